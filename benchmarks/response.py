@@ -0,0 +1,79 @@
+"""
+Benchmark salt ``Response`` aggregation on synthetic state.sls outputs
+
+Usage: python benchmarks/response.py [--minions 1000] [--states 40]
+"""
+from __future__ import print_function, division, absolute_import
+
+import sys
+import time
+import random
+import argparse
+
+from dask_ec2.salt import Response
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+def synthetic_response(minions=1000, states=40, failure_rate=0.01, seed=0):
+    """``state.sls`` like output: ``{'node-i': {'<state key>': {...}}}``
+    """
+    rng = random.Random(seed)
+    response = Response()
+    for i in range(minions):
+        output = {}
+        for j in range(states):
+            key = "cmd_|-state-{0}_|-command {0}_|-run".format(j)
+            failed = rng.random() < failure_rate
+            output[key] = {"__id__": "state-%i" % j,
+                           "__run_num__": j,
+                           "name": "command %i" % j,
+                           "result": not failed,
+                           "comment": "Command failed" if failed else "Command run",
+                           "changes": {"pid": rng.randint(1, 32768), "retcode": int(failed),
+                                       "stdout": "x" * 200, "stderr": ""},
+                           "duration": rng.uniform(1, 5000),
+                           "start_time": "10:00:%02i.000000" % (j % 60)}
+        response["node-%i" % i] = output
+    return response
+
+
+def measure(name, function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    memory = "n/a"
+    if tracemalloc:
+        # Separate run, tracing slows down the function a lot
+        tracemalloc.start()
+        function()
+        memory = "{:.1f} MB".format(tracemalloc.get_traced_memory()[1] / 1e6)
+        tracemalloc.stop()
+    print("{:<24} best {:8.1f} ms   peak memory {}".format(name, min(times) * 1000, memory))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minions", type=int, default=1000)
+    parser.add_argument("--states", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    response = synthetic_response(args.minions, args.states)
+    print("{} minions x {} states".format(args.minions, args.states))
+    aggregated = response.aggregate_by(field="result")
+    measure("aggregate_by", lambda: response.aggregate_by(field="result"), args.repeat)
+    measure("aggregated_to_table", lambda: aggregated.aggregated_to_table(agg=len), args.repeat)
+    measure("aggregated_success", aggregated.aggregated_success, args.repeat)
+    measure("group_by_id", response.group_by_id, args.repeat)
+    measure("group_by_id (aggregated)", aggregated.group_by_id, args.repeat)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
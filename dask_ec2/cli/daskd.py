@@ -2,11 +2,29 @@ import sys
 
 import click
 
-from .main import cli, print_state
+from .main import cli, apply_state, apply_states, print_state
+from .utils import AUTO_INT
 from ..cluster import Cluster
 from ..salt import upload_pillar
 
 
+def upload_dask_pillar(cluster, nprocs, source, nthreads=None, memory_limit=None):
+    scheduler_public_ip = cluster.instances[0].ip
+    scheduler_private_ip = cluster.instances[0].cluster_ip
+    upload_pillar(cluster, "dask.sls", {
+        "dask": {
+            "scheduler_public_ip": scheduler_public_ip,
+            "scheduler_private_ip": scheduler_private_ip,
+            "source_install": source,
+            "dask-worker": {
+                "nprocs": nprocs,
+                "nthreads": nthreads,
+                "memory_limit": memory_limit
+            }
+        }
+    })
+
+
 @cli.group('dask-distributed', invoke_without_command=True, short_help='dask.distributed option')
 @click.option("--file",
               "filepath",
@@ -16,19 +34,40 @@ from ..salt import upload_pillar
               required=False,
               help="Filepath to the instances metadata")
 @click.option("--nprocs",
-              default=1,
+              default="1",
+              type=AUTO_INT,
               show_default=True,
               required=False,
-              help="Number of processes per worker")
+              help="Number of processes per worker, 'auto' to derive the layout from the CPUs, memory and NUMA nodes")
+@click.option("--nthreads",
+              default=None,
+              type=AUTO_INT,
+              required=False,
+              help="Number of threads per worker process, by default the number of CPUs / nprocs")
+@click.option("--memory-limit",
+              default=None,
+              required=False,
+              help="Memory limit per worker process (e.g. 4GB) or 'auto', by default set by dask-worker")
 @click.option("--source/--no-source",
               is_flag=True,
               default=False,
               show_default=True,
               help="Install Dask/Distributed from git master")
+@click.option("--batch-size",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this many nodes at a time")
+@click.option("--batch-percent",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this percentage of the nodes at a time")
 @click.pass_context
-def dask(ctx, filepath, nprocs, source):
+def dask(ctx, filepath, nprocs, nthreads, memory_limit, source, batch_size, batch_percent):
     if ctx.invoked_subcommand is None:
-        ctx.invoke(dask_install, filepath=filepath, nprocs=nprocs, source=source)
+        ctx.invoke(dask_install, filepath=filepath, nprocs=nprocs, nthreads=nthreads, memory_limit=memory_limit,
+                   source=source, batch_size=batch_size, batch_percent=batch_percent)
 
 
 @dask.command("install", short_help="Start a dask.distributed cluster")
@@ -46,38 +85,58 @@ def dask(ctx, filepath, nprocs, source):
               show_default=True,
               help="Start or not a python shell when installation is finished")
 @click.option("--nprocs",
-              default=1,
+              default="1",
+              type=AUTO_INT,
               show_default=True,
               required=False,
-              help="Number of processes per worker")
+              help="Number of processes per worker, 'auto' to derive the layout from the CPUs, memory and NUMA nodes")
+@click.option("--nthreads",
+              default=None,
+              type=AUTO_INT,
+              required=False,
+              help="Number of threads per worker process, by default the number of CPUs / nprocs")
+@click.option("--memory-limit",
+              default=None,
+              required=False,
+              help="Memory limit per worker process (e.g. 4GB) or 'auto', by default set by dask-worker")
 @click.option("--source/--no-source",
               is_flag=True,
               default=False,
               show_default=True,
               help="Install Dask/Distributed from git master")
-def dask_install(ctx, filepath, shell, nprocs, source):
+@click.option("--batch-size",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this many nodes at a time")
+@click.option("--batch-percent",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this percentage of the nodes at a time")
+def dask_install(ctx, filepath, shell, nprocs, nthreads, memory_limit, source, batch_size, batch_percent):
     cluster = Cluster.from_filepath(filepath)
-    scheduler_public_ip = cluster.instances[0].ip
-    upload_pillar(cluster, "dask.sls", {
-        "dask": {
-            "scheduler_public_ip": scheduler_public_ip,
-            "source_install": source,
-            "dask-worker": {
-                "nprocs": nprocs
-            }
-        }
-    })
+    upload_dask_pillar(cluster, nprocs, source, nthreads=nthreads, memory_limit=memory_limit)
 
-    click.echo("Installing scheduler")
-    cluster.pepper.local("node-0", "grains.append", ["roles", "dask.distributed.scheduler"])
-    output = cluster.salt_call("node-0", "state.sls", ["dask.distributed.scheduler"])
-    response = print_state(output)
-    if not response.aggregated_success():
-        sys.exit(1)
+    batch = cluster.salt_batch()
+    batch.local("node-0", "grains.append", ["roles", "dask.distributed.scheduler"])
+    batch.local("node-[1-9]*", "grains.append", ["roles", "dask.distributed.worker"])
+    batch.send()
+
+    if batch_size or batch_percent:
+        click.echo("Installing scheduler")
+        output = apply_state(ctx, cluster, "node-0", "dask.distributed.scheduler")
+        response = print_state(output)
+        if not response.aggregated_success():
+            sys.exit(1)
 
-    click.echo("Installing workers")
-    cluster.pepper.local("node-[1-9]*", "grains.append", ["roles", "dask.distributed.worker"])
-    output = cluster.salt_call("node-[1-9]*", "state.sls", ["dask.distributed.worker"])
+        click.echo("Installing workers")
+        output = apply_state(ctx, cluster, "node-[1-9]*", "dask.distributed.worker", batch_size=batch_size,
+                             batch_percent=batch_percent)
+    else:
+        click.echo("Installing scheduler and workers")
+        output = apply_states(ctx, cluster, [("node-0", "dask.distributed.scheduler"),
+                                             ("node-[1-9]*", "dask.distributed.worker")])
     response = print_state(output)
     if not response.aggregated_success():
         sys.exit(1)
@@ -103,12 +162,14 @@ def dask_install(ctx, filepath, shell, nprocs, source):
 def dask_address(ctx, filepath):
     cluster = Cluster.from_filepath(filepath)
     address = cluster.instances[0].ip
+    private_address = cluster.instances[0].cluster_ip
     click.echo("""
 
 Addresses
 ---------
 Web Interface:    http://{0}:8787/status
 TCP Interface:           {0}:8786
+Workers connect to:      {1}:8786 (private network)
 
 To connect from the cluster
 ---------------------------
@@ -132,7 +193,7 @@ e = Client('{0}:8786')  # Connect to scheduler running on the head node
 To destroy
 ----------
 
-dask-ec2 destroy""".format(address).lstrip())
+dask-ec2 destroy""".format(address, private_address).lstrip())
 
 
 @dask.command(
@@ -182,3 +243,142 @@ def open_ui(ctx, filepath):
     cluster = Cluster.from_filepath(filepath)
     address = "{}:{}/status".format(cluster.instances[0].ip, 8787)
     webbrowser.open(address, new=2)
+
+
+WORKERS_SCRIPT = ("import json; from distributed import Client; "
+                  "c = Client('127.0.0.1:8786', timeout=10); "
+                  "print(json.dumps(sorted(c.scheduler_info()['workers'])))")
+
+
+def workers_command(install_prefix):
+    """Command that prints the addresses of the workers registered in the scheduler as JSON
+    """
+    from six.moves import shlex_quote
+    return "{}/bin/python -c {}".format(install_prefix.rstrip("/"), shlex_quote(WORKERS_SCRIPT))
+
+
+def tune_command(install_prefix, layouts, script="/tmp/dask-ec2-tune/tune_layout.py"):
+    """Command that benchmarks the ``(nprocs, nthreads)`` layouts with the uploaded ``tune_layout.py``
+    """
+    import json
+    from six.moves import shlex_quote
+    return "{}/bin/python {} {}".format(install_prefix.rstrip("/"), script, shlex_quote(json.dumps(layouts)))
+
+
+@dask.command("check-network", short_help="Check that the workers registered over the private network")
+@click.pass_context
+@click.option("--file",
+              "filepath",
+              type=click.Path(exists=True),
+              default="cluster.yaml",
+              show_default=True,
+              required=False,
+              help="Filepath to the instances metadata")
+@click.option("--install-prefix",
+              default="/opt/anaconda",
+              show_default=True,
+              required=False,
+              help="Path of the anaconda installation on the nodes")
+def check_network(ctx, filepath, install_prefix):
+    import json
+    from .utils import Table
+    cluster = Cluster.from_filepath(filepath)
+    output = cluster.instances[0].ssh_client.exec_command(workers_command(install_prefix))
+    if output["exit_code"] != 0:
+        click.echo("ERROR: Couldn't get the workers from the scheduler: {}".format(output["stderr"]), err=True)
+        sys.exit(1)
+
+    rows = cluster.classify_addresses(json.loads(output["stdout"].splitlines()[-1]))
+    data = [["Worker", "Node", "Network"]]
+    data.extend([address, "" if index is None else "node-{}".format(index), network]
+                for address, index, network in rows)
+    Table(data, 1).write()
+
+    if not rows:
+        click.echo("ERROR: No workers registered with the scheduler", err=True)
+        sys.exit(1)
+    not_private = [address for address, _, network in rows if network != "private"]
+    if not_private:
+        click.echo("ERROR: {} of {} workers are not using the private network".format(
+            len(not_private), len(rows)), err=True)
+        sys.exit(1)
+    click.echo("All {} workers registered over the private network".format(len(rows)))
+
+
+@dask.command("tune", short_help="Benchmark worker layouts on one node and apply the fastest one")
+@click.pass_context
+@click.option("--file",
+              "filepath",
+              type=click.Path(exists=True),
+              default="cluster.yaml",
+              show_default=True,
+              required=False,
+              help="Filepath to the instances metadata")
+@click.option("--install-prefix",
+              default="/opt/anaconda",
+              show_default=True,
+              required=False,
+              help="Path of the anaconda installation on the nodes")
+@click.option("--apply/--no-apply",
+              "apply_",
+              is_flag=True,
+              default=True,
+              show_default=True,
+              help="Restart the workers of all the nodes with the fastest layout")
+@click.option("--source/--no-source",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Dask/Distributed was installed from git master")
+def dask_tune(ctx, filepath, install_prefix, apply_, source):
+    import os
+    import json
+    import dask_ec2
+    from .utils import Table
+    from ..tuning import candidate_layouts, choose_layout
+
+    cluster = Cluster.from_filepath(filepath)
+    if len(cluster.instances) < 2:
+        click.echo("ERROR: The cluster has no worker nodes", err=True)
+        sys.exit(1)
+    # All the workers run on the same instance type, benchmark the first one
+    client = cluster.instances[1].ssh_client
+
+    output = client.exec_command("nproc && ls -d /sys/devices/system/node/node[0-9]* | wc -l")
+    cpus, numa_nodes = [int(line) for line in output["stdout"].split()[:2]]
+    layouts = candidate_layouts(cpus, numa_nodes)
+    click.echo("Benchmarking {} layouts on node-1 ({} CPUs, {} NUMA nodes)".format(len(layouts), cpus, numa_nodes))
+
+    dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
+    script = os.path.join(dask_ec2_src, "templates", "tune_layout.py")
+    lines = []
+
+    def __output(stream, line):
+        if stream == "stdout":
+            lines.append(line)
+
+    # The running worker would compete for the CPUs
+    client.exec_command("supervisorctl stop dask-worker", sudo=True)
+    try:
+        client.put_tar([(script, "tune_layout.py")], "/tmp/dask-ec2-tune",
+                       run=tune_command(install_prefix, layouts), callback=__output)
+    finally:
+        # Also if the benchmark fails, with --apply the state restarts it with the new layout
+        client.exec_command("supervisorctl start dask-worker", sudo=True)
+    results = json.loads(lines[-1])
+
+    best = choose_layout(results)
+    data = [["Processes", "Threads", "GIL-bound (s)", "GIL-releasing (s)", ""]]
+    for r in results:
+        data.append([r["nprocs"], r["nthreads"], "{:.2f}".format(r["gil_seconds"]),
+                     "{:.2f}".format(r["nogil_seconds"]), "fastest" if r is best else ""])
+    Table(data, 1).write()
+
+    if not apply_:
+        return
+    click.echo("Restarting the workers with {} processes x {} threads".format(best["nprocs"], best["nthreads"]))
+    upload_dask_pillar(cluster, best["nprocs"], source, nthreads=best["nthreads"], memory_limit="auto")
+    output = apply_state(ctx, cluster, "node-[1-9]*", "dask.distributed.worker")
+    response = print_state(output)
+    if not response.aggregated_success():
+        sys.exit(1)
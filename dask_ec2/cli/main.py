@@ -1,15 +1,21 @@
 from __future__ import print_function, division, absolute_import
 
+import os
 import sys
+import json
+import time
 import click
 
 from botocore.exceptions import ClientError
 
-from ..cluster import Cluster
+from ..cluster import Cluster, DEFAULT_POLL_INTERVAL
 from ..config import setup_logging
-from ..exceptions import DaskEc2Exception
-from ..salt import Response
-from .utils import Table
+from ..ec2 import PLACEMENT_STRATEGIES
+from ..exceptions import DaskEc2Exception, SaltTimeoutException
+from ..executor import DEFAULT_PARALLELISM
+from ..salt import Response, StateProfile
+from ..ssh import get_pool
+from .utils import Table, AUTO_INT
 import dask_ec2
 
 
@@ -33,6 +39,11 @@ def start():
     except Exception as e:
         click.echo(traceback.format_exc(), err=True)
         sys.exit(1)
+    finally:
+        pool = get_pool()
+        logging.getLogger("dask_ec2").debug("SSH connections: %(new)i new, %(reused)i reused, "
+                                            "%(reconnected)i reconnected, %(evicted)i evicted", pool.stats)
+        pool.close_all()
 
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
@@ -40,9 +51,32 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 @click.group(context_settings=CONTEXT_SETTINGS)
 @click.version_option(prog_name="dask-ec2", version=dask_ec2.__version__)
+@click.option("--poll-interval",
+              default=DEFAULT_POLL_INTERVAL,
+              type=float,
+              show_default=True,
+              required=False,
+              help="Seconds between polls for the results of salt states")
+@click.option("--deadline",
+              default=None,
+              type=int,
+              required=False,
+              help="Seconds to wait for every salt state run, by default until the minions return or stop running it")
+@click.option("--profile-file",
+              default=None,
+              type=click.Path(dir_okay=False),
+              required=False,
+              help="Append the per state timings of every salt state run to this JSON file")
+@click.option("--ec2-cache-ttl",
+              default=0,
+              type=int,
+              show_default=True,
+              required=False,
+              help="Seconds to cache the VPC, subnet and security group lookups in ~/.dask-ec2, 0 to disable")
 @click.pass_context
-def cli(ctx):
-    ctx.obj = {}
+def cli(ctx, poll_interval, deadline, profile_file, ec2_cache_ttl):
+    ctx.obj = {"poll_interval": poll_interval, "deadline": deadline, "profile_file": profile_file,
+               "ec2_cache_ttl": ec2_cache_ttl}
 
 
 @cli.command(short_help="Launch instances")
@@ -103,6 +137,45 @@ def cli(ctx):
               show_default=True,
               required=False,
               help="Root volume size (GB)")
+@click.option("--volume-iops",
+              default=None,
+              type=int,
+              required=False,
+              help="Provisioned IOPS of the root volume (gp3, io1 and io2)")
+@click.option("--volume-throughput",
+              default=None,
+              type=int,
+              required=False,
+              help="Provisioned throughput of the root volume in MiB/s (gp3)")
+@click.option("--data-volume",
+              "data_volumes",
+              multiple=True,
+              required=False,
+              help="Extra EBS volume as SIZE[:TYPE[:IOPS[:THROUGHPUT]]], the type defaults to gp3. Can be repeated")
+@click.option("--head-volume-type",
+              default=None,
+              required=False,
+              help="Root volume type of the head node, by default the same as the workers")
+@click.option("--head-volume-size",
+              default=None,
+              type=int,
+              required=False,
+              help="Root volume size (GB) of the head node, by default the same as the workers")
+@click.option("--head-volume-iops",
+              default=None,
+              type=int,
+              required=False,
+              help="Provisioned IOPS of the head node root volume, by default the workers' if its type supports it")
+@click.option("--head-volume-throughput",
+              default=None,
+              type=int,
+              required=False,
+              help="Provisioned throughput of the head node root volume, by default the workers' if it is gp3")
+@click.option("--head-data-volume",
+              "head_data_volumes",
+              multiple=True,
+              required=False,
+              help="Extra EBS volume of the head node, by default the same as the workers. Can be repeated")
 @click.option("--file",
               "filepath",
               type=click.Path(),
@@ -134,19 +207,98 @@ def cli(ctx):
               required=False,
               help="Start a Jupyter Notebook in the head node")
 @click.option("--nprocs",
-              default=1,
+              default="1",
+              type=AUTO_INT,
               show_default=True,
               required=False,
-              help="Number of processes per worker")
+              help="Number of processes per worker, 'auto' to derive the layout from the CPUs, memory and NUMA nodes")
+@click.option("--nthreads",
+              default=None,
+              type=AUTO_INT,
+              required=False,
+              help="Number of threads per worker process, by default the number of CPUs / nprocs")
+@click.option("--memory-limit",
+              default=None,
+              required=False,
+              help="Memory limit per worker process (e.g. 4GB) or 'auto', by default set by dask-worker")
+@click.option("--batch-size",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this many nodes at a time")
+@click.option("--batch-percent",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this percentage of the nodes at a time")
+@click.option("--parallelism",
+              default=DEFAULT_PARALLELISM,
+              show_default=True,
+              required=False,
+              help="Maximum number of nodes to work on at the same time")
+@click.option("--node-timeout",
+              default=None,
+              type=int,
+              required=False,
+              help="Seconds a node can take in every SSH step, slower nodes are reported as failed")
+@click.option("--node-deadline",
+              default=None,
+              type=int,
+              required=False,
+              help="Seconds all the nodes can take in every SSH step, the ones not done are reported as failed")
 @click.option("--source/--no-source",
               is_flag=True,
               default=False,
               show_default=True,
               help="Install Dask/Distributed from git master")
+@click.option("--highstate/--no-highstate",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Provision with one highstate per node instead of one run per component")
+@click.option("--baked/--no-baked",
+              is_flag=True,
+              default=True,
+              show_default=True,
+              help="Launch from an image created with `dask-ec2 bake` for the AMI if there is one")
+@click.option("--pipeline/--no-pipeline",
+              is_flag=True,
+              default=True,
+              show_default=True,
+              help="Bootstrap salt on every node as soon as it's running instead of waiting for all of them")
+@click.option("--placement-group",
+              default=None,
+              required=False,
+              help="Launch the nodes in this placement group, created if it doesn't exist")
+@click.option("--placement-strategy",
+              type=click.Choice(PLACEMENT_STRATEGIES),
+              default="cluster",
+              show_default=True,
+              required=False,
+              help="Strategy of the placement group if it's created")
+@click.option("--partition-count",
+              default=None,
+              type=int,
+              required=False,
+              help="Number of partitions of a placement group with the partition strategy")
+@click.option("--enhanced-networking/--no-enhanced-networking",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Require ENA support for the instance type and check ENA and jumbo frames on the nodes")
+@click.option("--instance-store/--no-instance-store",
+              is_flag=True,
+              default=True,
+              show_default=True,
+              help="Attach the instance store volumes of the instance type, used by the workers to spill to disk")
 def up(ctx, name, keyname, keypair, region_name, vpc_id, subnet_id,
        iaminstance_name, ami, username, instance_type, count,
        security_group_name, security_group_id, volume_type, volume_size,
-       filepath, _provision, anaconda_, dask, notebook, nprocs, source, tags):
+       filepath, _provision, anaconda_, dask, notebook, nprocs, nthreads, memory_limit, batch_size, batch_percent,
+       parallelism, node_timeout, node_deadline, source,
+       highstate, baked, pipeline, tags, placement_group, placement_strategy, partition_count,
+       enhanced_networking, instance_store, volume_iops, volume_throughput, data_volumes, head_volume_type,
+       head_volume_size, head_volume_iops, head_volume_throughput, head_data_volumes):
     import os
     from ..ec2 import EC2
 
@@ -162,6 +314,15 @@ def up(ctx, name, keyname, keypair, region_name, vpc_id, subnet_id,
             click.echo("Invalid Key Value Pair: {}.  Must be of the form K:V".format(t))
             sys.exit(1)
 
+    try:
+        worker_storage = get_storage(volume_type, volume_size, volume_iops, volume_throughput, data_volumes)
+        head_storage = get_head_storage(worker_storage, head_volume_type, head_volume_size, head_volume_iops,
+                                        head_volume_throughput, head_data_volumes)
+    except DaskEc2Exception as e:
+        click.echo("ERROR: {}".format(e), err=True)
+        sys.exit(1)
+    storage = {"head": head_storage, "worker": worker_storage}
+
     if os.path.exists(filepath):
         msg = "A file named {} already exists, proceeding will overwrite this file. Continue?".format(filepath)
         if not click.confirm(msg):
@@ -173,28 +334,148 @@ def up(ctx, name, keyname, keypair, region_name, vpc_id, subnet_id,
                  subnet_id=subnet_id,
                  default_vpc=not (vpc_id),
                  default_subnet=not (subnet_id),
-                 iaminstance_name=iaminstance_name)
+                 iaminstance_name=iaminstance_name,
+                 cache_ttl=(ctx.obj or {}).get("ec2_cache_ttl"))
+    baked_image_id = None
+    if baked and _provision and anaconda_ and dask:
+        from ..images import ImageRegistry, DEFAULT_PYVERSION, image_key
+        entry = ImageRegistry().get(image_key(region_name, ami, DEFAULT_PYVERSION, username))
+        if entry and driver.image_exists(entry["image_id"]):
+            baked_image_id = entry["image_id"]
+            click.echo("Using image {} baked from {}".format(baked_image_id, ami))
+
+    if enhanced_networking:
+        try:
+            ena_info = driver.check_enhanced_networking(instance_type, image_id=baked_image_id or ami)
+        except DaskEc2Exception as e:
+            click.echo("ERROR: {}".format(e), err=True)
+            sys.exit(1)
+        click.echo("Instance type {} has ENA support ({}), network performance: {}".format(
+            instance_type, ena_info["ena_support"], ena_info["network_performance"]))
+    if placement_group:
+        try:
+            driver.create_placement_group(placement_group, strategy=placement_strategy,
+                                          partition_count=partition_count)
+        except DaskEc2Exception as e:
+            click.echo("ERROR: {}".format(e), err=True)
+            sys.exit(1)
+
+    pipelined = pipeline and _provision
     click.echo("Launching nodes")
-    instances = driver.launch(name=name,
-                              image_id=ami,
-                              instance_type=instance_type,
-                              count=count,
-                              keyname=keyname,
-                              security_group_name=security_group_name,
-                              security_group_id=security_group_id,
-                              volume_type=volume_type,
-                              volume_size=volume_size,
-                              keypair=keypair,
-                              tags=tags)
+    instances = launch_nodes(driver, storage, count,
+                             name=name,
+                             image_id=baked_image_id or ami,
+                             instance_type=instance_type,
+                             keyname=keyname,
+                             security_group_name=security_group_name,
+                             security_group_id=security_group_id,
+                             keypair=keypair,
+                             tags=tags,
+                             wait=not pipelined,
+                             placement_group=placement_group,
+                             instance_store=instance_store)
 
-    cluster = Cluster.from_boto3_instances(region_name, instances)
-    cluster.set_username(username)
-    cluster.set_keypair(keypair)
-    cluster.to_file(filepath)
+    if pipelined:
+        launch_pipeline(instances, driver, region_name, username, keypair, parallelism, filepath, storage=storage,
+                        node_timeout=node_timeout, node_deadline=node_deadline)
+    else:
+        cluster = Cluster.from_boto3_instances(region_name, instances)
+        cluster.set_username(username)
+        cluster.set_keypair(keypair)
+        cluster.storage = storage
+        cluster.to_file(filepath)
+
+    if enhanced_networking:
+        ctx.invoke(network, filepath=filepath, strict=False)
 
     if _provision:
-        ctx.invoke(provision, filepath=filepath, anaconda_=anaconda_,
-                   dask=dask, notebook=notebook, nprocs=nprocs, source=source)
+        ctx.invoke(provision, filepath=filepath, ssh_check=not pipelined, master=not pipelined,
+                   minions=not pipelined, anaconda_=anaconda_, dask=dask, notebook=notebook, nprocs=nprocs,
+                   nthreads=nthreads, memory_limit=memory_limit,
+                   batch_size=batch_size, batch_percent=batch_percent, parallelism=parallelism,
+                   node_timeout=node_timeout, node_deadline=node_deadline, source=source,
+                   highstate=highstate, baked=baked_image_id is not None)
+
+
+def get_storage(volume_type, volume_size, iops, throughput, data_volumes):
+    """Volume settings of a role as ``EC2.launch`` arguments
+
+    Raises
+    ------
+        DaskEc2Exception if the settings are not valid for the volume types
+    """
+    from ..ec2 import ebs_mapping, parse_data_volume
+    storage = {"volume_type": volume_type, "volume_size": volume_size, "volume_iops": iops,
+               "volume_throughput": throughput, "data_volumes": [parse_data_volume(v) for v in data_volumes]}
+    # Validate before launching anything
+    ebs_mapping("/dev/sda1", volume_type, volume_size, iops, throughput)
+    for volume in storage["data_volumes"]:
+        ebs_mapping("/dev/sdf", **volume)
+    return storage
+
+
+def get_head_storage(worker_storage, volume_type, volume_size, iops, throughput, data_volumes):
+    """Volume settings of the head node, the ones not given are the ones of the workers
+
+    The IOPS and throughput of the workers are only inherited if the root
+    volume type of the head node supports them, e.g. a ``gp2`` head node with
+    ``gp3`` workers gets neither.
+    """
+    from ..ec2 import IOPS_VOLUME_TYPES, THROUGHPUT_VOLUME_TYPES
+    volume_type = volume_type or worker_storage["volume_type"]
+    if iops is None and volume_type in IOPS_VOLUME_TYPES:
+        iops = worker_storage["volume_iops"]
+    if throughput is None and volume_type in THROUGHPUT_VOLUME_TYPES:
+        throughput = worker_storage["volume_throughput"]
+    storage = get_storage(volume_type, volume_size or worker_storage["volume_size"], iops, throughput,
+                          data_volumes or [])
+    if not data_volumes:
+        storage["data_volumes"] = worker_storage["data_volumes"]
+    return storage
+
+
+def launch_nodes(driver, storage, count, **kwargs):
+    """Launch the head node and the workers with the volume settings of their role
+
+    Returns
+    -------
+        The boto3 instances, the head node first
+    """
+    if count == 1 or storage["head"] == storage["worker"]:
+        return driver.launch(count=count, **dict(kwargs, **storage["head"]))
+    head = driver.launch(count=1, **dict(kwargs, **storage["head"]))
+    workers = driver.launch(count=count - 1, first_index=1, **dict(kwargs, **storage["worker"]))
+    return list(head) + list(workers)
+
+
+def launch_pipeline(instances, driver, region_name, username, keypair, parallelism, filepath, storage=None,
+                    node_timeout=None, node_deadline=None):
+    """Bootstrap salt on every node as soon as it is running, see ``dask_ec2.pipeline``
+
+    The cluster file is written even if the pipeline fails so the instances
+    can be destroyed.
+    """
+    from ..pipeline import LaunchPipeline
+
+    def __progress(index, stage, seconds):
+        if stage in ("master", "minion"):
+            click.echo("  node-{}: salt-{} installed ({:.1f}s)".format(index, stage, seconds))
+
+    click.echo("Bootstrapping salt on the nodes as they boot")
+    pipeline = LaunchPipeline(driver, region_name, instances, username, keypair, parallelism=parallelism,
+                              node_timeout=node_timeout, node_deadline=node_deadline, callback=__progress)
+    pipeline.cluster.storage = storage or {}
+    try:
+        pipeline.run()
+    finally:
+        pipeline.cluster.to_file(filepath)
+
+    data = [["Stage", "p50 (s)", "Max (s)"]]
+    for stage, seconds in pipeline.summary().items():
+        data.append([stage, "{:.1f}".format(seconds["p50"]), "{:.1f}".format(seconds["max"])])
+    Table(data, 1).write()
+    click.echo("Salt ready on {} nodes in {:.1f}s".format(len(instances), pipeline.seconds))
+    return pipeline.cluster
 
 
 @cli.command(short_help="Destroy cluster")
@@ -215,7 +496,8 @@ def destroy(ctx, filepath, yes):
 
     question = 'Are you sure you want to destroy the cluster?'
     if yes or click.confirm(question):
-        driver = EC2(region=cluster.region, default_vpc=False, default_subnet=False)
+        driver = EC2(region=cluster.region, default_vpc=False, default_subnet=False,
+                     cache_ttl=(ctx.obj or {}).get("ec2_cache_ttl"))
         # needed if there is no default vpc or subnet
         ids = [i.uid for i in cluster.instances]
         click.echo("Terminating instances")
@@ -253,6 +535,101 @@ def ssh(ctx, node, filepath):
     subprocess.call(cmd)
 
 
+@cli.command(short_help="Check ENA, MTU and link speed of the nodes")
+@click.pass_context
+@click.option("--file",
+              "filepath",
+              type=click.Path(exists=True),
+              default="cluster.yaml",
+              show_default=True,
+              required=False,
+              help="Filepath to the instances metadata")
+@click.option("--strict/--no-strict",
+              is_flag=True,
+              default=True,
+              show_default=True,
+              help="Exit with an error if a node doesn't use ENA or jumbo frames")
+def network(ctx, filepath, strict):
+    from ..salt import network_info, JUMBO_MTU
+    cluster = Cluster.from_filepath(filepath)
+    try:
+        cluster.wait_for_ssh()
+    except DaskEc2Exception as e:
+        click.echo("ERROR: {}".format(e), err=True)
+        sys.exit(1)
+
+    info = network_info(cluster)
+    data = [["Node ID", "IP", "Interface", "Driver", "MTU", "Speed (Mbps)"]]
+    problems = []
+    for i, (ip, node) in enumerate(info.items()):
+        if node is None:
+            data.append(["node-{}".format(i), ip, "", "", "", ""])
+            problems.append("node-{}: couldn't get the network settings".format(i))
+            continue
+        data.append(["node-{}".format(i), ip, node["interface"], node["driver"], node["mtu"],
+                     node["speed"] or "n/a"])
+        if not node["ena"]:
+            problems.append("node-{}: driver is '{}', not ena".format(i, node["driver"]))
+        if not node["jumbo"]:
+            problems.append("node-{}: MTU {} is lower than {}".format(i, node["mtu"], JUMBO_MTU))
+    Table(data, 1).write()
+
+    for problem in problems:
+        click.echo("WARNING: {}".format(problem), err=True)
+    if problems and strict:
+        sys.exit(1)
+
+
+@cli.command("disk-benchmark", short_help="Measure the disk throughput of the nodes with fio")
+@click.pass_context
+@click.option("--file",
+              "filepath",
+              type=click.Path(exists=True),
+              default="cluster.yaml",
+              show_default=True,
+              required=False,
+              help="Filepath to the instances metadata")
+@click.option("--directory",
+              default="/mnt/dask-local",
+              show_default=True,
+              required=False,
+              help="Directory on the disk to measure, by default the dask-worker local directory")
+@click.option("--size",
+              default="1G",
+              show_default=True,
+              required=False,
+              help="Size of the fio test file")
+@click.option("--runtime",
+              default=30,
+              show_default=True,
+              required=False,
+              help="Seconds per fio job")
+def disk_benchmark(ctx, filepath, directory, size, runtime):
+    from ..salt import disk_benchmark as run_disk_benchmark
+    cluster = Cluster.from_filepath(filepath)
+    click.echo("Installing fio")
+    output = apply_state(ctx, cluster, "*", "fio")
+    response = print_state(output)
+    if not response.aggregated_success():
+        sys.exit(1)
+
+    click.echo("Running the disk benchmark on {} ({} seconds per job)".format(directory, runtime))
+    results = run_disk_benchmark(cluster, directory=directory, size=size, runtime=runtime)
+    data = [["Node ID", "IP", "Write (MB/s)", "Read (MB/s)", "Write IOPS", "Read IOPS"]]
+    failed = []
+    for i, (ip, result) in enumerate(results.items()):
+        if result is None:
+            failed.append("node-{}".format(i))
+            data.append(["node-{}".format(i), ip, "failed", "failed", "", ""])
+            continue
+        data.append(["node-{}".format(i), ip] + ["{:.0f}".format(result[k]) for k in ("write_mbps", "read_mbps",
+                                                                                      "write_iops", "read_iops")])
+    Table(data, 1).write()
+    if failed:
+        click.echo("ERROR: The disk benchmark failed on: {}".format(", ".join(failed)), err=True)
+        sys.exit(1)
+
+
 @cli.command(short_help="Provision salt instances")
 @click.pass_context
 @click.option("--file",
@@ -301,49 +678,319 @@ def ssh(ctx, node, filepath):
               required=False,
               help="Start a Jupyter Notebook in the head node")
 @click.option("--nprocs",
-              default=1,
+              default="1",
+              type=AUTO_INT,
               show_default=True,
               required=False,
-              help="Number of processes per worker")
+              help="Number of processes per worker, 'auto' to derive the layout from the CPUs, memory and NUMA nodes")
+@click.option("--nthreads",
+              default=None,
+              type=AUTO_INT,
+              required=False,
+              help="Number of threads per worker process, by default the number of CPUs / nprocs")
+@click.option("--memory-limit",
+              default=None,
+              required=False,
+              help="Memory limit per worker process (e.g. 4GB) or 'auto', by default set by dask-worker")
+@click.option("--batch-size",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this many nodes at a time")
+@click.option("--batch-percent",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this percentage of the nodes at a time")
+@click.option("--parallelism",
+              default=DEFAULT_PARALLELISM,
+              show_default=True,
+              required=False,
+              help="Maximum number of nodes to work on at the same time")
+@click.option("--node-timeout",
+              default=None,
+              type=int,
+              required=False,
+              help="Seconds a node can take in every SSH step, slower nodes are reported as failed")
+@click.option("--node-deadline",
+              default=None,
+              type=int,
+              required=False,
+              help="Seconds all the nodes can take in every SSH step, the ones not done are reported as failed")
 @click.option("--source/--no-source",
               is_flag=True,
               default=False,
               show_default=True,
               help="Install Dask/Distributed from git master")
-def provision(ctx, filepath, ssh_check, master, minions, upload, anaconda_, dask, notebook, nprocs, source):
-    import six
+@click.option("--highstate/--no-highstate",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Assign all the roles first and apply one highstate per node instead of one run per component")
+@click.option("--baked/--no-baked",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="The nodes run an image created with `dask-ec2 bake`, skip the installation states")
+def provision(ctx, filepath, ssh_check, master, minions, upload, anaconda_, dask, notebook, nprocs, nthreads,
+              memory_limit, batch_size, batch_percent, parallelism, node_timeout, node_deadline, source, highstate,
+              baked):
+    from ..images import DEFAULT_PYVERSION
     from ..salt import install_salt_master, install_salt_minion, upload_formulas, upload_pillar
 
     cluster = Cluster.from_filepath(filepath)
+    cluster.parallelism = parallelism
+    cluster.node_timeout = node_timeout
+    cluster.node_deadline = node_deadline
     if ssh_check:
         click.echo("Checking SSH connection to nodes")
-        cluster = Cluster.from_filepath(filepath)
-        info = cluster.check_ssh()
-        data = [["Node IP", "SSH check"]]
-        for ip, status in info.items():
-            data.append([ip, status])
+        info = cluster.wait_for_ssh()
+        data = [["Node IP", "SSH check", "Time to ready (s)"]]
+        for ip, seconds in info.items():
+            data.append([ip, True, "{:.1f}".format(seconds)])
         t = Table(data, 1)
         t.write()
     if master:
         click.echo("Bootstrapping salt master")
-        install_salt_master(cluster)
+        steps = install_salt_master(cluster)
+        data = [["Step", "Time (s)"]]
+        for step in steps:
+            data.append([step["name"], "{:.1f}".format(step["seconds"])])
+        t = Table(data, 1)
+        t.write()
     if minions:
         click.echo("Bootstrapping salt minions")
-        install_salt_minion(cluster)
+        results = install_salt_minion(cluster)
+        click.echo("Slowest nodes:")
+        data = [["Node IP", "Minion ID", "bootstrap (s)", "configure (s)", "restart (s)", "Total (s)"]]
+        for result in sorted(results, key=lambda x: x["seconds"], reverse=True)[:5]:
+            timings = ["{:.1f}".format(step["seconds"]) for step in result["steps"]]
+            data.append([result["ip"], result["minion_id"]] + timings + ["{:.1f}".format(result["seconds"])])
+        t = Table(data, 1)
+        t.write()
     if upload:
         click.echo("Uploading salt formulas")
-        upload_formulas(cluster)
+        synced = upload_formulas(cluster)
+        for name in sorted(synced):
+            stats = synced[name]
+            click.echo("  {}: {} transferred, {} skipped, {} deleted ({:.1f} KB)".format(
+                name, len(stats["transferred"]), stats["skipped"], len(stats["deleted"]), stats["bytes_sent"] / 1024.0))
         click.echo("Uploading conda and cluster settings")
-        upload_pillar(cluster, "conda.sls", {"conda": {"pyversion": 2 if six.PY2 else 3}})
-        upload_pillar(cluster, "cluster.sls", {"cluster": {"username": cluster.instances[0].username}})
+        upload_pillar(cluster, "conda.sls", {"conda": {"pyversion": DEFAULT_PYVERSION}})
+        upload_pillar(cluster, "cluster.sls", {"cluster": {"username": cluster.instances[0].username,
+                                                           "baked": baked}})
+
+    components = [name for name, enabled in (("anaconda", anaconda_), ("dask", dask), ("notebook", notebook))
+                  if enabled]
+    if not components:
+        return
+    start = time.time()
+    if highstate:
+        provision_highstate(ctx, cluster, anaconda_, dask, notebook, nprocs, source, batch_size, batch_percent,
+                            nthreads=nthreads, memory_limit=memory_limit)
+    else:
+        if anaconda_:
+            ctx.invoke(anaconda, filepath=filepath, batch_size=batch_size, batch_percent=batch_percent)
+        if dask:
+            from .daskd import dask_install
+            ctx.invoke(dask_install, filepath=filepath, nprocs=nprocs, nthreads=nthreads, memory_limit=memory_limit,
+                       source=source, batch_size=batch_size, batch_percent=batch_percent)
+        if notebook:
+            from .notebook import notebook_install
+            ctx.invoke(notebook_install, filepath=filepath)
+    print_provision_time(cluster, "highstate" if highstate else "multi-pass", components, time.time() - start)
+
+
+def provision_highstate(ctx, cluster, anaconda_, dask, notebook, nprocs, source, batch_size, batch_percent,
+                        nthreads=None, memory_limit=None):
+    """Set the ``roles`` grain of every node and apply the highstate once
+
+    ``formulas/salt/top.sls`` maps the roles to states, so every node
+    renders and runs its whole state tree in a single pass.
+    """
+    from .daskd import upload_dask_pillar, dask_address
+    from .notebook import upload_jupyter_pillar, JUPYTER_PASSWORD
+
+    head_roles, worker_roles = [], []
     if anaconda_:
-        ctx.invoke(anaconda, filepath=filepath)
+        head_roles.append("conda")
+        worker_roles.append("conda")
     if dask:
-        from .daskd import dask_install
-        ctx.invoke(dask_install, filepath=filepath, nprocs=nprocs, source=source)
+        upload_dask_pillar(cluster, nprocs, source, nthreads=nthreads, memory_limit=memory_limit)
+        head_roles.append("dask.distributed.scheduler")
+        worker_roles.append("dask.distributed.worker")
     if notebook:
-        from .notebook import notebook_install
-        ctx.invoke(notebook_install, filepath=filepath)
+        upload_jupyter_pillar(cluster, JUPYTER_PASSWORD)
+        head_roles.append("jupyter.notebook")
+
+    click.echo("Assigning roles: node-0: {}; workers: {}".format(", ".join(head_roles), ", ".join(worker_roles)))
+    batch = cluster.salt_batch()
+    batch.local("node-0", "grains.setval", ["roles", head_roles])
+    batch.local("node-[1-9]*", "grains.setval", ["roles", worker_roles])
+    batch.send()
+
+    click.echo("Applying highstate")
+    output = apply_state(ctx, cluster, "*", None, batch_size=batch_size, batch_percent=batch_percent)
+    response = print_state(output)
+    if not response.aggregated_success():
+        sys.exit(1)
+
+    if dask:
+        ctx.invoke(dask_address, filepath=cluster.filepath)
+    if notebook:
+        click.echo("Jupyter notebook available at http://%s:8888/ \nLogin with "
+                   "password: %s" % (cluster.head.ip, JUPYTER_PASSWORD))
+
+
+def print_provision_time(cluster, mode, components, seconds):
+    """Record the wall time of the state runs of ``provision`` and compare
+    it with the other mode if it was recorded for the same components
+    """
+    key = "provision-{}-{}".format(mode, "+".join(components))
+    timings = cluster.record_timing(key, seconds)
+    click.echo("Provisioning {} took {:.1f}s ({})".format(", ".join(components), seconds, mode))
+
+    other = "multi-pass" if mode == "highstate" else "highstate"
+    previous = timings.get("provision-{}-{}".format(other, "+".join(components)))
+    if previous:
+        multi_pass = previous["seconds"] if mode == "highstate" else seconds
+        single_pass = seconds if mode == "highstate" else previous["seconds"]
+        saved = multi_pass - single_pass
+        click.echo("  {} took {:.1f}s: highstate {} {:.1f}s ({:.0f}%)".format(
+            other, previous["seconds"], "saves" if saved >= 0 else "costs", abs(saved),
+            100.0 * abs(saved) / multi_pass))
+
+
+@cli.command(short_help="Create an image with anaconda and dask.distributed installed")
+@click.pass_context
+@click.option("--keyname", required=True, help="Keyname on EC2 console")
+@click.option("--keypair",
+              required=True,
+              type=click.Path(exists=True),
+              help="Path to the keypair that matches the keyname")
+@click.option("--region-name",
+              default="us-east-1",
+              show_default=True,
+              required=False,
+              help="AWS region")
+@click.option("--vpc-id", default=None, show_default=True, required=False, help="EC2 VPC ID")
+@click.option("--subnet-id", default=None, show_default=True, required=False, help="EC2 Subnet ID on the VPC")
+@click.option("--iaminstance-name", default=None, show_default=True, required=False, help="IAM Instance Name")
+@click.option("--ami", default="ami-d05e75b8", show_default=True, required=False, help="Base EC2 AMI")
+@click.option("--username",
+              default="ubuntu",
+              show_default=True,
+              required=False,
+              help="User to SSH to the AMI")
+@click.option("--type",
+              "instance_type",
+              default="m3.2xlarge",
+              show_default=True,
+              required=False,
+              help="EC2 Instance Type used to bake the image")
+@click.option("--security-group",
+              "security_group_name",
+              default="dask-ec2-default",
+              show_default=True,
+              required=False,
+              help="Security Group Name")
+@click.option("--security-group-id",
+              "security_group_id",
+              default=None,
+              show_default=True,
+              required=False,
+              help="Security Group ID (overwrites Security Group Name)")
+@click.option("--volume-type",
+              default="gp2",
+              show_default=True,
+              required=False,
+              help="Root volume type")
+@click.option("--volume-size",
+              default=50,
+              show_default=True,
+              required=False,
+              help="Root volume size (GB), clusters launched from the image need at least this size")
+@click.option("--image-name",
+              default=None,
+              required=False,
+              help="Name of the new AMI, by default based on the formulas hash")
+@click.option("--force/--no-force",
+              is_flag=True,
+              default=False,
+              show_default=True,
+              help="Bake a new image even if there is one for the current formulas")
+def bake(ctx, keyname, keypair, region_name, vpc_id, subnet_id, iaminstance_name, ami, username, instance_type,
+         security_group_name, security_group_id, volume_type, volume_size, image_name, force):
+    """Provision one instance with the conda and dask.distributed formulas
+    and create an AMI from it
+
+    The AMI is recorded in ~/.dask-ec2/images.yaml keyed by region, base
+    AMI, Python version, username and a hash of the formulas. `dask-ec2 up`
+    uses it for the same base AMI and skips the installation states.
+    """
+    import shutil
+    import tempfile
+    from ..ec2 import EC2
+    from ..images import ImageRegistry, DEFAULT_PYVERSION, BAKED_ROLES, formulas_hash, image_key
+    from ..salt import bake_cleanup
+
+    registry = ImageRegistry()
+    formulas = formulas_hash()
+    key = image_key(region_name, ami, DEFAULT_PYVERSION, username, formulas)
+
+    driver = EC2(region=region_name,
+                 vpc_id=vpc_id,
+                 subnet_id=subnet_id,
+                 default_vpc=not (vpc_id),
+                 default_subnet=not (subnet_id),
+                 iaminstance_name=iaminstance_name,
+                 cache_ttl=(ctx.obj or {}).get("ec2_cache_ttl"))
+    entry = registry.get(key)
+    if entry and not force and driver.image_exists(entry["image_id"]):
+        click.echo("Image {} is up to date with the formulas, use --force to bake a new one".format(
+            entry["image_id"]))
+        return
+
+    click.echo("Launching instance to bake the image")
+    instances = driver.launch(name="dask-ec2-bake",
+                              image_id=ami,
+                              instance_type=instance_type,
+                              count=1,
+                              keyname=keyname,
+                              security_group_name=security_group_name,
+                              security_group_id=security_group_id,
+                              volume_type=volume_type,
+                              volume_size=volume_size,
+                              keypair=keypair)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(tmpdir, "cluster.yaml")
+        cluster = Cluster.from_boto3_instances(region_name, instances)
+        cluster.set_username(username)
+        cluster.set_keypair(keypair)
+        cluster.to_file(filepath)
+
+        ctx.invoke(provision, filepath=filepath, anaconda_=False, dask=False, notebook=False)
+        cluster = Cluster.from_filepath(filepath)
+        cluster.salt_call("*", "grains.setval", ["roles", BAKED_ROLES])
+        click.echo("Installing {}".format(", ".join(BAKED_ROLES)))
+        output = apply_state(ctx, cluster, "*", None)
+        response = print_state(output)
+        if not response.aggregated_success():
+            sys.exit(1)
+
+        click.echo("Cleaning up and creating the image")
+        bake_cleanup(cluster)
+        image_name = image_name or "dask-ec2-py{}-{}-{}".format(DEFAULT_PYVERSION, formulas[:8], int(time.time()))
+        image_id = driver.create_image(instances[0].id, image_name,
+                                       description="dask-ec2 image baked from {}".format(ami))
+        registry.add(key, image_id, name=image_name, region=region_name, base_image_id=ami,
+                     pyversion=DEFAULT_PYVERSION, username=username, formulas=formulas)
+        click.echo("Image {} created and saved to {}".format(image_id, registry.filepath))
+    finally:
+        click.echo("Terminating the instance used to bake the image")
+        driver.destroy([instance.id for instance in instances])
+        shutil.rmtree(tmpdir)
 
 
 @cli.command(short_help="Provision anaconda")
@@ -356,14 +1003,125 @@ def provision(ctx, filepath, ssh_check, master, minions, upload, anaconda_, dask
               show_default=True,
               required=False,
               help="Filepath to the instances metadata")
-def anaconda(ctx, filepath):
+@click.option("--batch-size",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this many nodes at a time")
+@click.option("--batch-percent",
+              default=None,
+              type=int,
+              required=False,
+              help="Apply the salt states to this percentage of the nodes at a time")
+def anaconda(ctx, filepath, batch_size, batch_percent):
     cluster = Cluster.from_filepath(filepath)
-    output = cluster.salt_call("*", "state.sls", ["conda"])
+    output = apply_state(ctx, cluster, "*", "conda", batch_size=batch_size, batch_percent=batch_percent)
     response = print_state(output)
     if not response.aggregated_success():
         sys.exit(1)
 
 
+def state_command(sls):
+    """Salt module and arguments to apply ``sls``, ``None`` for the highstate
+    """
+    if sls is None:
+        return "state.highstate", []
+    return "state.sls", [sls]
+
+
+def state_progress(start):
+    """Callback for ``Cluster.salt_call_async`` that prints every minion as it returns
+    """
+    def __progress(minion_id, result):
+        summary = Response({minion_id: result}).aggregate_by(field="result")[minion_id]
+        click.echo("  {}: {} successful, {} failed ({:.1f}s)".format(
+            minion_id, len(summary["successful"]), len(summary["failed"]), time.time() - start))
+    return __progress
+
+
+def state_timeout(ctx, e):
+    """Print the partial output of a salt job that exceeded the deadline and exit
+    """
+    print_state(e.output)
+    click.echo("ERROR: Salt job {} didn't finish in {}s. Minions that didn't return: {}".format(
+        e.jid, (ctx.obj or {}).get("deadline"), ", ".join(sorted(e.missing))), err=True)
+    sys.exit(1)
+
+
+def apply_state(ctx, cluster, target, sls, batch_size=None, batch_percent=None):
+    """Run ``state.sls`` as a salt job printing each minion as it returns
+
+    If ``sls`` is None the highstate is applied instead.
+
+    Poll interval and deadline are taken from the global CLI options. If the
+    deadline is exceeded the partial results and the minions that didn't
+    return are printed and the command exits.
+
+    With ``batch_size`` or ``batch_percent`` the matched minions are
+    rolled out in batches of that size, one after the other, and the wall
+    time of every batch is printed.
+    """
+    if not (batch_size or batch_percent):
+        return apply_states(ctx, cluster, [(target, sls)])
+
+    options = ctx.obj or {}
+    start = time.time()
+    output = {}
+    try:
+        batches = cluster.get_batches(target, size=batch_size, percent=batch_percent)
+        for i, batch in enumerate(batches, 1):
+            click.echo("Batch {}/{}: {}".format(i, len(batches), ", ".join(batch)))
+            batch_start = time.time()
+            try:
+                ret = cluster.salt_call_async(batch, *state_command(sls),
+                                              poll_interval=options.get("poll_interval", DEFAULT_POLL_INTERVAL),
+                                              deadline=options.get("deadline"),
+                                              callback=state_progress(start),
+                                              expr_form="list")
+            except SaltTimeoutException as e:
+                e.output["return"][0].update(output)
+                raise
+            output.update(ret["return"][0])
+            click.echo("Batch {}/{} finished in {:.1f}s".format(i, len(batches), time.time() - batch_start))
+    except SaltTimeoutException as e:
+        state_timeout(ctx, e)
+
+    output = {"return": [output]}
+    print_profile(ctx, target, sls, output, time.time() - start)
+    return output
+
+
+def apply_states(ctx, cluster, states):
+    """Run independent ``state.sls`` on different targets at the same time
+
+    The jobs are started, and their results polled, in the same salt-api
+    requests. See ``apply_state``.
+
+    Parameters
+    ----------
+    states : list of ``(target, sls)``
+
+    Returns
+    -------
+        Output of all the jobs merged
+    """
+    options = ctx.obj or {}
+    start = time.time()
+    try:
+        outputs = cluster.salt_jobs([(target, ) + state_command(sls) for target, sls in states],
+                                    poll_interval=options.get("poll_interval", DEFAULT_POLL_INTERVAL),
+                                    deadline=options.get("deadline"),
+                                    callback=state_progress(start))
+    except SaltTimeoutException as e:
+        state_timeout(ctx, e)
+
+    merged = {}
+    for (target, sls), output in zip(states, outputs):
+        print_profile(ctx, target, sls, output, time.time() - start)
+        merged.update(output["return"][0])
+    return {"return": [merged]}
+
+
 def print_state(output):
     response = Response.from_dict(output)
     response = response.aggregate_by(field="result")
@@ -382,5 +1140,39 @@ def print_state(output):
     return response
 
 
+def print_profile(ctx, target, sls, output, seconds):
+    """Print the slowest states of a ``state.sls`` run and append the
+    timings to the ``--profile-file``, if given
+    """
+    profile = StateProfile(Response.from_dict(output))
+    if not len(profile):
+        return profile
+
+    click.echo("Slowest state per node")
+    data = [["Node ID", "State", "Seconds"]]
+    for node_id, records in sorted(profile.slowest(n=1).items()):
+        data.extend([node_id, r["state"], "{:.1f}".format(r["seconds"])] for r in records)
+    Table(data, 1).write()
+
+    click.echo("Time per state ({:.1f}s wall time)".format(seconds))
+    data = [["State", "# Nodes", "Total", "p50", "p95", "Max"]]
+    for s in profile.by_state():
+        data.append([s["state"], s["nodes"]] + ["{:.1f}".format(s[k]) for k in ("total", "p50", "p95", "max")])
+    Table(data, 1).write()
+
+    filepath = (ctx.obj or {}).get("profile_file")
+    if filepath:
+        runs = []
+        if os.path.exists(filepath):
+            with open(filepath, "r") as f:
+                runs = json.load(f)
+        run = profile.to_dict()
+        run.update({"sls": sls or "highstate", "target": target, "time": time.time(), "seconds": seconds})
+        runs.append(run)
+        with open(filepath, "w") as f:
+            json.dump(runs, f, indent=2)
+    return profile
+
+
 from .daskd import *  # noqa
 from .notebook import *  # noqa
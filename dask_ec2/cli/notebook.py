@@ -2,10 +2,16 @@ import sys
 
 import click
 
-from .main import cli, print_state
+from .main import cli, apply_state, print_state
 from ..cluster import Cluster
 from ..salt import upload_pillar
 
+JUPYTER_PASSWORD = "jupyter"
+
+
+def upload_jupyter_pillar(cluster, password):
+    upload_pillar(cluster, "jupyter.sls", {"jupyter": {"password": password}})
+
 
 @cli.group('notebook', invoke_without_command=True, short_help='Provision the Jupyter notebook')
 @click.pass_context
@@ -31,16 +37,20 @@ def notebook(ctx, filepath):
               show_default=True,
               required=False,
               help="Filepath to the instances metadata")
-@click.option("--password", default="jupyter", show_default=True, required=False, help="Password for Jupyter Notebook")
+@click.option("--password",
+              default=JUPYTER_PASSWORD,
+              show_default=True,
+              required=False,
+              help="Password for Jupyter Notebook")
 @click.pass_context
 def notebook_install(ctx, filepath, password):
     click.echo("Installing Jupyter notebook on the head node")
     cluster = Cluster.from_filepath(filepath)
 
-    upload_pillar(cluster, "jupyter.sls", {"jupyter": {"password": password}})
+    upload_jupyter_pillar(cluster, password)
 
     # only install on head node
-    output = cluster.salt_call("node-0", "state.sls", ["jupyter.notebook"])
+    output = apply_state(ctx, cluster, "node-0", "jupyter.notebook")
 
     response = print_state(output)
     if not response.aggregated_success():
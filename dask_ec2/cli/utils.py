@@ -1,3 +1,6 @@
+import click
+
+
 class Table():
 
     def __init__(self, data, tabletype=0):
@@ -80,3 +83,23 @@ class Table():
                 print(border)
                 print(self.formatRow(r, columns, maxColLengths))
             print(border)
+
+
+class AutoInt(click.ParamType):
+    """Positive integer or ``auto``
+    """
+    name = "integer|auto"
+
+    def convert(self, value, param, ctx):
+        if value == "auto":
+            return value
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            self.fail("{} is not a positive integer or 'auto'".format(value), param, ctx)
+        if value < 1:
+            self.fail("{} is not a positive integer or 'auto'".format(value), param, ctx)
+        return value
+
+
+AUTO_INT = AutoInt()
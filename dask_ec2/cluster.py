@@ -1,24 +1,105 @@
 from __future__ import print_function, division, absolute_import
 
+import os
+import math
+import time
+import fnmatch
 import logging
+from collections import OrderedDict
 
 import yaml
 from . import libpepper
 
-from .exceptions import DaskEc2Exception
+from .exceptions import DaskEc2Exception, SaltTimeoutException
+from .executor import ParallelExecutor, DEFAULT_PARALLELISM
 from .instance import Instance
+from .ssh import get_pool
 
 from six.moves.urllib.error import URLError
 
 logger = logging.getLogger(__name__)
 
+# Cached salt-api tokens are not used if they expire in less than this (seconds)
+TOKEN_EXPIRE_MARGIN = 60
+
+# Seconds between polls of the status of an asynchronous salt job
+DEFAULT_POLL_INTERVAL = 5
+
+# Seconds between checks that the minions that didn't return are still running the job
+DEFAULT_FIND_JOB_INTERVAL = 30
+
+# Result of a minion that stopped running a job without returning, as the salt CLI prints it
+MINION_DID_NOT_RETURN = "Minion did not return. [No response]"
+
+
+class SaltBatch(object):
+    """Salt commands queued to be sent to salt-api in a single request
+
+    Example
+    -------
+    >>> batch = cluster.salt_batch()
+    >>> scheduler = batch.local("node-0", "grains.append", ["roles", "dask.distributed.scheduler"])
+    >>> workers = batch.local("node-[1-9]*", "grains.append", ["roles", "dask.distributed.worker"])
+    >>> outputs = batch.send()
+    >>> outputs[scheduler]
+    {'return': [{'node-0': ...}]}
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.chunks = []
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, client, fun, target=None, args=None, expr_form=None, **kwargs):
+        """Queue a lowstate chunk and return its index in the outputs of ``send``
+        """
+        self.chunks.append(libpepper.Pepper.make_low(client, fun, tgt=target, arg=args, expr_form=expr_form,
+                                                     **kwargs))
+        return len(self.chunks) - 1
+
+    def local(self, target, module, args=None, expr_form='glob'):
+        return self.add('local', module, target, args, expr_form)
+
+    def local_async(self, target, module, args=None, expr_form='glob'):
+        return self.add('local_async', module, target, args, expr_form)
+
+    def runner(self, fun, **kwargs):
+        return self.add('runner', fun, **kwargs)
+
+    def send(self):
+        """Send all the queued commands in one request
+
+        Returns
+        -------
+            List with the output of every command, in the same format as
+            ``Cluster.salt_call``, in the order they were queued
+        """
+        if not self.chunks:
+            return []
+        chunks, self.chunks = self.chunks, []
+        response = self.cluster.salt_request(lambda pepper: pepper.low(chunks))
+        returns = response["return"]
+        if len(returns) != len(chunks):
+            raise DaskEc2Exception("salt-api returned %i results for %i commands" % (len(returns), len(chunks)))
+        return [{"return": [ret]} for ret in returns]
+
 
 class Cluster(object):
 
-    def __init__(self, region, instances=None):
+    def __init__(self, region, instances=None, parallelism=DEFAULT_PARALLELISM, node_timeout=None,
+                 node_deadline=None):
         self._pepper = None
         self.region = region
         self.instances = instances or []
+        self.parallelism = parallelism
+        # Seconds a node, and all of them, can take in a parallel operation, see ``ParallelExecutor``
+        self.node_timeout = node_timeout
+        self.node_deadline = node_deadline
+        self.filepath = None
+        # Volume settings the nodes were launched with: ``{'head': {...}, 'worker': {...}}``
+        self.storage = {}
 
     @classmethod
     def from_boto3_instances(cls, region, instances):
@@ -31,8 +112,10 @@ class Cluster(object):
     @classmethod
     def from_filepath(cls, filepath):
         with open(filepath, 'r') as f:
-            data = yaml.load(f.read())
-            return cls.from_dict(data)
+            data = yaml.safe_load(f.read())
+            self = cls.from_dict(data)
+            self.filepath = filepath
+            return self
 
     @classmethod
     def from_dict(cls, data):
@@ -40,6 +123,7 @@ class Cluster(object):
         instances = data["instances"]
         for instance in instances:
             self.instances.append(Instance.from_dict(instance))
+        self.storage = data.get("storage") or {}
         return self
 
     def get_head(self):
@@ -52,20 +136,321 @@ class Cluster(object):
             url = 'https://{}:8000'.format(self.instances[0].ip)
             try:
                 self._pepper = libpepper.Pepper(url, ignore_ssl_errors=True)
-                self._pepper.login('saltdev', 'saltdev', 'pam')
+                auth = self.load_token()
+                if auth:
+                    logger.debug("Using cached salt-api token")
+                    self._pepper.auth = auth
+                else:
+                    self.login()
             except URLError:
                 raise DaskEc2Exception("Could not connect to salt server. Try `dask-ec2 provision` and try again")
         return self._pepper
 
     pepper = property(get_pepper_client, None, None)
 
-    def salt_call(self, target, module, args=None):
-        args = [] or args
+    def login(self):
+        """Login into salt-api and cache the token next to the cluster file
+        """
+        auth = self._pepper.login('saltdev', 'saltdev', 'pam')
+        self.save_token(auth)
+        return auth
+
+    def get_sidecar_filepath(self, extension):
+        """Path of a hidden file next to the cluster file, None if the cluster wasn't loaded from a file
+        """
+        if self.filepath is None:
+            return None
+        dirname, basename = os.path.split(os.path.abspath(self.filepath))
+        return os.path.join(dirname, ".{}.{}".format(basename, extension))
+
+    def get_token_filepath(self):
+        """Path of the salt-api token cache, None if the cluster wasn't loaded from a file
+        """
+        return self.get_sidecar_filepath("token")
+
+    token_filepath = property(get_token_filepath, None, None)
+
+    def record_timing(self, key, seconds):
+        """Save the wall time of an operation next to the cluster file
+
+        Returns
+        -------
+            Dict of all the recorded ``key: {'seconds', 'time'}``
+        """
+        filepath = self.get_sidecar_filepath("timings")
+        timings = {}
+        if filepath is None:
+            return timings
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r') as f:
+                    timings = yaml.safe_load(f.read()) or {}
+            except (IOError, yaml.YAMLError):
+                logger.debug("Ignoring invalid timings file %s", filepath)
+        timings[key] = {"seconds": float(seconds), "time": time.time()}
+        with open(filepath, 'w') as f:
+            yaml.safe_dump(timings, f, default_flow_style=False)
+        return timings
+
+    def load_token(self):
+        """Return the cached salt-api token for the head node if it hasn't expired
+        """
+        filepath = self.token_filepath
+        if filepath is None or not os.path.exists(filepath):
+            return None
+        try:
+            with open(filepath, 'r') as f:
+                tokens = yaml.safe_load(f.read()) or {}
+        except (IOError, yaml.YAMLError):
+            logger.debug("Ignoring invalid salt-api token cache %s", filepath)
+            return None
+        auth = tokens.get(self.head.ip)
+        if not auth or auth.get('expire', 0) < time.time() + TOKEN_EXPIRE_MARGIN:
+            return None
+        return auth
+
+    def save_token(self, auth):
+        filepath = self.token_filepath
+        if filepath is None or not auth:
+            return
+        tokens = {}
+        if os.path.exists(filepath):
+            try:
+                with open(filepath, 'r') as f:
+                    tokens = yaml.safe_load(f.read()) or {}
+            except (IOError, yaml.YAMLError):
+                pass
+        tokens[self.head.ip] = auth
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            yaml.safe_dump(tokens, f, default_flow_style=False)
+
+    def salt_request(self, function):
+        """Call ``function(pepper)`` logging in again if the salt-api token was rejected
+        """
         try:
-            return self.pepper.local(target, module, args)
+            try:
+                return function(self.pepper)
+            except libpepper.PepperException as e:
+                if str(e) != 'Authentication denied':
+                    raise
+                logger.debug("salt-api token was rejected, login again")
+                self.login()
+                return function(self.pepper)
         except URLError:
             raise DaskEc2Exception("Could not connect to salt server. Try `dask-ec2 provision` and try again")
 
+    def salt_call(self, target, module, args=None):
+        args = args or []
+        return self.salt_request(lambda pepper: pepper.local(target, module, args))
+
+    def salt_batch(self):
+        """Return a ``SaltBatch`` to send several salt commands in one request
+        """
+        return SaltBatch(self)
+
+    def salt_call_async(self, target, module, args=None, poll_interval=DEFAULT_POLL_INTERVAL, deadline=None,
+                        callback=None, expr_form='glob'):
+        """Run a salt command as a job and poll for its results
+
+        Unlike ``salt_call`` no HTTP request is held open while the command
+        runs, the job is started with the ``local_async`` client and its
+        results are polled with ``jobs.lookup_jid``.
+
+        Parameters
+        ----------
+        poll_interval : float
+            Seconds between polls
+        deadline : float, optional
+            Seconds to wait for all the minions to return
+        callback : callable, optional
+            Called as ``callback(minion_id, result)`` as soon as each minion
+            returns
+        expr_form : str
+            How to match the target, e.g. ``glob`` or ``list``
+
+        Returns
+        -------
+            Output in the same format as ``salt_call``
+
+        Raises
+        ------
+            SaltTimeoutException with the partial output and the minions that
+            didn't return if the deadline is exceeded
+        """
+        commands = [(target, module, args or [], expr_form)]
+        return self.salt_jobs(commands, poll_interval=poll_interval, deadline=deadline, callback=callback)[0]
+
+    def salt_jobs(self, commands, poll_interval=DEFAULT_POLL_INTERVAL, deadline=None, callback=None,
+                  find_job_interval=DEFAULT_FIND_JOB_INTERVAL):
+        """Run independent salt commands as jobs started in the same request
+
+        The results of all the jobs are also polled together, one request per
+        ``poll_interval``. See ``salt_call_async`` for the parameters.
+
+        Like the salt CLI, every ``find_job_interval`` seconds the minions
+        that didn't return are asked with ``saltutil.find_job`` if they are
+        still running the job. Minions that are not running it (or don't
+        answer, e.g. they are offline) in two consecutive checks get a
+        ``MINION_DID_NOT_RETURN`` result, so the jobs finish without a deadline.
+
+        Parameters
+        ----------
+        commands : list
+            ``(target, module, args)`` or ``(target, module, args, expr_form)``
+        find_job_interval : float, optional
+            Seconds between checks of the running jobs, None to disable
+
+        Returns
+        -------
+            List with the output of every command in the order they were given
+
+        Raises
+        ------
+            SaltTimeoutException with the jid of the first unfinished job, the
+            merged partial output and the minions that didn't return
+        """
+        batch = self.salt_batch()
+        for command in commands:
+            target, module, args = command[:3]
+            expr_form = command[3] if len(command) > 3 else 'glob'
+            batch.local_async(target, module, args, expr_form=expr_form)
+
+        jobs = []
+        for command, output in zip(commands, batch.send()):
+            job = output["return"][0] or {}
+            if "jid" not in job:
+                # Same as the output of ``salt_call`` when the target doesn't match
+                logger.debug("No minions matched the target '%s'", command[0])
+                job = {"jid": None, "minions": []}
+            logger.debug("Started salt job %s on %i minions", job["jid"], len(job.get("minions", [])))
+            jobs.append((job["jid"], job.get("minions", []), OrderedDict()))
+
+        start = last_check = time.time()
+        not_running = {}
+        while True:
+            pending = [job for job in jobs if any(minion_id not in job[2] for minion_id in job[1])]
+            for jid, _, _ in pending:
+                batch.runner('jobs.lookup_jid', jid='{0}'.format(jid))
+            for (jid, _, results), output in zip(pending, batch.send()):
+                data = output["return"][0] or {}
+                if "outputter" in data and "data" in data:
+                    data = data["data"]
+                for minion_id, result in data.items():
+                    if minion_id not in results:
+                        results[minion_id] = result
+                        if callback is not None:
+                            callback(minion_id, result)
+
+            pending = [job for job in pending if any(minion_id not in job[2] for minion_id in job[1])]
+            if pending and find_job_interval is not None and time.time() - last_check >= find_job_interval:
+                last_check = time.time()
+                self._find_jobs(batch, pending, not_running, callback)
+                pending = [job for job in pending if any(minion_id not in job[2] for minion_id in job[1])]
+            if not pending:
+                return [{"return": [dict(results)]} for _, _, results in jobs]
+            if deadline is not None and time.time() - start > deadline:
+                missing, results = [], {}
+                for _, minions, job_results in jobs:
+                    missing.extend(minion_id for minion_id in minions if minion_id not in job_results)
+                    results.update(job_results)
+                raise SaltTimeoutException(pending[0][0], missing, {"return": [results]})
+            time.sleep(poll_interval)
+
+    def _find_jobs(self, batch, pending, not_running, callback=None):
+        """Mark the minions that are no longer running their job as not returned
+
+        ``not_running`` counts the consecutive checks a ``(jid, minion_id)``
+        was not running the job, one check is not enough as the minion could
+        have returned after the last lookup.
+        """
+        for jid, minions, results in pending:
+            missing = [minion_id for minion_id in minions if minion_id not in results]
+            batch.local(missing, "saltutil.find_job", [jid], expr_form="list")
+        for (jid, minions, results), output in zip(pending, batch.send()):
+            running = output["return"][0] or {}
+            for minion_id in minions:
+                if minion_id in results:
+                    continue
+                if running.get(minion_id):
+                    not_running.pop((jid, minion_id), None)
+                    continue
+                not_running[(jid, minion_id)] = not_running.get((jid, minion_id), 0) + 1
+                if not_running[(jid, minion_id)] >= 2:
+                    logger.debug("Minion %s is not running job %s and didn't return", minion_id, jid)
+                    results[minion_id] = MINION_DID_NOT_RETURN
+                    if callback is not None:
+                        callback(minion_id, MINION_DID_NOT_RETURN)
+
+    def wait_for_minions(self, timeout=120, poll_interval=2):
+        """Wait until every node answers ``test.ping`` through the salt master
+
+        Raises
+        ------
+            DaskEc2Exception with the minions that didn't answer after ``timeout`` seconds
+        """
+        expected = self.get_minion_ids()
+        start = time.time()
+        while True:
+            answered = self.salt_call("*", "test.ping")["return"][0] or {}
+            missing = [minion_id for minion_id in expected if answered.get(minion_id) is not True]
+            if not missing:
+                return time.time() - start
+            if time.time() - start > timeout:
+                raise DaskEc2Exception("Minions didn't connect to the salt master: %s" % ", ".join(missing))
+            logger.debug("Waiting for minions to connect: %s", ", ".join(missing))
+            time.sleep(poll_interval)
+
+    def get_minion_ids(self, target="*"):
+        """IDs of the salt minions matched by a glob target
+
+        Minion IDs are assigned by position, ``node-0`` is the head node.
+        """
+        minion_ids = ["node-{}".format(i) for i in range(len(self.instances))]
+        return [minion_id for minion_id in minion_ids if fnmatch.fnmatchcase(minion_id, target)]
+
+    def get_batches(self, target="*", size=None, percent=None):
+        """Split the minions matched by target in batches
+
+        Batches have ``size`` minions or ``percent`` % of the matched minions
+        (at least one), a single batch is returned if neither is given.
+        """
+        if size and percent:
+            raise DaskEc2Exception("Only one of batch size or batch percent can be used")
+        minion_ids = self.get_minion_ids(target)
+        if size is None and percent is not None:
+            size = int(math.ceil(len(minion_ids) * percent / 100.0))
+        if not size:
+            return [minion_ids]
+        size = max(1, size)
+        return [minion_ids[i:i + size] for i in range(0, len(minion_ids), size)]
+
+    def classify_addresses(self, addresses):
+        """Match the addresses workers registered with to the nodes
+
+        Parameters
+        ----------
+        addresses : list of str
+            As reported by the scheduler, e.g. ``tcp://10.0.0.5:40123``
+
+        Returns
+        -------
+            List of ``(address, node index or None, network)`` where network is
+            ``'private'``, ``'public'`` or ``'unknown'``
+        """
+        private = dict((instance.private_ip, i) for i, instance in enumerate(self.instances) if instance.private_ip)
+        public = dict((instance.ip, i) for i, instance in enumerate(self.instances) if instance.ip)
+        ret = []
+        for address in addresses:
+            host = address.split("://")[-1].rsplit(":", 1)[0]
+            if host in private:
+                ret.append((address, private[host], "private"))
+            elif host in public:
+                ret.append((address, public[host], "public"))
+            else:
+                ret.append((address, None, "unknown"))
+        return ret
+
     def append(self, instance):
         if isinstance(instance, Instance):
             self.instances.append(instance)
@@ -80,12 +465,36 @@ class Cluster(object):
         for instance in self.instances:
             instance.keypair = keypair_path
 
-    def check_ssh(self):
-        ret = {}
-        for instance in self.instances:
-            address = "{}:{}".format(instance.ip, instance.port)
-            ret[address] = instance.check_ssh()
-        return ret
+    def executor(self, **kwargs):
+        """Return a ParallelExecutor limited to the cluster parallelism
+
+        Nodes that take longer than ``node_timeout``, or are not done after
+        ``node_deadline``, are reported as failed instead of blocking the
+        operation. The SSH pool is sized so the clients of the nodes being
+        worked on are not closed to make room for the others.
+        """
+        kwargs.setdefault("parallelism", self.parallelism)
+        kwargs.setdefault("timeout", self.node_timeout)
+        kwargs.setdefault("deadline", self.node_deadline)
+        get_pool(max_connections=kwargs["parallelism"])
+        return ParallelExecutor(**kwargs)
+
+    def check_ssh(self, timeout=300):
+        return dict((address, True) for address in self.wait_for_ssh(timeout=timeout))
+
+    def wait_for_ssh(self, timeout=300):
+        """Wait in parallel until all the nodes accept SSH connections
+
+        Returns
+        -------
+            OrderedDict of ``ip:port`` to the seconds the node took to be ready
+        """
+        results = self.executor().map(lambda instance: instance.wait_for_ssh(timeout=timeout), self.instances,
+                                      key=lambda instance: "{}:{}".format(instance.ip, instance.port))
+        failed = [address for address, result in results.items() if not result.success]
+        if failed:
+            raise DaskEc2Exception("Couldn't connect via SSH to nodes: %s" % ", ".join(failed))
+        return OrderedDict((address, result.output) for address, result in results.items())
 
     def to_dict(self):
         ret = {}
@@ -93,6 +502,8 @@ class Cluster(object):
         ret["instances"] = []
         for instance in self.instances:
             ret["instances"].append(instance.to_dict())
+        if self.storage:
+            ret["storage"] = self.storage
         return ret
 
     def to_file(self, filepath):
@@ -1,35 +1,179 @@
 from __future__ import print_function, division, absolute_import
 
+import os
 import time
+import hashlib
 import logging
 
+import yaml
 import boto3
 from botocore.exceptions import ClientError, WaiterError
 
 from dask_ec2.exceptions import DaskEc2Exception
+from dask_ec2.executor import ParallelExecutor
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_SG_GROUP_NAME = "dask-ec2-default"
 
+DEFAULT_CACHE_FILEPATH = os.path.join(os.path.expanduser("~"), ".dask-ec2", "ec2-cache.yaml")
+
+PLACEMENT_STRATEGIES = ["cluster", "partition", "spread"]
+
+# Maximum number of concurrent create_tags calls of ``EC2.tag_names``
+TAG_PARALLELISM = 16
+
+# EBS volume types that accept provisioned IOPS and throughput
+IOPS_VOLUME_TYPES = ["gp3", "io1", "io2"]
+THROUGHPUT_VOLUME_TYPES = ["gp3"]
+
+
+def ebs_mapping(device_name, volume_type="gp2", volume_size=500, iops=None, throughput=None):
+    """``BlockDeviceMappings`` entry for an EBS volume deleted with the instance
+
+    Parameters
+    ----------
+    iops : int, optional
+        Provisioned IOPS, only for gp3, io1 and io2 (required for io1 and io2)
+    throughput : int, optional
+        Provisioned throughput in MiB/s, only for gp3
+    """
+    if iops and volume_type not in IOPS_VOLUME_TYPES:
+        raise DaskEc2Exception("Volume type '{}' doesn't support provisioned IOPS".format(volume_type))
+    if throughput and volume_type not in THROUGHPUT_VOLUME_TYPES:
+        raise DaskEc2Exception("Volume type '{}' doesn't support provisioned throughput".format(volume_type))
+    if not iops and volume_type in ("io1", "io2"):
+        raise DaskEc2Exception("Volume type '{}' requires the provisioned IOPS".format(volume_type))
+
+    ebs = {"VolumeSize": volume_size, "DeleteOnTermination": True, "VolumeType": volume_type}
+    if iops:
+        ebs["Iops"] = iops
+    if throughput:
+        ebs["Throughput"] = throughput
+    return {"DeviceName": device_name, "Ebs": ebs}
+
+
+def parse_data_volume(spec):
+    """Parse a ``SIZE[:TYPE[:IOPS[:THROUGHPUT]]]`` data volume
+
+    Returns
+    -------
+        dict with ``volume_size``, ``volume_type``, ``iops`` and ``throughput``
+    """
+    parts = spec.split(":")
+    try:
+        numbers = [int(part) if part else None for part in [parts[0]] + parts[2:]]
+    except ValueError:
+        numbers = []
+    if len(parts) > 4 or not numbers or numbers[0] is None:
+        raise DaskEc2Exception("Invalid data volume '{}', must be SIZE[:TYPE[:IOPS[:THROUGHPUT]]]".format(spec))
+    numbers += [None] * (3 - len(numbers))
+    volume_type = parts[1] if len(parts) > 1 and parts[1] else "gp3"
+    return {"volume_size": numbers[0], "volume_type": volume_type, "iops": numbers[1], "throughput": numbers[2]}
+
+
+class LookupCache(object):
+    """Memoize lookups of EC2 objects that rarely change (VPCs, subnets,
+    security groups)
+
+    Values are kept in memory for the life of the object and, if ``ttl`` is
+    given, in a YAML file shared by CLI invocations for ``ttl`` seconds.
+    Only IDs (strings) are cached.
+
+    Parameters
+    ----------
+    namespace : str
+        Prefix of the keys in the disk cache, e.g. the region and account
+    ttl : int, optional
+        Seconds the disk cache is valid, disabled if 0 or None
+    filepath : str, optional
+        Defaults to ``~/.dask-ec2/ec2-cache.yaml``
+    """
+
+    def __init__(self, namespace, ttl=None, filepath=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.filepath = filepath or DEFAULT_CACHE_FILEPATH
+        self._memory = {}
+
+    def _load(self):
+        if not os.path.exists(self.filepath):
+            return {}
+        try:
+            with open(self.filepath, "r") as f:
+                return yaml.safe_load(f.read()) or {}
+        except (IOError, yaml.YAMLError):
+            logger.debug("Ignoring invalid EC2 lookup cache %s", self.filepath)
+            return {}
+
+    def get(self, key, function):
+        """Return the cached value for key or the result of ``function()``
+
+        Empty results are not cached.
+        """
+        if key in self._memory:
+            return self._memory[key]
+
+        disk_key = "{}:{}".format(self.namespace, key)
+        if self.ttl:
+            entry = self._load().get(disk_key)
+            if entry and time.time() - entry["time"] < self.ttl:
+                logger.debug("Using cached EC2 lookup %s", key)
+                self._memory[key] = entry["value"]
+                return entry["value"]
+
+        value = function()
+        if value:
+            self._memory[key] = value
+            if self.ttl:
+                self._save(disk_key, value)
+        return value
+
+    def _save(self, disk_key, value):
+        cache = self._load()
+        now = time.time()
+        cache = dict((k, v) for k, v in cache.items() if now - v["time"] < self.ttl)
+        cache[disk_key] = {"value": value, "time": now}
+        dirname = os.path.dirname(self.filepath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.filepath, "w") as f:
+            yaml.safe_dump(cache, f, default_flow_style=False)
+
+    def invalidate(self, key):
+        self._memory.pop(key, None)
+        if self.ttl:
+            cache = self._load()
+            if cache.pop("{}:{}".format(self.namespace, key), None) is not None:
+                with open(self.filepath, "w") as f:
+                    yaml.safe_dump(cache, f, default_flow_style=False)
+
 
 class EC2(object):
 
     def __init__(self, region, vpc_id=None, subnet_id=None, default_vpc=True,
                  default_subnet=True, iaminstance_name=None,
-                 test=True):
+                 test=True, cache_ttl=None, cache_filepath=None):
 
         self.ec2 = boto3.resource("ec2", region_name=region)
         self.client = boto3.client("ec2", region_name=region)
+        self.cache = LookupCache(self._cache_namespace(region), ttl=cache_ttl, filepath=cache_filepath)
 
         self.vpc_id = self.get_default_vpc() if default_vpc else vpc_id
         self.subnet_id = self.get_default_subnet() if default_subnet else subnet_id
         self.iaminstance_name = iaminstance_name
 
         if test:
-            filters = [{"Name": "instance-state-name", "Values": ["running"]}]
-            collection = self.ec2.instances.filter(Filters=filters)
-            list(collection)
+            # Checks the credentials without listing all the instances
+            self.client.describe_instances(MaxResults=5)
+
+    @staticmethod
+    def _cache_namespace(region):
+        """Region and a hash of the access key, so accounts don't share cache entries
+        """
+        credentials = boto3.Session().get_credentials()
+        access_key = credentials.access_key if credentials is not None else ""
+        return "{}/{}".format(region, hashlib.sha1(access_key.encode("utf-8")).hexdigest()[:12])
 
     def get_default_vpc(self):
         """
@@ -40,10 +184,15 @@ class EC2(object):
             If there is not a default VPC
         """
         logger.debug("Searching for default VPC")
-        for vpc in self.ec2.vpcs.all():
-            if vpc.is_default:
-                logger.debug("Default VPC found - Using VPC ID: %s", vpc.id)
-                return vpc.id
+
+        def __lookup():
+            filters = [{"Name": "isDefault", "Values": ["true"]}]
+            return [vpc.id for vpc in self.ec2.vpcs.filter(Filters=filters)]
+
+        vpcs = self.cache.get("default-vpc", __lookup)
+        if vpcs:
+            logger.debug("Default VPC found - Using VPC ID: %s", vpcs[0])
+            return vpcs[0]
         raise DaskEc2Exception("There is no default VPC, please pass VPC ID")
 
     def get_default_subnet(self, availability_zone=None):
@@ -54,19 +203,21 @@ class EC2(object):
         ------
             If there is not a default subnet on the VPC
         """
-        logger.debug("Searching for default subnet in VPC %s", self.vpc_id)
-        for vpc in self.ec2.vpcs.all():
-            if vpc.id == self.vpc_id:
-                for subnet in vpc.subnets.all():
-                    if availability_zone is None and subnet.default_for_az:
-                        logger.debug("Default subnet found - Using Subnet ID: %s", subnet.id)
-                        return subnet.id
-                    else:
-                        if subnet.availability_zone == availability_zone and subnet.default_for_az:
-                            logger.debug("Default subnet found - Using Subnet ID: %s", subnet.id)
-                            return subnet.id
         if not self.vpc_id:
             raise DaskEc2Exception("There is no VPC, please pass VPC ID or assign a default VPC")
+        logger.debug("Searching for default subnet in VPC %s", self.vpc_id)
+
+        def __lookup():
+            filters = [{"Name": "vpc-id", "Values": [self.vpc_id]},
+                       {"Name": "default-for-az", "Values": ["true"]}]
+            if availability_zone is not None:
+                filters.append({"Name": "availability-zone", "Values": [availability_zone]})
+            return [subnet.id for subnet in self.ec2.subnets.filter(Filters=filters)]
+
+        subnets = self.cache.get("default-subnet/{}/{}".format(self.vpc_id, availability_zone), __lookup)
+        if subnets:
+            logger.debug("Default subnet found - Using Subnet ID: %s", subnets[0])
+            return subnets[0]
         raise DaskEc2Exception("There is no default subnet on VPC %s, please pass a subnet ID" % self.vpc_id)
 
     def check_keyname(self, keyname):
@@ -95,21 +246,25 @@ class EC2(object):
         ----------
         security_group_name : str
         """
-        logger.debug("Getting all security groups and filtering by VPC ID %s and name %s", self.vpc_id,
-                     security_group_name)
-        collection = self.ec2.security_groups.all()
-        matches = [i for i in collection]
-        if self.vpc_id is not None:
-            matches = [m for m in matches if m.vpc_id == self.vpc_id and m.group_name == security_group_name]
-        else:
-            matches = [m for m in matches if m.group_name == security_group_name]
+        matches = [self.ec2.SecurityGroup(id_) for id_ in self.get_security_groups_ids(security_group_name)]
         logger.debug("Found Security groups: %s", matches)
         return matches
 
+    def _sg_cache_key(self, security_group_name):
+        return "security-groups/{}/{}".format(self.vpc_id, security_group_name)
+
     def get_security_groups_ids(self, security_groups):
         """Get the security group ids (if exists) for the security group names in the VPC
         """
-        return [i.id for i in self.get_security_groups(security_groups)]
+        logger.debug("Getting security groups by VPC ID %s and name %s", self.vpc_id, security_groups)
+
+        def __lookup():
+            filters = [{"Name": "group-name", "Values": [security_groups]}]
+            if self.vpc_id is not None:
+                filters.append({"Name": "vpc-id", "Values": [self.vpc_id]})
+            return [sg.id for sg in self.ec2.security_groups.filter(Filters=filters)]
+
+        return self.cache.get(self._sg_cache_key(security_groups), __lookup)
 
     def check_sg(self, security_group):
         """Checks if the security groups exists in the EC2 account
@@ -150,6 +305,7 @@ class EC2(object):
                 raise e
 
         logger.debug("Setting up default values for the '%s' security group", DEFAULT_SG_GROUP_NAME)
+        self.cache.invalidate(self._sg_cache_key(DEFAULT_SG_GROUP_NAME))
         security_group = self.get_security_groups(DEFAULT_SG_GROUP_NAME)[0]
 
         IpPermissions = [{
@@ -219,29 +375,39 @@ class EC2(object):
                volume_size=500,
                keypair=None,
                tags=None,
-               check_ami=True):
-        tags = tags or []
+               check_ami=True,
+               wait=True,
+               placement_group=None,
+               instance_store=False,
+               volume_iops=None,
+               volume_throughput=None,
+               data_volumes=None,
+               first_index=0):
+        """Create instances, wait until they are running and tag them
+
+        With ``wait=False`` the instances are returned as soon as they are
+        created, see ``iter_running``. ``placement_group`` is the name of an
+        existing placement group, see ``create_placement_group``. With
+        ``instance_store`` the instance store volumes of the type are attached,
+        see ``get_instance_store_mappings``.
+
+        ``volume_iops`` and ``volume_throughput`` apply to the root volume,
+        ``data_volumes`` are extra EBS volumes (see ``parse_data_volume``)
+        attached from ``/dev/sdf`` on. Instances are named from
+        ``<name>-<first_index>``.
+        """
         self.check_keyname(keyname)
         if check_ami:
             self.check_image_is_ebs(image_id)
         self.check_sg(security_group_name)
 
-        # assumed to be formatted correctly in ec2.py
-        custom_tags = []
-        for t in tags:
-            k, v = t.split(":")
-            custom_tags.append({"Key": k, "Value": v})
-
-        device_map = [
-            {
-                "DeviceName": "/dev/sda1",
-                "Ebs": {
-                    "VolumeSize": volume_size,
-                    "DeleteOnTermination": True,
-                    "VolumeType": volume_type,
-                },
-            },
-        ]
+        device_map = [ebs_mapping("/dev/sda1", volume_type, volume_size, volume_iops, volume_throughput)]
+        if instance_store:
+            device_map.extend(self.get_instance_store_mappings(instance_type))
+        used = set(mapping["DeviceName"] for mapping in device_map)
+        free = (device for device in ("/dev/sd" + c for c in "fghijklmnopqrstuvwxyz") if device not in used)
+        for volume in data_volumes or []:
+            device_map.append(ebs_mapping(next(free), **volume))
 
         if security_group_id:
             security_groups_ids = [security_group_id]
@@ -260,11 +426,20 @@ class EC2(object):
             kwargs['SubnetId'] = self.subnet_id
         if self.iaminstance_name is not None and self.iaminstance_name != "":
             kwargs['IamInstanceProfile'] = {'Name': self.iaminstance_name}
+        if placement_group:
+            kwargs['Placement'] = {'GroupName': placement_group}
+        tag_specifications = self.get_tag_specifications(name, tags)
+        if tag_specifications:
+            kwargs['TagSpecifications'] = tag_specifications
         instances = self.ec2.create_instances(**kwargs)
+        ids = [i.id for i in instances]
+        if name:
+            self.tag_names(ids, name, first_index=first_index)
+        if not wait:
+            return instances
 
         time.sleep(5)
 
-        ids = [i.id for i in instances]
         waiter = self.client.get_waiter("instance_running")
         try:
             waiter.wait(InstanceIds=ids)
@@ -273,19 +448,83 @@ class EC2(object):
                                    "Refer to the AWS Management Console for more information.")
 
         collection = self.ec2.instances.filter(InstanceIds=ids)
-        instances = []
-        for i, instance in enumerate(collection):
-            instances.append(instance)
-            if len(custom_tags) > 0:
-                for v in instance.volumes.all():
-                    v.create_tags(DryRun=False, Tags=custom_tags)
-            if name:
-                logger.debug("Tagging instance '%s'", instance.id)
-                tags_ = [{"Key": "Name", "Value": "{0}-{1}".format(name, i)}]
-                tags_.extend(custom_tags)
-                self.ec2.create_tags(Resources=[instance.id], Tags=tags_)
-
-        return instances
+        return sorted(collection, key=lambda instance: ids.index(instance.id))
+
+    def get_tag_specifications(self, name=None, tags=None):
+        """``TagSpecifications`` for ``create_instances``
+
+        The instances get the ``Name`` and the ``K:V`` custom tags and their
+        volumes the custom tags, all in the same call that creates them.
+        """
+        # assumed to be formatted correctly in ec2.py
+        custom_tags = []
+        for t in tags or []:
+            k, v = t.split(":")
+            custom_tags.append({"Key": k, "Value": v})
+
+        specifications = []
+        instance_tags = list(custom_tags)
+        if name:
+            instance_tags.insert(0, {"Key": "Name", "Value": name})
+        if instance_tags:
+            specifications.append({"ResourceType": "instance", "Tags": instance_tags})
+        if custom_tags:
+            specifications.append({"ResourceType": "volume", "Tags": custom_tags})
+        return specifications
+
+    def tag_names(self, ids, name, first_index=0):
+        """Tag the instances as ``<name>-<index>``, starting at ``first_index``
+
+        ``create_tags`` applies the same tags to all its resources, so unlike
+        the tags set at creation this still takes one call per instance. The
+        calls run concurrently, at most ``TAG_PARALLELISM`` at a time.
+        Instances that can't be tagged keep the ``Name`` set at creation.
+        """
+        def __tag(args):
+            index, instance_id = args
+            self.client.create_tags(Resources=[instance_id], Tags=[{"Key": "Name",
+                                                                    "Value": "{0}-{1}".format(name, index)}])
+
+        logger.debug("Tagging %i instances", len(ids))
+        # New instances are not always visible to create_tags right away
+        executor = ParallelExecutor(parallelism=TAG_PARALLELISM, retries=5, wait=1, catch=(ClientError, ))
+        results = executor.map(__tag, list(enumerate(ids, first_index)), key=lambda args: args[1])
+        failed = [instance_id for instance_id, result in results.items() if not result.success]
+        if failed:
+            logger.warning("Couldn't set the Name tag of instances: %s", ", ".join(failed))
+        return failed
+
+    def iter_running(self, ids, poll_interval=5, timeout=600):
+        """Yield the instances as soon as each of them is running
+
+        Raises
+        ------
+            DaskEc2Exception if an instance stops or terminates, or if they are
+            not running after ``timeout`` seconds
+        """
+        pending = list(ids)
+        start = time.time()
+        while pending:
+            try:
+                collection = list(self.ec2.instances.filter(InstanceIds=pending))
+            except ClientError as e:
+                # Instances can take a moment to be visible after they are created
+                if "InvalidInstanceID.NotFound" not in str(e):
+                    raise
+                collection = []
+            for instance in collection:
+                state = instance.state["Name"]
+                if state == "running":
+                    pending.remove(instance.id)
+                    yield instance
+                elif state != "pending":
+                    raise DaskEc2Exception("Instance {} is {} instead of running. Refer to the AWS "
+                                           "Management Console for more information.".format(instance.id, state))
+            if pending:
+                if time.time() - start > timeout:
+                    raise DaskEc2Exception("Instances {} were not running after {} seconds".format(
+                        ", ".join(pending), timeout))
+                time.sleep(poll_interval)
 
     def destroy(self, ids):
         """Terminate a set of EC2 instances by ID
@@ -301,3 +540,110 @@ class EC2(object):
         self.ec2.instances.filter(InstanceIds=ids).terminate()
         waiter = self.client.get_waiter("instance_terminated")
         waiter.wait(InstanceIds=ids)
+
+    def create_image(self, instance_id, name, description=None, wait=True):
+        """Create an AMI from an instance and wait until it's available
+
+        The instance is rebooted so the file system is consistent.
+
+        Returns
+        -------
+            The ID of the new image
+        """
+        logger.debug("Creating image '%s' from instance %s", name, instance_id)
+        response = self.client.create_image(InstanceId=instance_id, Name=name,
+                                            Description=description or name)
+        image_id = response["ImageId"]
+        if wait:
+            waiter = self.client.get_waiter("image_available")
+            try:
+                waiter.wait(ImageIds=[image_id], WaiterConfig={"Delay": 15, "MaxAttempts": 120})
+            except WaiterError:
+                raise DaskEc2Exception("Image {} didn't become available. "
+                                       "Refer to the AWS Management Console for more information.".format(image_id))
+        return image_id
+
+    def image_exists(self, image_id):
+        """Check that an AMI exists and is available
+        """
+        try:
+            images = self.client.describe_images(ImageIds=[image_id])["Images"]
+        except ClientError:
+            return False
+        return len(images) > 0 and images[0].get("State") == "available"
+
+    def create_placement_group(self, name, strategy="cluster", partition_count=None):
+        """Create a placement group, or reuse it if it already exists
+
+        Raises
+        ------
+            DaskEc2Exception if a group with that name exists with another strategy
+        """
+        if strategy not in PLACEMENT_STRATEGIES:
+            raise DaskEc2Exception("Placement strategy must be one of: %s" % ", ".join(PLACEMENT_STRATEGIES))
+        try:
+            groups = self.client.describe_placement_groups(GroupNames=[name])["PlacementGroups"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("InvalidPlacementGroup.Unknown", "InvalidParameterValue"):
+                raise e
+            groups = []
+
+        if groups:
+            if groups[0]["Strategy"] != strategy:
+                raise DaskEc2Exception("Placement group '{}' already exists with strategy '{}'".format(
+                    name, groups[0]["Strategy"]))
+            logger.debug("Reusing placement group '%s'", name)
+            return name
+
+        logger.debug("Creating placement group '%s' with strategy '%s'", name, strategy)
+        kwargs = dict(GroupName=name, Strategy=strategy)
+        if strategy == "partition" and partition_count:
+            kwargs["PartitionCount"] = partition_count
+        self.client.create_placement_group(**kwargs)
+        return name
+
+    def check_enhanced_networking(self, instance_type, image_id=None):
+        """Check that the instance type (and image) support ENA
+
+        Returns
+        -------
+            dict with the ``ena_support`` and ``network_performance`` of the instance type
+
+        Raises
+        ------
+            DaskEc2Exception if the instance type or the image don't support ENA
+        """
+        try:
+            types = self.client.describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"]
+        except ClientError as e:
+            raise DaskEc2Exception("Couldn't describe instance type '{}': {}".format(instance_type, e))
+        network = types[0].get("NetworkInfo", {}) if types else {}
+        info = {"ena_support": network.get("EnaSupport", "unsupported"),
+                "network_performance": network.get("NetworkPerformance", "unknown")}
+        if info["ena_support"] == "unsupported":
+            raise DaskEc2Exception("Instance type '{}' doesn't support enhanced networking (ENA)".format(instance_type))
+
+        if image_id is not None:
+            images = self.client.describe_images(ImageIds=[image_id])["Images"]
+            if images and not images[0].get("EnaSupport", False):
+                raise DaskEc2Exception("Image '{}' doesn't have ENA support enabled".format(image_id))
+        return info
+
+    def get_instance_store_mappings(self, instance_type):
+        """``BlockDeviceMappings`` for the instance store volumes of an instance type
+
+        NVMe instance store volumes of Nitro instances are always attached,
+        the volumes of older instance types are only attached if they are mapped.
+        """
+        try:
+            types = self.client.describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"]
+        except ClientError as e:
+            logger.debug("Couldn't describe instance type '%s': %s", instance_type, e)
+            return []
+        storage = types[0].get("InstanceStorageInfo", {}) if types else {}
+        count = sum(disk.get("Count", 1) for disk in storage.get("Disks", []))
+        if not count and storage.get("TotalSizeInGB"):
+            count = 1
+        # /dev/sda1 is the root volume
+        return [{"DeviceName": "/dev/sd{}".format(chr(ord("b") + i)), "VirtualName": "ephemeral{}".format(i)}
+                for i in range(min(count, 24))]
@@ -11,3 +11,12 @@ class RetriesExceededException(DaskEc2Exception):
         super(RetriesExceededException, self).__init__(message)
         self.function = function
         self.last_exception = last_exception
+
+
+class SaltTimeoutException(DaskEc2Exception):
+
+    def __init__(self, jid, missing, output, message="Salt job didn't finish before the deadline"):
+        super(SaltTimeoutException, self).__init__(message)
+        self.jid = jid
+        self.missing = missing
+        self.output = output
@@ -0,0 +1,209 @@
+"""
+Bounded parallel execution of per-node operations
+"""
+from __future__ import print_function, division, absolute_import
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from six.moves import queue
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of nodes being worked on at the same time
+DEFAULT_PARALLELISM = 32
+
+
+class TaskResult(object):
+    """Result of running a function for one item (node)
+
+    Attributes
+    ----------
+    key : hashable
+        Identifier of the item, usually the node IP
+    success : bool
+    output : object
+        Return value of the function, None if it failed
+    error : Exception or None
+        Last exception raised, or the reason the task didn't finish
+    duration : float
+        Seconds since the first attempt started
+    attempts : int
+        Number of attempts that were started
+    """
+
+    def __init__(self, key, success, output=None, error=None, duration=0.0, attempts=0):
+        self.key = key
+        self.success = success
+        self.output = output
+        self.error = error
+        self.duration = duration
+        self.attempts = attempts
+
+    def to_dict(self):
+        ret = {}
+        ret["key"] = self.key
+        ret["success"] = self.success
+        ret["output"] = self.output
+        ret["error"] = self.error
+        ret["duration"] = self.duration
+        ret["attempts"] = self.attempts
+        return ret
+
+    def __repr__(self):
+        return "TaskResult(%r, success=%r, duration=%.2f, attempts=%i)" % (
+            self.key, self.success, self.duration, self.attempts)
+
+
+class TaskTimeout(Exception):
+    pass
+
+
+class ParallelExecutor(object):
+    """Run a function over many items on a bounded number of threads
+
+    Parameters
+    ----------
+    parallelism : int
+        Maximum number of items being processed at the same time
+    timeout : float, optional
+        Seconds an item can take (including retries) before it is reported as
+        failed. The thread running it can't be killed, so it is abandoned and
+        a new thread takes its place.
+    deadline : float, optional
+        Seconds for the whole run, items not finished by then are reported as
+        failed
+    retries : int
+        Number of attempts per item
+    wait : float
+        Seconds to wait between attempts
+    catch : tuple of exceptions
+        Exceptions that trigger a retry, by default all of them
+    """
+
+    def __init__(self, parallelism=DEFAULT_PARALLELISM, timeout=None, deadline=None, retries=1, wait=0, catch=None):
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.wait = wait
+        self.catch = catch or (Exception,)
+
+    def map(self, function, items, key=None):
+        """Call ``function(item)`` for every item
+
+        Returns
+        -------
+            OrderedDict of ``key(item)`` to ``TaskResult`` in the order of items
+        """
+        key = key or (lambda item: item)
+        items = [(key(item), item) for item in items]
+        results = OrderedDict((k, None) for k, _ in items)
+        if not items:
+            return results
+
+        tasks, done = queue.Queue(), queue.Queue()
+        for item in items:
+            tasks.put(item)
+        running, attempts, abandoned = {}, {}, set()
+        lock, stop = threading.Lock(), threading.Event()
+
+        def __worker():
+            while not stop.is_set():
+                try:
+                    k, item = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                with lock:
+                    running[k] = time.time()
+                    attempts[k] = 0
+                done.put(self._run(function, k, item, attempts, stop))
+                with lock:
+                    if k in abandoned:
+                        # A replacement thread was started when this task timed out
+                        return
+
+        def __start_worker():
+            t = threading.Thread(target=__worker)
+            t.daemon = True
+            t.start()
+
+        for _ in range(max(1, min(self.parallelism, len(items)))):
+            __start_worker()
+
+        start = time.time()
+        deadline = start + self.deadline if self.deadline else None
+        pending = len(items)
+        while pending:
+            try:
+                result = done.get(timeout=self._next_wakeup(running, lock, deadline))
+                with lock:
+                    running.pop(result.key, None)
+                if results[result.key] is None:
+                    results[result.key] = result
+                    pending -= 1
+            except queue.Empty:
+                pass
+
+            now = time.time()
+            if self.timeout:
+                with lock:
+                    expired = [(k, started) for k, started in running.items() if now - started > self.timeout]
+                    for k, _ in expired:
+                        del running[k]
+                        abandoned.add(k)
+                for k, started in expired:
+                    logger.debug("Task for '%s' timed out after %.1f seconds", k, now - started)
+                    error = TaskTimeout("Timed out after %.1f seconds" % self.timeout)
+                    results[k] = TaskResult(k, False, error=error, duration=now - started, attempts=attempts[k])
+                    pending -= 1
+                    if not tasks.empty():
+                        __start_worker()
+
+            if deadline and now > deadline and pending:
+                stop.set()
+                logger.debug("Deadline of %.1f seconds exceeded, %i tasks didn't finish", self.deadline, pending)
+                error = TaskTimeout("Deadline of %.1f seconds exceeded" % self.deadline)
+                for k in results:
+                    if results[k] is None:
+                        started = running.get(k, now)
+                        results[k] = TaskResult(k, False, error=error, duration=now - started,
+                                                attempts=attempts.get(k, 0))
+                pending = 0
+
+        return results
+
+    def _next_wakeup(self, running, lock, deadline):
+        """Seconds until the next task timeout or the deadline, at most 1
+        """
+        now = time.time()
+        wakeup = [1.0]
+        if self.timeout:
+            with lock:
+                wakeup.extend(started + self.timeout - now for started in running.values())
+        if deadline:
+            wakeup.append(deadline - now)
+        return max(0.01, min(wakeup))
+
+    def _run(self, function, k, item, attempts, stop):
+        start = time.time()
+        last_exception = None
+        for attempt in range(1, self.retries + 1):
+            attempts[k] = attempt
+            try:
+                output = function(item)
+                return TaskResult(k, True, output=output, duration=time.time() - start, attempts=attempt)
+            except self.catch as e:
+                last_exception = e
+                logger.debug("Attempt %i/%i for '%s' failed: %s", attempt, self.retries, k, e)
+                if stop.is_set():
+                    break
+                if attempt < self.retries:
+                    time.sleep(self.wait)
+            except Exception as e:
+                last_exception = e
+                logger.debug("Task for '%s' failed: %s", k, e)
+                break
+        return TaskResult(k, False, error=last_exception, duration=time.time() - start, attempts=attempts[k])
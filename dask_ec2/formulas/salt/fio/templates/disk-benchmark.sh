@@ -0,0 +1,22 @@
+#!/bin/bash
+# Sequential write and read throughput of the disk of DIRECTORY as fio JSON
+# in a single line.
+#
+# Usage: dask-ec2-disk-benchmark DIRECTORY [SIZE] [RUNTIME]
+
+set -e -o pipefail
+
+DIRECTORY="${1:-/mnt/dask-local}"
+SIZE="${2:-1G}"
+RUNTIME="${3:-30}"
+
+mkdir -p "${DIRECTORY}"
+trap 'rm -f "${DIRECTORY}/dask-ec2-fio"' EXIT
+
+fio --output-format=json \
+    --directory="${DIRECTORY}" --filename=dask-ec2-fio \
+    --size="${SIZE}" --runtime="${RUNTIME}" --time_based \
+    --ioengine=libaio --direct=1 --bs=1M --iodepth=32 \
+    --name=write --rw=write \
+    --name=read --rw=read --stonewall | tr -d '\n'
+echo
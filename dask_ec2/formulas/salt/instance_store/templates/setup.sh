@@ -0,0 +1,75 @@
+#!/bin/bash
+# Format and mount the instance store volumes of the node at MOUNT_POINT.
+#
+# Several volumes are assembled in a RAID0 array. Nodes without instance
+# store only get an empty directory in the root volume.
+
+set -e
+
+MOUNT_POINT="${1:-/mnt/dask-local}"
+RAID_DEVICE="${2:-/dev/md0}"
+FILESYSTEM="${3:-ext4}"
+
+if mountpoint -q "${MOUNT_POINT}"; then
+    exit 0
+fi
+
+devices=()
+
+# NVMe instance store (Nitro and i3)
+for device in /dev/nvme*n1; do
+    [ -b "${device}" ] || continue
+    model=$(cat "/sys/block/$(basename ${device})/device/model" 2>/dev/null || true)
+    if [[ "${model}" == *"Instance Storage"* ]]; then
+        devices+=("${device}")
+    fi
+done
+
+# Ephemeral volumes of the block device mapping (Xen)
+if [ ${#devices[@]} -eq 0 ]; then
+    metadata="http://169.254.169.254/latest/meta-data/block-device-mapping"
+    for name in $(curl -sf "${metadata}/" | grep ephemeral || true); do
+        device=$(curl -sf "${metadata}/${name}" | sed 's/^sd/xvd/')
+        [ -b "/dev/${device}" ] && devices+=("/dev/${device}")
+    done
+fi
+
+# cloud-init mounts ephemeral0 at /mnt on the ubuntu AMIs, take it over.
+# Devices mounted anywhere else are left alone.
+free=()
+for device in "${devices[@]}"; do
+    mounted=$(awk -v d="${device}" '$1 == d {print $2}' /proc/mounts)
+    if [ "${mounted}" = "/mnt" ]; then
+        umount /mnt
+        sed -i "\|^${device}[[:space:]]|d; \|comment=cloudconfig|d" /etc/fstab
+        mounted=""
+    fi
+    if [ -z "${mounted}" ]; then
+        free+=("${device}")
+    fi
+done
+
+mkdir -p "${MOUNT_POINT}"
+if [ ${#free[@]} -eq 0 ]; then
+    echo "No instance store volumes, using ${MOUNT_POINT} in the root volume"
+    chmod 1777 "${MOUNT_POINT}"
+    exit 0
+fi
+
+if [ ${#free[@]} -eq 1 ]; then
+    target="${free[0]}"
+else
+    yes | mdadm --create "${RAID_DEVICE}" --level=0 --raid-devices=${#free[@]} "${free[@]}"
+    mdadm --detail --scan >> /etc/mdadm/mdadm.conf
+    target="${RAID_DEVICE}"
+fi
+
+if [ "${FILESYSTEM}" = "xfs" ]; then
+    mkfs.xfs -f "${target}"
+else
+    mkfs.ext4 -F -E nodiscard "${target}"
+fi
+mount -o defaults,noatime "${target}" "${MOUNT_POINT}"
+echo "${target} ${MOUNT_POINT} ${FILESYSTEM} defaults,noatime,nofail 0 2" >> /etc/fstab
+chmod 1777 "${MOUNT_POINT}"
+echo "Mounted ${#free[@]} instance store volumes (${free[*]}) at ${MOUNT_POINT}"
@@ -0,0 +1,93 @@
+"""
+Registry of AMIs baked with the conda and dask.distributed formulas
+"""
+from __future__ import print_function, division, absolute_import
+
+import os
+import time
+import hashlib
+import logging
+
+import six
+import yaml
+
+import dask_ec2
+from .ssh import local_manifest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REGISTRY_FILEPATH = os.path.join(os.path.expanduser("~"), ".dask-ec2", "images.yaml")
+
+# Python version of the anaconda installed by the conda formula
+DEFAULT_PYVERSION = 2 if six.PY2 else 3
+
+# Salt states applied when baking an image, see ``formulas/salt/top.sls``
+BAKED_ROLES = ["conda", "dask.distributed"]
+
+
+def formulas_hash():
+    """sha1 of the content of the salt formulas
+
+    Any change to the formulas invalidates the images baked with them.
+    """
+    dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
+    manifest = local_manifest(os.path.join(dask_ec2_src, "formulas", "salt"))
+    digest = hashlib.sha1()
+    for relpath in sorted(manifest):
+        digest.update("{} {}\n".format(relpath, manifest[relpath]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def image_key(region, base_image_id, pyversion, username, formulas=None):
+    """Registry key of an image baked from ``base_image_id`` with the current formulas
+    """
+    return "{}/{}/py{}/{}/{}".format(region, base_image_id, pyversion, username, formulas or formulas_hash())
+
+
+class ImageRegistry(object):
+    """Baked AMIs stored in a YAML file
+
+    Parameters
+    ----------
+    filepath : str
+        Defaults to ``~/.dask-ec2/images.yaml``
+    """
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath or DEFAULT_REGISTRY_FILEPATH
+
+    def load(self):
+        if not os.path.exists(self.filepath):
+            return {}
+        try:
+            with open(self.filepath, "r") as f:
+                return yaml.safe_load(f.read()) or {}
+        except (IOError, yaml.YAMLError):
+            logger.debug("Ignoring invalid image registry %s", self.filepath)
+            return {}
+
+    def save(self, images):
+        dirname = os.path.dirname(self.filepath)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.filepath, "w") as f:
+            yaml.safe_dump(images, f, default_flow_style=False)
+
+    def get(self, key):
+        """Return the ``{'image_id', ...}`` entry for a key, None if there is no baked image
+        """
+        return self.load().get(key)
+
+    def add(self, key, image_id, **info):
+        images = self.load()
+        entry = {"image_id": image_id, "created": time.time()}
+        entry.update(info)
+        images[key] = entry
+        self.save(images)
+        return entry
+
+    def remove(self, key):
+        images = self.load()
+        entry = images.pop(key, None)
+        self.save(images)
+        return entry
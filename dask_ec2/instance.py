@@ -1,11 +1,12 @@
 from __future__ import print_function, division, absolute_import
 
+import time
 import socket
 import logging
 
 from paramiko.ssh_exception import BadHostKeyException, AuthenticationException, SSHException
 
-from .ssh import SSHClient
+from .ssh import get_pool, wait_for_port
 from .utils import retry
 from .exceptions import DaskEc2Exception
 
@@ -13,9 +14,15 @@ logger = logging.getLogger(__name__)
 
 
 class Instance(object):
+    """A node of the cluster
 
-    def __init__(self, ip, uid=None, port=22, username=None, keypair=None):
+    ``ip`` is the address used to SSH to the node and by external clients,
+    ``private_ip`` is the VPC address used for the traffic inside the cluster.
+    """
+
+    def __init__(self, ip, uid=None, port=22, username=None, keypair=None, private_ip=None):
         self.ip = ip
+        self.private_ip = private_ip
         self.uid = uid
         self.port = port
         self.username = username
@@ -26,22 +33,49 @@ class Instance(object):
         instance_ip = instance.public_ip_address
         if instance_ip is None:
             instance_ip = instance.private_ip_address
-        self = cls(ip=instance_ip, uid=instance.id)
+        self = cls(ip=instance_ip, uid=instance.id, private_ip=instance.private_ip_address)
         return self
 
-    @retry(catch=(BadHostKeyException, AuthenticationException, SSHException, socket.error, TypeError,
-                  DaskEc2Exception))
-    def check_ssh(self):
+    @property
+    def cluster_ip(self):
+        """Address other nodes use to reach this node: the private IP if known
+        """
+        return self.private_ip or self.ip
+
+    def check_ssh(self, timeout=300):
+        self.wait_for_ssh(timeout=timeout)
+        return True
+
+    def wait_for_ssh(self, timeout=300):
+        """Wait until the node accepts SSH connections
+
+        The SSH port is probed with a cheap TCP connect first, the SSH
+        handshake is only attempted once the port is open.
+
+        Returns
+        -------
+            Seconds until the node was ready
+        """
+        start = time.time()
+        logger.debug('Waiting for port %s to be open on %s', self.port, self.ip)
+        wait_for_port(self.ip, self.port, timeout=timeout)
+        self._check_ssh_handshake()
+        return time.time() - start
+
+    @retry(retries=5, wait=2, catch=(BadHostKeyException, AuthenticationException, SSHException, socket.error,
+                                     TypeError, DaskEc2Exception))
+    def _check_ssh_handshake(self):
         logger.debug('Checking ssh connection for %s', self.ip)
         self.ssh_client.exec_command("ls")
-        return True
 
     def get_ssh_client(self):
+        """Return a connected SSHClient from the shared connection pool
+        """
         host = self.ip
         username = self.username
         pkey = self.keypair
         port = self.port
-        client = SSHClient(host, username=username, pkey=pkey, port=port)
+        client = get_pool().get(host, username=username, pkey=pkey, port=port)
         return client
 
     ssh_client = property(get_ssh_client, None, None)
@@ -53,12 +87,15 @@ class Instance(object):
         self.port = data["port"]
         self.username = data["username"]
         self.keypair = data["keypair"]
+        # Cluster files written before private IPs were recorded don't have it
+        self.private_ip = data.get("private_ip")
         return self
 
     def to_dict(self):
         ret = {}
         ret['uid'] = self.uid
         ret['ip'] = self.ip
+        ret['private_ip'] = self.private_ip
         ret['port'] = self.port
         ret['username'] = self.username
         ret['keypair'] = self.keypair
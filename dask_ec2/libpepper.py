@@ -5,7 +5,10 @@ A Python library for working with Salt's REST API
 
 '''
 import json
+import time
+import socket
 import logging
+import threading
 import ssl
 try:
     ssl._create_default_https_context = ssl._create_stdlib_context
@@ -13,14 +16,13 @@ except:
     pass
 
 try:
-    from urllib.request import HTTPHandler, Request, urlopen, \
-        install_opener, build_opener
     from urllib.error import HTTPError, URLError
     import urllib.parse as urlparse
+    import http.client as httplib
 except ImportError:
-    from urllib2 import HTTPHandler, Request, urlopen, install_opener, build_opener, \
-        HTTPError, URLError
+    from urllib2 import HTTPError, URLError
     import urlparse
+    import httplib
 
 logger = logging.getLogger('pepper')
 
@@ -29,6 +31,18 @@ class PepperException(Exception):
     pass
 
 
+def _closed_without_response(exc):
+    '''
+    True if the server closed the connection without sending a single byte
+    of the response
+    '''
+    remote_disconnected = getattr(httplib, 'RemoteDisconnected', None)
+    if remote_disconnected is not None and isinstance(exc, remote_disconnected):
+        return True
+    # Python 2 raises BadStatusLine with the empty status line
+    return isinstance(exc, httplib.BadStatusLine) and exc.line in ('', "''")
+
+
 class Pepper(object):
     '''
     A thin wrapper for making HTTP calls to the salt-api rest_cherrpy REST
@@ -65,9 +79,9 @@ class Pepper(object):
         :param api_url: Host or IP address of the salt-api URL;
             include the port number
 
-        :param debug_http: Add a flag to urllib2 to output the HTTP exchange
+        :param debug_http: Output the HTTP exchange
 
-        :param ignore_ssl_errors: Add a flag to urllib2 to ignore invalid SSL certificates
+        :param ignore_ssl_errors: Ignore invalid SSL certificates
 
         :raises PepperException: if the api_url is misformed
 
@@ -81,9 +95,92 @@ class Pepper(object):
         self._ssl_verify = not ignore_ssl_errors
         self.auth = {}
 
+        self._connection = None
+        self._connection_requests = 0
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0, 'reconnects': 0, 'total_time': 0.0, 'max_time': 0.0}
+
+    def _get_connection(self):
+        '''
+        Return the persistent connection to salt-api, opening it if needed
+        '''
+        if self._connection is None:
+            split = urlparse.urlsplit(self.api_url)
+            if split.scheme == 'https':
+                context = None if self._ssl_verify else ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                self._connection = httplib.HTTPSConnection(split.hostname, split.port, context=context)
+            else:
+                self._connection = httplib.HTTPConnection(split.hostname, split.port)
+            self._connection.set_debuglevel(self.debug_http)
+            self._connection_requests = 0
+            self.stats['connections'] += 1
+        return self._connection
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        '''
+        Close the persistent connection to salt-api
+        '''
+        with self._lock:
+            self._close_connection()
+
+    def get_stats(self):
+        '''
+        Request count and latency statistics (in seconds) of this client
+        '''
+        stats = dict(self.stats)
+        stats['mean_time'] = stats['total_time'] / stats['requests'] if stats['requests'] else 0.0
+        return stats
+
+    def _send(self, method, url, body, headers):
+        '''
+        Send a request over the persistent connection and return the
+        ``(status, reason, headers, content)`` of the response
+
+        A connection that was dropped by the server while idle is reopened
+        and the request sent again. Once the request is sent it is never
+        repeated if the connection fails, unless the server closed it without
+        any response, as it does with an idle connection: the server could
+        be running it already and a ``local_async`` would run twice.
+        '''
+        while True:
+            connection = self._get_connection()
+            reused = self._connection_requests > 0
+            try:
+                connection.request(method, url, body, headers)
+            except (httplib.HTTPException, socket.error) as exc:
+                # The server didn't get the whole request
+                self._close_connection()
+                if reused:
+                    logger.debug('Connection to salt-api dropped, reconnecting: {0}'.format(exc))
+                    self.stats['reconnects'] += 1
+                    continue
+                raise URLError(exc)
+
+            try:
+                resp = connection.getresponse()
+                content = resp.read()
+            except (httplib.HTTPException, socket.error) as exc:
+                self._close_connection()
+                if reused and _closed_without_response(exc):
+                    logger.debug('Connection to salt-api closed while idle, reconnecting: {0}'.format(exc))
+                    self.stats['reconnects'] += 1
+                    continue
+                raise URLError(exc)
+
+            self._connection_requests += 1
+            if resp.will_close:
+                self._close_connection()
+            return resp.status, resp.reason, resp.msg, content
+
     def req(self, path, data=None):
         '''
-        A thin wrapper around urllib2 to send requests and return the response
+        Send a request over a persistent HTTP(S) connection and return the
+        response
 
         If the current instance contains an authentication token it will be
         attached to the request as a custom header.
@@ -100,50 +197,48 @@ class Pepper(object):
             'X-Requested-With': 'XMLHttpRequest',
         }
 
-        handler = HTTPHandler(debuglevel=self.debug_http)
-        opener = build_opener(handler)
-        install_opener(opener)
-
         # Build POST data
+        postdata = None
         if data is not None:
             postdata = json.dumps(data).encode()
-            clen = len(postdata)
-
-        # Create request object
-        url = self._construct_url(path)
-        req = Request(url, postdata, headers)
-
-        # Add POST data to request
-        if data is not None:
-            req.add_header('Content-Length', clen)
+            headers['Content-Length'] = str(len(postdata))
 
         # Add auth header to request
         if self.auth and 'token' in self.auth and self.auth['token']:
-            req.add_header('X-Auth-Token', self.auth['token'])
+            headers['X-Auth-Token'] = self.auth['token']
+
+        url = self._construct_url(path)
+        split = urlparse.urlsplit(url)
+        selector = urlparse.urlunsplit(('', '', split.path or '/', split.query, ''))
+        method = 'POST' if data is not None else 'GET'
 
         # Send request
+        start = time.time()
         try:
-            if not (self._ssl_verify):
-                con = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-                # con.check_hostname = False
-                # con.verify_mode = ssl.CERT_NONE
-                f = urlopen(req, context=con)
-            else:
-                f = urlopen(req)
-            ret = json.loads(f.read().decode('utf-8'))
-        except (HTTPError, URLError) as exc:
-            logger.debug('Error with request', exc_info=True)
-            status = getattr(exc, 'code', None)
+            with self._lock:
+                status, reason, resp_headers, content = self._send(method, selector, postdata, headers)
+        except URLError as exc:
+            logger.error('Error with request: {0}'.format(exc))
+            raise
+        finally:
+            elapsed = time.time() - start
+            self.stats['requests'] += 1
+            self.stats['total_time'] += elapsed
+            self.stats['max_time'] = max(self.stats['max_time'], elapsed)
+
+        if status == 401:
+            raise PepperException('Authentication denied')
 
-            if status == 401:
-                raise PepperException('Authentication denied')
+        if status == 500:
+            raise PepperException('Server error.')
 
-            if status == 500:
-                raise PepperException('Server error.')
+        if status >= 400:
+            logger.error('Error with request: {0} {1}'.format(status, reason))
+            raise HTTPError(url, status, reason, resp_headers, None)
 
-            logger.error('Error with request: {0}'.format(exc))
-            raise
-        except AttributeError:
+        try:
+            ret = json.loads(content.decode('utf-8'))
+        except ValueError:
             logger.debug('Error converting response from JSON', exc_info=True)
             raise PepperException('Unable to parse the server response.')
 
@@ -199,13 +294,18 @@ class Pepper(object):
         '''
         return self.req(path, lowstate)
 
-    def local(self, tgt, fun, arg=None, kwarg=None, expr_form='glob', timeout=None, ret=None):
+    @staticmethod
+    def make_low(client, fun, tgt=None, arg=None, kwarg=None, expr_form=None, timeout=None, ret=None, **kwargs):
         '''
-        Run a single command using the ``local`` client
+        Build a lowstate chunk for :meth:`low`, empty values are left out
 
-        Wraps :meth:`low`.
+        Several chunks can be sent in one request, the response has one
+        item in ``return`` per chunk in the same order.
         '''
-        low = {'client': 'local', 'tgt': tgt, 'fun': fun}
+        low = {'client': client, 'fun': fun}
+
+        if tgt:
+            low['tgt'] = tgt
 
         if arg:
             low['arg'] = arg
@@ -222,6 +322,16 @@ class Pepper(object):
         if ret:
             low['ret'] = ret
 
+        low.update(kwargs)
+        return low
+
+    def local(self, tgt, fun, arg=None, kwarg=None, expr_form='glob', timeout=None, ret=None):
+        '''
+        Run a single command using the ``local`` client
+
+        Wraps :meth:`low`.
+        '''
+        low = self.make_low('local', fun, tgt, arg, kwarg, expr_form, timeout, ret)
         return self.low([low], path='/')
 
     def local_async(self, tgt, fun, arg=None, kwarg=None, expr_form='glob', timeout=None, ret=None):
@@ -230,23 +340,7 @@ class Pepper(object):
 
         Wraps :meth:`low`.
         '''
-        low = {'client': 'local_async', 'tgt': tgt, 'fun': fun}
-
-        if arg:
-            low['arg'] = arg
-
-        if kwarg:
-            low['kwarg'] = kwarg
-
-        if expr_form:
-            low['expr_form'] = expr_form
-
-        if timeout:
-            low['timeout'] = timeout
-
-        if ret:
-            low['ret'] = ret
-
+        low = self.make_low('local_async', fun, tgt, arg, kwarg, expr_form, timeout, ret)
         return self.low([low], path='/')
 
     def lookup_jid(self, jid):
@@ -265,10 +359,7 @@ class Pepper(object):
         Usage::
           runner('jobs.lookup_jid', jid=12345)
         '''
-        low = {'client': 'runner', 'fun': fun}
-
-        low.update(kwargs)
-
+        low = self.make_low('runner', fun, **kwargs)
         return self.low([low], path='/')
 
     def login(self, username, password, eauth):
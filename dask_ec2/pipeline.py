@@ -0,0 +1,163 @@
+"""
+Pipelined launch of the cluster: every node goes running -> SSH ready ->
+salt-minion installed on its own, and salt-master is installed on the head
+node while the workers are still booting
+"""
+from __future__ import print_function, division, absolute_import
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from .cluster import Cluster
+from .instance import Instance
+from .exceptions import DaskEc2Exception
+from .salt import install_salt_master, install_node_minion, percentile
+
+logger = logging.getLogger(__name__)
+
+# Stages of every node, in order. Only the head node has a "master" stage
+STAGES = ["running", "ssh", "master", "minion"]
+
+
+class LaunchPipeline(object):
+    """Bootstrap salt on instances that were just created
+
+    Parameters
+    ----------
+    driver : dask_ec2.ec2.EC2
+    region : str
+    instances : list of boto3 instances
+        As returned by ``EC2.launch(..., wait=False)``, the first one is the
+        head node
+    username, keypair : str
+        To SSH to the nodes
+    parallelism : int
+        Maximum number of nodes being bootstrapped at the same time
+    node_timeout : float, optional
+        Seconds for a node to be bootstrapped, from the start of its bootstrap
+    node_deadline : float, optional
+        Seconds for all the nodes to be bootstrapped
+    ssh_timeout : float
+        Seconds for a node to accept SSH connections once it's running
+    running_timeout : float
+        Seconds for all the instances to be running
+    poll_interval : float
+        Seconds between polls of the state of the instances
+    callback : callable, optional
+        Called as ``callback(index, stage, seconds)`` when a node finishes a
+        stage, seconds are counted from the start of the pipeline
+    """
+
+    def __init__(self, driver, region, instances, username, keypair, parallelism=None, node_timeout=None,
+                 node_deadline=None, ssh_timeout=300, running_timeout=600, poll_interval=5, callback=None):
+        self.driver = driver
+        self.ids = [instance.id for instance in instances]
+        self.ssh_timeout = ssh_timeout
+        self.running_timeout = running_timeout
+        self.poll_interval = poll_interval
+        self.callback = callback
+
+        nodes = [Instance(ip=None, uid=uid, username=username, keypair=keypair) for uid in self.ids]
+        self.cluster = Cluster(region, nodes)
+        if parallelism:
+            self.cluster.parallelism = parallelism
+        self.cluster.node_timeout = node_timeout
+        self.cluster.node_deadline = node_deadline
+
+        self.timings = OrderedDict((uid, {}) for uid in self.ids)
+        self._running = dict((uid, threading.Event()) for uid in self.ids)
+        self._errors = []
+        self._start = None
+        self.seconds = None
+
+    def _record(self, index, stage):
+        seconds = time.time() - self._start
+        self.timings[self.ids[index]][stage] = seconds
+        logger.debug("Node %i finished stage '%s' at %.1f seconds", index, stage, seconds)
+        if self.callback is not None:
+            self.callback(index, stage, seconds)
+
+    def _poll_running(self):
+        try:
+            for boto3_instance in self.driver.iter_running(self.ids, poll_interval=self.poll_interval,
+                                                           timeout=self.running_timeout):
+                index = self.ids.index(boto3_instance.id)
+                node = Instance.from_boto3_instance(boto3_instance)
+                self.cluster.instances[index].ip = node.ip
+                self.cluster.instances[index].private_ip = node.private_ip
+                self._record(index, "running")
+                self._running[boto3_instance.id].set()
+        except Exception as e:
+            logger.debug("Error waiting for the instances to be running: %s", e)
+            self._errors.append(e)
+            for event in self._running.values():
+                event.set()
+
+    def _wait_running(self, index):
+        self._running[self.ids[index]].wait()
+        if self._errors:
+            raise self._errors[0]
+
+    def _bootstrap(self, index):
+        self._wait_running(index)
+        node = self.cluster.instances[index]
+        node.wait_for_ssh(timeout=self.ssh_timeout)
+        self._record(index, "ssh")
+
+        if index == 0:
+            install_salt_master(self.cluster)
+            self._record(index, "master")
+        else:
+            # The minion only needs the master IPs, not a running salt-master
+            self._wait_running(0)
+
+        result = install_node_minion(self.cluster, index)
+        if result["failed_step"]:
+            raise DaskEc2Exception("Error installing salt-minion ({}): {}".format(
+                result["failed_step"], result["error"]))
+        self._record(index, "minion")
+        return result
+
+    def run(self):
+        """Run the pipeline for all the nodes and wait for the minions to connect
+
+        Returns
+        -------
+            The ``Cluster``
+
+        Raises
+        ------
+            DaskEc2Exception with the nodes that failed and their stage
+        """
+        self._start = time.time()
+        poller = threading.Thread(target=self._poll_running)
+        poller.daemon = True
+        poller.start()
+
+        results = self.cluster.executor().map(self._bootstrap, list(range(len(self.ids))),
+                                              key=lambda index: self.ids[index])
+        failed = []
+        for index, (uid, result) in enumerate(results.items()):
+            if not result.success:
+                stages = [stage for stage in STAGES if index == 0 or stage != "master"]
+                stage = next(stage for stage in stages if stage not in self.timings[uid])
+                failed.append("{} ({}: {})".format(uid, stage, result.error))
+        if failed:
+            raise DaskEc2Exception("Error bootstrapping nodes: %s" % ", ".join(failed))
+
+        self.cluster.wait_for_minions()
+        self.seconds = time.time() - self._start
+        return self.cluster
+
+    def summary(self):
+        """Seconds since the start of the pipeline at which the nodes
+        finished every stage: ``{stage: {'p50', 'max'}}``
+        """
+        ret = OrderedDict()
+        for stage in STAGES:
+            values = [timing[stage] for timing in self.timings.values() if stage in timing]
+            if values:
+                ret[stage] = {"p50": percentile(values, 50), "max": max(values)}
+        return ret
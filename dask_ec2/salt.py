@@ -1,11 +1,15 @@
 """
 Utilities to manage salt bootstrap and other stuff
 """
-import copy
 import os
+import json
+import math
+import time
+import hashlib
 import logging
-import itertools
-import threading
+from collections import OrderedDict
+
+import six
 
 import dask_ec2
 from dask_ec2.utils import retry
@@ -13,6 +17,9 @@ from dask_ec2.exceptions import DaskEc2Exception, RetriesExceededException
 
 logger = logging.getLogger(__name__)
 
+# Lines of output kept in memory for long running commands (bootstrap, apt, pip)
+OUTPUT_TAIL = 100
+
 
 class Response(dict):
     """Response from a Salt Command
@@ -39,27 +46,35 @@ class Response(dict):
         """
         Useful when the Command module returns a dictionary, for example state.sls
         Default values are for salt module `state.sls`
+
+        Done in a single pass without modifying the response, successful states
+        are kept by name only and failed states as ``{'name', 'comment', field}``.
+        Minions that returned something other than states (render errors, for
+        example) are reported with one failed entry per error.
         """
-        try:
-            ret = Response()
-            for minion_id, values in self.items():
-                inner_values = []
-                if type(values) == dict:
-                    # Assumes: depth=1 going to flat
-                    for key, value in values.items():
-                        value['name'] = key
-                        inner_values.append(value)
-                elif type(self[minion_id]) == list:
-                    inner_values = self[minion_id]
-
-                successful = [action for action in inner_values if action[field] == validation]
-                failed = [action for action in inner_values if action[field] != validation]
-                summary = {'successful': successful, 'failed': failed}
-                ret[minion_id] = summary
-                return ret
-        except TypeError:
-            logger.debug("Error with salt state.  Printing full returned output")
-            logger.debug(self)
+        ret = Response()
+        for minion_id, values in self.items():
+            successful, failed = [], []
+            if isinstance(values, dict):
+                # Assumes: depth=1 going to flat
+                items = six.iteritems(values)
+            elif isinstance(values, list):
+                items = ((None, value) for value in values)
+            else:
+                items = [(None, values)]
+
+            for key, value in items:
+                if not isinstance(value, dict):
+                    failed.append({'name': 'error', 'comment': str(value), field: None})
+                    continue
+                # List-form results don't always have a name
+                name = key if key is not None else value.get('name') or value.get('__id__') or 'unknown'
+                if value.get(field) == validation:
+                    successful.append(name)
+                else:
+                    failed.append({'name': name, 'comment': value.get('comment', ''), field: value.get(field)})
+            ret[minion_id] = {'successful': successful, 'failed': failed}
+        return ret
 
     def aggregated_to_table(self, agg=None):
         """
@@ -80,307 +95,442 @@ class Response(dict):
         """
         From an aggregated return True if all the states where successful
         """
-        ret = True
-        for node_id, data in self.items():
-            failed = data["failed"]
-            ret = ret & (len(failed) == 0)
-        return ret
+        return all(len(data["failed"]) == 0 for data in self.values())
 
     def group_by_id(self, ignore_fields=None, sort=True):
-        if ignore_fields:
-            clone = copy.deepcopy(self)
-            for id_ in clone:
-                for field in ignore_fields:
-                    del clone[id_][field]
-        else:
-            clone = self
+        """Group the minions that returned the same output
 
-        items = sorted(clone.items(), key=lambda x: x[1])
-        groups = []
-        for key, group in itertools.groupby(items, key=lambda x: x[1]):
-            groups.append((key, [item[0] for item in group]))
+        Outputs are compared by a hash of their JSON serialization, ignoring
+        the top level ``ignore_fields``, so the response is not copied.
 
+        Returns
+        -------
+            List of ``(output, [minion_id, ...])``, the largest group first if
+            ``sort``, where output is the one of the first minion in the group
+        """
+        ignore_fields = set(ignore_fields or [])
+        groups = OrderedDict()
+        for minion_id, values in self.items():
+            if ignore_fields and isinstance(values, dict):
+                values = dict((k, v) for k, v in values.items() if k not in ignore_fields)
+            digest = hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+            if digest not in groups:
+                groups[digest] = (values, [])
+            groups[digest][1].append(minion_id)
+
+        groups = list(groups.values())
         if sort:
             groups = sorted(groups, key=lambda x: len(x[1]), reverse=True)
         return groups
 
 
+class StepTimings(object):
+    """Collect per step timings from the progress markers of a remote script
+
+    Used as the ``callback`` of ``SSHClient.exec_command``, it parses lines
+    like ``@@dask-ec2 start <step>`` and ``@@dask-ec2 end <step> <exit_code>``
+    and timestamps them as they are received.
+    """
+
+    marker = "@@dask-ec2"
+
+    def __init__(self):
+        self.steps = []
+        self._started = {}
+
+    def __call__(self, stream, line):
+        if stream != "stdout" or not line.startswith(self.marker):
+            return
+        logger.debug(line)
+        fields = line.split()
+        if fields[1] == "start":
+            self._started[fields[2]] = time.time()
+        elif fields[1] == "end":
+            name, exit_code = fields[2], int(fields[3])
+            start = self._started.pop(name)
+            self.steps.append({"name": name, "seconds": time.time() - start, "exit_code": exit_code})
+
+    def failed(self):
+        """Name of the step that failed or didn't finish, None if all succeeded
+        """
+        for step in self.steps:
+            if step["exit_code"] != 0:
+                return step["name"]
+        if self._started:
+            return list(self._started)[0]
+        return None
+
+
+def percentile(values, q):
+    """Nearest-rank percentile ``q`` (0-100) of a list of numbers
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(q / 100.0 * len(values)))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+def parse_duration(duration):
+    """Salt reports state durations in milliseconds, as a number or as a
+    string like ``'12.3 ms'`` in older versions. Returns seconds.
+    """
+    if isinstance(duration, six.string_types):
+        duration = duration.split()[0]
+    return float(duration) / 1000.0
+
+
+class StateProfile(object):
+    """Per state timings of a ``state.sls`` run from the ``duration`` and
+    ``start_time`` salt includes in every state return
+
+    Parameters
+    ----------
+    response : Response
+        Salt response by minion id, not aggregated
+    """
+
+    def __init__(self, response):
+        self.records = []
+        for minion_id, states in response.items():
+            if not isinstance(states, dict):
+                # Rendering errors are returned as a list of strings
+                continue
+            for key, state in states.items():
+                if not isinstance(state, dict) or "duration" not in state:
+                    continue
+                # Keys are '<module>_|-<state id>_|-<name>_|-<function>'
+                parts = key.split("_|-")
+                self.records.append({"node": minion_id,
+                                     "state": state.get("__id__") or parts[1],
+                                     "function": "{}.{}".format(parts[0], parts[-1]),
+                                     "seconds": parse_duration(state["duration"]),
+                                     "start_time": state.get("start_time"),
+                                     "result": state.get("result")})
+
+    def __len__(self):
+        return len(self.records)
+
+    def slowest(self, n=1):
+        """Slowest ``n`` states of every node
+
+        Returns
+        -------
+            Dict of node id to a list of records, slowest first
+        """
+        by_node = {}
+        for record in self.records:
+            by_node.setdefault(record["node"], []).append(record)
+        return {node: sorted(records, key=lambda r: r["seconds"], reverse=True)[:n]
+                for node, records in by_node.items()}
+
+    def by_state(self):
+        """Time spent in every state ID across the cluster
+
+        Returns
+        -------
+            List of ``{'state', 'nodes', 'total', 'p50', 'p95', 'max'}`` dicts
+            (seconds), the state with the largest total first
+        """
+        by_state = {}
+        for record in self.records:
+            by_state.setdefault(record["state"], []).append(record["seconds"])
+        ret = []
+        for state, seconds in by_state.items():
+            ret.append({"state": state,
+                        "nodes": len(seconds),
+                        "total": sum(seconds),
+                        "p50": percentile(seconds, 50),
+                        "p95": percentile(seconds, 95),
+                        "max": max(seconds)})
+        return sorted(ret, key=lambda x: x["total"], reverse=True)
+
+    def to_dict(self):
+        return {"states": self.by_state(), "records": self.records}
+
+
 def install_salt_master(cluster):
+    """Install and configure salt-master and salt-api on the head node
+
+    The setup script and the ``master.d`` configuration files are uploaded
+    as one bundle and the (idempotent) script is executed in the same SSH
+    session, streaming progress markers back.
+
+    Returns
+    -------
+        List of ``{'name', 'seconds', 'exit_code'}`` dicts, one per step
+    """
     master = cluster.instances[0].ssh_client
     dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
     templates_src = os.path.join(dask_ec2_src, "templates")
 
+    bundle = [(os.path.join(templates_src, "install_salt_master.sh"), "install_salt_master.sh")]
+    for name in ("auto_accept.conf", "rest_cherrypy.conf", "external_auth.conf"):
+        bundle.append((os.path.join(templates_src, name), "master.d/{}".format(name)))
+    bundle_dir = "/tmp/dask-ec2-master"
+    run = "bash {}/install_salt_master.sh".format(bundle_dir)
+
+    timings = []
+
     @retry(retries=3, wait=0)
     def __install_salt_master():
-        cmd = "curl -sS -L https://bootstrap.saltstack.com | sh -s -- -d -X -M -N stable"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
-        return True
+        timings.append(StepTimings())
+        master.put_tar(bundle, bundle_dir, sudo=True, run=run, callback=timings[-1])
 
     try:
         __install_salt_master()
     except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't bootstrap salt-master. Error is above (maybe try again)" %
-                               e.last_exception)
-
-    @retry(retries=3, wait=0)
-    def __install_salt_api():
-        cmd = "curl -L https://bootstrap.saltstack.com | sh -s -- -d -X -M -N -P -L -p salt-api stable"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+        step = timings[-1].failed() if timings else None
+        raise DaskEc2Exception("%s\nCouldn't setup salt-master, failed at step '%s'. Error is above (maybe try again)" %
+                               (e.last_exception, step))
+    return timings[-1].steps
 
-    try:
-        __install_salt_api()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't bootstrap salt-api. Error is above (maybe try again)" % e.last_exception)
 
-    @retry(retries=3, wait=0)
-    def __setup_salt_master():
-        local = os.path.join(templates_src, "auto_accept.conf")
-        remote = "/etc/salt/master.d/auto_accept.conf"
-        master.put(local, remote, sudo=True)
+def remote_cmd(cluster, command, instances=None):
+    """Run a command with sudo on the nodes (all by default) in parallel
 
-    try:
-        __setup_salt_master()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't setup salt-master settings. Error is above (maybe try again)" %
-                               e.last_exception)
+    Returns
+    -------
+        OrderedDict of node IP to TaskResult, the output is the
+        ``exec_command`` response
+    """
+    instances = cluster.instances if instances is None else instances
 
-    @retry(retries=3, wait=0)
-    def __apt_installs():
-        cmd = "apt-get install -y python-pip libssl-dev libffi-dev python-dev"
-        ret = master.exec_command(cmd, sudo=True)
+    def __remote_cmd(instance):
+        ret = instance.ssh_client.exec_command(command, sudo=True, tail=OUTPUT_TAIL)
         if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+            raise Exception(ret["stderr"])
+        return ret
 
-    try:
-        __apt_installs()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't install ubuntu dependencies. Error is above (maybe try again)" %
-                               e.last_exception)
+    return cluster.executor(retries=3).map(__remote_cmd, instances, key=lambda instance: instance.ip)
 
-    @retry(retries=3, wait=0)
-    def __upgrade_pip():
-        cmd = "pip install --upgrade pip packaging appdirs six"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"])
 
-    try:
-        __upgrade_pip()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't upgrade pip. Error is above (maybe try again)" % e.last_exception)
+def remote_upload(cluster, local, remote, instances=None):
+    """Upload a file or directory with sudo to the nodes (all by default) in parallel
 
-    @retry(retries=3, wait=0)
-    def __install_salt_rest_api():
-        cmd = "pip install cherrypy"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+    Returns
+    -------
+        OrderedDict of node IP to TaskResult
+    """
+    instances = cluster.instances if instances is None else instances
 
-    try:
-        __install_salt_rest_api()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't install CherryPy. Error is above (maybe try again)" % e.last_exception)
+    def __remote_upload(instance):
+        instance.ssh_client.put(local, remote, sudo=True)
+        return True
 
-    @retry(retries=3, wait=0)
-    def __install_pyopensll():
-        cmd = "pip install PyOpenSSL==16.2.0"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"])
+    return cluster.executor(retries=3).map(__remote_upload, instances, key=lambda instance: instance.ip)
 
-    try:
-        __install_pyopensll()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't install PyOpenSSL. Error is above (maybe try again)" % e.last_exception)
 
-    @retry(retries=3, wait=0)
-    def __create_ssl_cert():
-        cmd = "salt-call --local tls.create_self_signed_cert"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+# Settings of the interface of the default route as ``key=value`` lines
+NETWORK_INFO_CMD = ("iface=$(ip route show default | awk '{print $5; exit}'); "
+                    "echo interface=$iface; "
+                    "echo driver=$(ethtool -i $iface 2>/dev/null | awk '/^driver:/ {print $2}'); "
+                    "echo mtu=$(cat /sys/class/net/$iface/mtu); "
+                    "echo speed=$(cat /sys/class/net/$iface/speed 2>/dev/null)")
 
-    try:
-        __create_ssl_cert()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't generate SSL certificate. Error is above (maybe try again)" %
-                               e.last_exception)
+# MTU of jumbo frames inside a VPC
+JUMBO_MTU = 9001
 
-    @retry(retries=3, wait=0)
-    def __setup_rest_cherrypy():
-        local = os.path.join(templates_src, "rest_cherrypy.conf")
-        remote = "/etc/salt/master.d/rest_cherrypy.conf"
-        master.put(local, remote, sudo=True)
 
+def parse_network_info(output):
+    """Parse the output of ``NETWORK_INFO_CMD``
+
+    Returns
+    -------
+        dict with ``interface``, ``driver``, ``mtu`` (int), ``speed`` (Mbps,
+        None if the driver doesn't report it), ``ena`` and ``jumbo`` (bools)
+    """
+    values = dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
+    info = {"interface": values.get("interface") or None, "driver": values.get("driver") or None}
     try:
-        __setup_rest_cherrypy()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't setup salt-rest server. Error is above (maybe try again)" %
-                               e.last_exception)
+        info["mtu"] = int(values.get("mtu"))
+    except (TypeError, ValueError):
+        info["mtu"] = None
+    try:
+        speed = int(values.get("speed"))
+        # ENA reports -1 or nothing, the bandwidth depends on the instance type
+        info["speed"] = speed if speed > 0 else None
+    except (TypeError, ValueError):
+        info["speed"] = None
+    info["ena"] = info["driver"] == "ena"
+    info["jumbo"] = info["mtu"] is not None and info["mtu"] >= JUMBO_MTU
+    return info
+
+
+def network_info(cluster):
+    """Driver, MTU and link speed of the primary interface of every node
+
+    Returns
+    -------
+        OrderedDict of node IP to the ``parse_network_info`` dict, None for the
+        nodes where the command failed
+    """
+    results = remote_cmd(cluster, NETWORK_INFO_CMD)
+    return OrderedDict((ip, parse_network_info(result.output["stdout"]) if result.success else None)
+                       for ip, result in results.items())
 
-    @retry(retries=3, wait=0)
-    def __setup_salt_external_auth():
-        local = os.path.join(templates_src, "external_auth.conf")
-        remote = "/etc/salt/master.d/external_auth.conf"
-        master.put(local, remote, sudo=True)
 
-    try:
-        __setup_salt_external_auth()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't setup salt external auth system. Error is above (maybe try again)" %
-                               e.last_exception)
+def parse_fio_output(output):
+    """Throughput and IOPS of a ``dask-ec2-disk-benchmark`` (fio JSON) run
 
-    @retry(retries=3, wait=0)
-    def __create_saltdev_user():
-        cmd = "id -u saltdev &>/dev/null || useradd -p $(openssl passwd -1 saltdev) saltdev"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+    Returns
+    -------
+        dict with ``write_mbps``, ``read_mbps``, ``write_iops`` and ``read_iops``
+    """
+    start = output.find("{")
+    if start < 0:
+        raise DaskEc2Exception("Invalid fio output: %s" % output[-200:])
+    jobs = json.loads(output[start:])["jobs"]
+    ret = {}
+    for direction in ("write", "read"):
+        stats = [job[direction] for job in jobs]
+        ret["%s_mbps" % direction] = sum(stat.get("bw_bytes", stat.get("bw", 0) * 1024) for stat in stats) / 1e6
+        ret["%s_iops" % direction] = sum(stat.get("iops", 0) for stat in stats)
+    return ret
+
+
+def disk_benchmark(cluster, directory="/mnt/dask-local", size="1G", runtime=30):
+    """Run ``dask-ec2-disk-benchmark`` (installed by the ``fio`` state) on every node
+
+    Returns
+    -------
+        OrderedDict of node IP to the ``parse_fio_output`` dict, None for the
+        nodes where the benchmark failed
+    """
+    command = "/usr/local/bin/dask-ec2-disk-benchmark {} {} {}".format(directory, size, runtime)
+    results = remote_cmd(cluster, command)
+    ret = OrderedDict()
+    for ip, result in results.items():
+        try:
+            ret[ip] = parse_fio_output(result.output["stdout"]) if result.success else None
+        except (DaskEc2Exception, ValueError, KeyError) as e:
+            logger.debug("Invalid disk benchmark output for %s: %s", ip, e)
+            ret[ip] = None
+    return ret
 
-    try:
-        __create_saltdev_user()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't create 'saltdev' user. Error is above (maybe try again)" %
-                               e.last_exception)
 
-    @retry(retries=3, wait=0)
-    def __restart_salt_master():
-        cmd = "service salt-master restart"
-        ret = master.exec_command(cmd, sudo=True)
+def _install_minion(instance, minion_id, master_ip, mine_conf):
+    """Run the bootstrap -> configure -> restart pipeline on one node
+
+    Returns a dict with the per step timings and the error (if any)
+    """
+    # Images created with `dask-ec2 bake` already have salt-minion installed
+    bootstrap = "command -v salt-minion >/dev/null 2>&1 || curl -L https://bootstrap.saltstack.com | sh -s -- "
+    bootstrap += "-d -X -P -L -A {master_ip} -i {minion_id} stable".format(master_ip=master_ip, minion_id=minion_id)
+    identity = ('echo "master: {master_ip}" > /etc/salt/minion.d/dask-ec2.conf'
+                ' && echo "id: {minion_id}" >> /etc/salt/minion.d/dask-ec2.conf'
+                ' && echo "{minion_id}" > /etc/salt/minion_id').format(master_ip=master_ip, minion_id=minion_id)
+
+    def __remote_cmd(command):
+        ret = instance.ssh_client.exec_command(command, sudo=True, tail=OUTPUT_TAIL)
         if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+            raise Exception(ret["stderr"])
 
-    try:
-        __restart_salt_master()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't restart salt-master service. Error is above (maybe try again)" %
-                               e.last_exception)
+    def __configure():
+        instance.ssh_client.put_tar([(mine_conf, "mine.conf")], "/etc/salt/minion.d", sudo=True, run=identity)
 
-    @retry(retries=3, wait=0)
-    def __restart_salt_api():
-        cmd = "service salt-api restart"
-        ret = master.exec_command(cmd, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
+    pipeline = [("bootstrap", lambda: __remote_cmd(bootstrap)),
+                ("configure", __configure),
+                ("restart", lambda: __remote_cmd("service salt-minion restart"))]
 
-    try:
-        __restart_salt_api()
-    except RetriesExceededException as e:
-        raise DaskEc2Exception("%s\nCouldn't restart salt-api service. Error is above (maybe try again)" %
-                               e.last_exception)
+    ret = {"ip": instance.ip, "minion_id": minion_id, "steps": [], "failed_step": None, "error": None}
+    for name, function in pipeline:
+        start = time.time()
+        try:
+            retry(retries=3, wait=0)(function)()
+        except RetriesExceededException as e:
+            ret["failed_step"], ret["error"] = name, e.last_exception
+            logger.debug("Step '%s' failed on node %s: %s", name, instance.ip, e.last_exception)
+            break
+        finally:
+            ret["steps"].append({"name": name, "seconds": time.time() - start})
+    ret["seconds"] = sum(step["seconds"] for step in ret["steps"])
+    return ret
+
+
+def install_node_minion(cluster, i):
+    """Install salt-minion on the i-th node of the cluster as ``node-<i>``
+
+    Only needs the IP of the head node, the minion keeps trying to connect
+    until salt-master is running. Minions connect to the master over its
+    private IP so the salt traffic stays inside the VPC.
+    """
+    dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
+    mine_conf = os.path.join(dask_ec2_src, "templates", "mine_functions.conf")
+    return _install_minion(cluster.instances[i], "node-{}".format(i), cluster.instances[0].cluster_ip, mine_conf)
 
 
-def async_cmd(results, instance, command):
-    client = instance.ssh_client
+def install_salt_minion(cluster):
+    """Install salt-minion on all the nodes
 
-    @retry(retries=3, wait=0)
-    def __remote_cmd():
-        ret = client.exec_command(command, sudo=True)
-        if ret["exit_code"] != 0:
-            raise Exception(ret["stderr"].decode('utf-8'))
-        return ret
+    Each node runs its own bootstrap -> configure -> restart pipeline on the
+    cluster executor, so a slow node doesn't hold back the others between
+    steps.
 
-    try:
-        results[instance.ip] = __remote_cmd()
-    except RetriesExceededException:
-        results[instance.ip] = False
+    Returns
+    -------
+        List with the result of every node, see ``_install_minion``
+    """
+    logger.debug("Installing salt-minion on all the nodes")
 
+    def __install(args):
+        i, instance = args
+        return install_node_minion(cluster, i)
 
-def async_upload(results, instance, local, remote):
-    client = instance.ssh_client
+    tasks = cluster.executor().map(__install, list(enumerate(cluster.instances)), key=lambda args: args[1].ip)
+    results = []
+    for ip, task in tasks.items():
+        if task.success:
+            results.append(task.output)
+        else:
+            results.append({"ip": ip, "minion_id": None, "steps": [], "failed_step": "pipeline",
+                            "error": task.error, "seconds": task.duration})
 
-    @retry(retries=3, wait=0)
-    def __remote_upload():
-        client.put(local, remote, sudo=True)
-        return True
+    for result in results:
+        logger.debug("Node %s salt-minion steps: %s", result["ip"],
+                     ", ".join("{name}={seconds:.1f}s".format(**step) for step in result["steps"]))
 
-    try:
-        results[instance.ip] = __remote_upload()
-    except RetriesExceededException:
-        results[instance.ip] = False
+    failed_nodes = ["%s (%s)" % (result["ip"], result["failed_step"]) for result in results if result["failed_step"]]
+    if failed_nodes:
+        raise DaskEc2Exception("Error installing salt-minion at nodes: %s (maybe try again)" % ", ".join(failed_nodes))
+    return results
 
 
-def install_salt_minion(cluster):
-    dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
-    templates_src = os.path.join(dask_ec2_src, "templates")
+def bake_cleanup(cluster, install_prefix="/opt/anaconda"):
+    """Prepare the head node to be turned into an image by ``dask-ec2 bake``
 
-    logger.debug("Installing salt-minion on all the nodes")
-    results, threads = {}, []
-    master_ip = cluster.instances[0].ip
-    for i, instance in enumerate(cluster.instances):
-        minion_id = "node-{}".format(i)
-        cmd = "curl -L https://bootstrap.saltstack.com | sh -s -- "
-        cmd += "-d -X -P -L -A {master_ip} -i {minion_id} stable".format(master_ip=master_ip, minion_id=minion_id)
-        t = threading.Thread(target=async_cmd, args=(results, instance, cmd))
-        t.start()
-        threads.append(t)
-    for t in threads:
-        t.join()
-
-    all_ok = all([r is False for r in results])
-    if not all_ok:
-        failed_nodes = []
-        for minion_ip, minion_data in results.items():
-            if minion_data is False:
-                failed_nodes.append(minion_ip)
-        if failed_nodes:
-            raise DaskEc2Exception("Error bootstrapping salt-minion at nodes: %s (maybe try again)" % failed_nodes)
-
-    logger.debug("Configuring salt-mine on the salt minions")
-    results, threads = {}, []
-    for i, instance in enumerate(cluster.instances):
-        local = os.path.join(templates_src, "mine_functions.conf")
-        remote = "/etc/salt/minion.d/mine.conf"
-        t = threading.Thread(target=async_upload, args=(results, instance, local, remote))
-        t.start()
-        threads.append(t)
-    for t in threads:
-        t.join()
-
-    all_ok = all([r is False for r in results])
-    if not all_ok:
-        failed_nodes = []
-        for minion_ip, minion_data in results.items():
-            if minion_data is False:
-                failed_nodes.append(minion_ip)
-        if failed_nodes:
-            raise DaskEc2Exception("Error configuring the salt-mine in the salt-minion at nodes: %s (maybe try again)" %
-                                   failed_nodes)
-
-    logger.debug("Restarting the salt-minion service")
-    results, threads = {}, []
-    for i, instance in enumerate(cluster.instances):
-        cmd = "service salt-minion restart"
-        t = threading.Thread(target=async_cmd, args=(results, instance, cmd))
-        t.start()
-        threads.append(t)
-    for t in threads:
-        t.join()
-
-    all_ok = all([r is False for r in results])
-    if not all_ok:
-        failed_nodes = []
-        for minion_ip, minion_data in results.items():
-            if minion_data is False:
-                failed_nodes.append(minion_ip)
-        if failed_nodes:
-            raise DaskEc2Exception("Error restarting the salt-minion at nodes: %s (maybe try again)" % failed_nodes)
+    Stops salt, removes the salt identity and keys of the node and the
+    installation caches.
+    """
+    dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
+    script = os.path.join(dask_ec2_src, "templates", "bake_cleanup.sh")
+    run = "bash /tmp/dask-ec2-bake/bake_cleanup.sh {}".format(install_prefix)
+    client = cluster.instances[0].ssh_client
+    return client.put_tar([(script, "bake_cleanup.sh")], "/tmp/dask-ec2-bake", sudo=True, run=run)
 
 
 def upload_formulas(cluster):
+    """Sync the salt formulas and pillars to the head node
+
+    Only new or modified files are transferred. Pillars are never deleted
+    remotely since the CLI uploads generated pillars (``upload_pillar``) to
+    the same directory. ``dask_ec2/tuning.py`` is uploaded as the
+    ``dask_tuning`` execution module and synced to the minions, the states
+    use it for the ``auto`` dask-worker layout.
+    """
     dask_ec2_src = os.path.realpath(os.path.dirname(dask_ec2.__file__))
     src_salt_root = os.path.join(dask_ec2_src, "formulas", "salt")
     src_pillar_root = os.path.join(dask_ec2_src, "formulas", "pillar")
     dst_salt_root = "/srv/salt"
     dst_pillar_root = "/srv/pillar"
+    modules = {"_modules/dask_tuning.py": os.path.join(dask_ec2_src, "tuning.py")}
 
     client = cluster.instances[0].ssh_client
-    client.put(src_salt_root, dst_salt_root, sudo=True)
-    client.put(src_pillar_root, dst_pillar_root, sudo=True)
+    ret = {}
+    ret["salt"] = client.sync_dir(src_salt_root, dst_salt_root, sudo=True, extra=modules)
+    ret["pillar"] = client.sync_dir(src_pillar_root, dst_pillar_root, sudo=True, delete=False)
+    cluster.salt_call("*", "saltutil.sync_modules")
+    return ret
 
 
 def upload_pillar(cluster, name, data):
@@ -2,21 +2,49 @@
 Small wrapper around paramiko.SSHClient
 """
 import os
+import re
 import time
+import select
+import socket
+import hashlib
 import logging
+import tarfile
 import posixpath
+import threading
+from collections import OrderedDict, deque
 from socket import gaierror as sock_gaierror, error as sock_error
 
+from six.moves import shlex_quote
+
 from .exceptions import DaskEc2Exception
 
 import paramiko
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_KEEPALIVE = 30
+DEFAULT_MAX_CONNECTIONS = 256
+RECV_BUFFER_SIZE = 32768
+
+
+def wrap_command(command, sudo=False):
+    """Command line that runs ``command`` in ``bash -c``, with sudo if needed
+
+    The command is quoted, so it can have single quotes of its own.
+    """
+    if sudo:
+        return "sudo -S bash -c %s" % shlex_quote(command)
+    return "bash -c %s" % shlex_quote(command)
+
+
+def _channel_in_use(channel):
+    return not channel.closed or channel.recv_ready() or channel.recv_stderr_ready()
+
 
 class SSHClient(object):
 
-    def __init__(self, host, username=None, password=None, pkey=None, port=22, timeout=15, connect=True):
+    def __init__(self, host, username=None, password=None, pkey=None, port=22, timeout=15, connect=True,
+                 keepalive=DEFAULT_KEEPALIVE):
         self.host = host
         self.username = username
         self.password = password
@@ -33,10 +61,14 @@ class SSHClient(object):
             self.pkey = None
         self.port = port
         self.timeout = timeout
+        self.keepalive = keepalive
 
         self.client = paramiko.SSHClient()
         self.client.set_missing_host_key_policy(paramiko.MissingHostKeyPolicy())
         self._sftp = None
+        self._connect_lock = threading.Lock()
+        # Command channels, to know if the client is in use
+        self._channels = []
 
         if connect:
             self.connect()
@@ -60,43 +92,90 @@ class SSHClient(object):
         except paramiko.SSHException as e:
             raise DaskEc2Exception("General SSH error - %s" % e)
 
+        if self.keepalive:
+            self.client.get_transport().set_keepalive(self.keepalive)
+
     def close(self):
+        self._sftp = None
+        self._channels = []
         self.client.close()
 
-    def exec_command(self, command, sudo=False, **kwargs):
-        """Wrapper to paramiko.SSHClient.exec_command
+    def is_active(self):
+        """Return True if the underlying transport is connected
         """
-        channel = self.client.get_transport().open_session()
-        # stdin = channel.makefile('wb')
-        stdout = channel.makefile('rb')
-        stderr = channel.makefile_stderr('rb')
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
 
-        if sudo:
-            command = 'sudo -S bash -c \'%s\'' % command
-        else:
-            command = 'bash -c \'%s\'' % command
+    def is_busy(self):
+        """Return True if a command is running or its output was not read yet
+        """
+        self._channels = [channel for channel in self._channels if _channel_in_use(channel)]
+        return len(self._channels) > 0
+
+    def get_transport(self):
+        """Return the open transport, (re)connecting if it is not active
+        """
+        with self._connect_lock:
+            if not self.is_active():
+                if self.client.get_transport() is not None:
+                    logger.debug("Transport to '%s' is not active, reconnecting", self.host)
+                    self.close()
+                self.connect()
+        return self.client.get_transport()
+
+    def open_command(self, command, sudo=False, **kwargs):
+        """Start command on a new channel and return the channel
+        """
+        channel = self.get_transport().open_session()
+        command = wrap_command(command, sudo=sudo)
+        self._channels = [c for c in self._channels if _channel_in_use(c)] + [channel]
 
         logger.debug("Running command %s on '%s'", command, self.host)
         channel.exec_command(command, **kwargs)
+        return channel
 
-        while not (channel.recv_ready() or channel.closed or channel.exit_status_ready()):
-            time.sleep(.2)
+    def iter_command(self, command, sudo=False, timeout=None, **kwargs):
+        """Run command and return a CommandStream over its output lines
+        """
+        channel = self.open_command(command, sudo=sudo, **kwargs)
+        return CommandStream(channel, host=self.host, timeout=timeout)
+
+    def exec_command(self, command, sudo=False, callback=None, tail=None, timeout=None, **kwargs):
+        """Wrapper to paramiko.SSHClient.exec_command
+
+        Parameters
+        ----------
+        callback : callable, optional
+            Called as ``callback(stream, line)`` for every line of output as it
+            arrives, ``stream`` is ``'stdout'`` or ``'stderr'``
+        tail : int, optional
+            Only keep the last ``tail`` lines of each stream, by default all
+            the output is kept
+        timeout : float, optional
+            Seconds to wait for new output before giving up
+        """
+        stream = self.iter_command(command, sudo=sudo, timeout=timeout, **kwargs)
+        output = {'stdout': deque(maxlen=tail), 'stderr': deque(maxlen=tail)}
+        for name, line in stream:
+            output[name].append(line)
+            if callback is not None:
+                callback(name, line)
 
         ret = {
-            'stdout': stdout.read().strip().decode('utf-8'),
-            'stderr': stderr.read().strip().decode('utf-8'),
-            'exit_code': channel.recv_exit_status()
+            'stdout': '\n'.join(output['stdout']).strip(),
+            'stderr': '\n'.join(output['stderr']).strip(),
+            'exit_code': stream.exit_code
         }
         return ret
 
     def get_sftp(self):
-        if self._sftp is None:
+        if self._sftp is None or not self.is_active():
             self._sftp = self.make_sftp()
         return self._sftp
 
     def make_sftp(self):
         """Make SFTP client from open transport"""
-        transport = self.client.get_transport()
+        transport = self.get_transport()
         transport.open_session()
         return paramiko.SFTPClient.from_transport(transport)
 
@@ -144,30 +223,377 @@ class SSHClient(object):
         self.sftp.put(local, remote)
 
         if sudo:
-            cmd = 'cp -rf {} {}'.format(remote, real_remote)
+            cmd = 'cp -rf {} {}'.format(remote, shlex_quote(real_remote))
             self.exec_command(cmd, sudo=True)
             cmd = 'rm -rf {}'.format(remote)
             self.exec_command(cmd, sudo=True)
 
-    def put_dir(self, local, remote, sudo=False):
+    def put_dir(self, local, remote, sudo=False, compress=True):
+        """Upload the contents of the local directory into remote
+
+        The directory is sent as a single tar stream, see ``put_tar``.
+        """
         logger.debug("Uploading directory %s to %s", local, remote)
+        sources = [(os.path.join(local, item), item) for item in sorted(os.listdir(local))]
+        return self.put_tar(sources, remote, sudo=sudo, compress=compress)
 
-        self.exec_command("mkdir -p {}".format(remote), sudo=True)
+    def put_tar(self, sources, remote, sudo=False, compress=True, run=None, callback=None):
+        """Upload files and directories in one round trip
 
-        if sudo:
-            real_remote = remote
-            remote = '/tmp/.__tmp_copy'
+        A tar archive is streamed over a single exec channel into
+        ``tar -x -C <remote>``, so the number of round trips does not depend
+        on the number of files.
+
+        Parameters
+        ----------
+        sources : list of tuples
+            ``(local_path, arcname)`` pairs, ``arcname`` is the path relative
+            to ``remote``. Directories are added recursively.
+        remote : str
+            Remote directory, created if it doesn't exist
+        compress : bool
+            Gzip the stream
+        run : str, optional
+            Command to execute in the same session after the extraction
+        callback : callable, optional
+            Called as ``callback(stream, line)`` for every line of output,
+            see ``exec_command``
+
+        Returns
+        -------
+            dict with ``bytes_sent`` and ``seconds``
+        """
+        start = time.time()
+        flags = "-xzf" if compress else "-xf"
+        command = "mkdir -p {0} && tar {1} - -C {0} --no-same-owner".format(shlex_quote(remote), flags)
+        if run:
+            command = "{} && {}".format(command, run)
+        channel = self.open_command(command, sudo=sudo)
+
+        writer = ChannelWriter(channel)
+        archive = tarfile.open(fileobj=writer, mode="w|gz" if compress else "w|")
+        try:
+            for local, arcname in sources:
+                archive.add(local, arcname=arcname)
+        finally:
+            archive.close()
+        channel.shutdown_write()
+
+        stderr = deque(maxlen=100)
+        for name, line in CommandStream(channel, host=self.host):
+            if name == 'stderr':
+                stderr.append(line)
+            if callback is not None:
+                callback(name, line)
+        exit_code = channel.recv_exit_status()
+        if exit_code != 0:
+            raise DaskEc2Exception("Error running upload command in '%s:%s'\n%s" %
+                                   (self.host, remote, '\n'.join(stderr)))
+
+        ret = {'bytes_sent': writer.bytes_sent, 'seconds': time.time() - start}
+        logger.debug("Uploaded %i bytes to %s:%s in %.2f seconds", ret['bytes_sent'], self.host, remote,
+                     ret['seconds'])
+        return ret
+
+    def remote_manifest(self, remote, sudo=False):
+        """Return a ``{relative_path: sha1}`` dict of the files under remote
+
+        The hashes are computed remotely in a single command, an empty dict is
+        returned if remote doesn't exist.
+        """
+        command = "if [ -d {0} ]; then cd {0} && find . -type f -exec sha1sum {{}} +; fi".format(shlex_quote(remote))
+        ret = self.exec_command(command, sudo=sudo)
+        if ret['exit_code'] != 0:
+            raise DaskEc2Exception("Error listing files in '%s:%s'\n%s" % (self.host, remote, ret['stderr']))
+        return parse_sha1sum(ret['stdout'])
+
+    def sync_dir(self, local, remote, sudo=False, delete=True, compress=True, extra=None):
+        """Make remote match the local directory transferring only the differences
+
+        Files are compared by content hash: new or modified files are sent in
+        one tar stream (see ``put_tar``) and, if ``delete`` is True, remote
+        files that don't exist locally are removed. ``extra`` is a
+        ``{relative_path: local_path}`` dict of files from outside ``local``
+        to sync as if they were in it.
+
+        Returns
+        -------
+            dict with the ``transferred`` and ``deleted`` paths, the number of
+            ``skipped`` (unchanged) files and ``bytes_sent``
+        """
+        extra = extra or {}
+        local_files = local_manifest(local)
+        for path, local_path in extra.items():
+            local_files[path] = _sha1(local_path)
+        remote_files = self.remote_manifest(remote, sudo=sudo)
+
+        transferred = sorted(path for path, digest in local_files.items() if remote_files.get(path) != digest)
+        deleted = sorted(set(remote_files) - set(local_files)) if delete else []
+
+        ret = {'transferred': transferred,
+               'deleted': deleted,
+               'skipped': len(local_files) - len(transferred),
+               'bytes_sent': 0}
+
+        if transferred:
+            sources = [(extra.get(path) or os.path.join(local, *path.split('/')), path) for path in transferred]
+            ret['bytes_sent'] = self.put_tar(sources, remote, sudo=sudo, compress=compress)['bytes_sent']
+        if deleted:
+            paths = ' '.join(shlex_quote(path) for path in deleted)
+            self.exec_command("cd {} && rm -f -- {}".format(shlex_quote(remote), paths), sudo=sudo)
+
+        logger.debug("Synced %s to %s:%s - %i transferred, %i skipped, %i deleted", local, self.host, remote,
+                     len(transferred), ret['skipped'], len(deleted))
+        return ret
+
+
+def parse_sha1sum(output):
+    """Return a ``{relative_path: sha1}`` dict from the output of ``sha1sum`` run on ``./`` paths
+
+    sha1sum starts the line with a backslash and escapes the backslashes,
+    newlines (and carriage returns in recent versions) of the file name if
+    it has any of them.
+    """
+    escapes = {'\\': '\\', 'n': '\n', 'r': '\r'}
+    manifest = {}
+    # Not splitlines, file names can have other line boundaries such as \x1c
+    for line in output.split('\n'):
+        if not line:
+            continue
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        digest, path = line[:40], line[42:]
+        if escaped:
+            path = re.sub(r'\\(.)', lambda match: escapes.get(match.group(1), match.group(0)), path)
+        if path.startswith('./'):
+            path = path[2:]
+        manifest[path] = digest
+    return manifest
 
-        self.mkdir(remote)
-        for item in os.listdir(local):
-            if os.path.isfile(os.path.join(local, item)):
-                self.put(os.path.join(local, item), '%s/%s' % (remote, item))
+
+def local_manifest(local):
+    """Return a ``{relative_path: sha1}`` dict of the files under local
+
+    Paths use ``/`` as separator to match the remote manifest.
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(local):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, local).replace(os.sep, '/')
+            manifest[relpath] = _sha1(path)
+    return manifest
+
+
+def _sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def wait_for_port(host, port=22, timeout=300, connect_timeout=2, initial_wait=0.5, max_wait=10):
+    """Wait until a TCP port accepts connections
+
+    Probes with a plain TCP connect (no SSH handshake) backing off
+    exponentially between attempts.
+
+    Returns
+    -------
+        Seconds until the port was open
+
+    Raises
+    ------
+        DaskEc2Exception if the port is not open after timeout seconds
+    """
+    start = time.time()
+    wait = initial_wait
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(connect_timeout)
+        try:
+            if sock.connect_ex((host, port)) == 0:
+                return time.time() - start
+        except socket.error as e:
+            logger.debug("Error probing '%s:%s': %s", host, port, e)
+        finally:
+            sock.close()
+
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            raise DaskEc2Exception("Port %s on host '%s' not open after %i seconds" % (port, host, timeout))
+        time.sleep(min(wait, timeout - elapsed))
+        wait = min(wait * 2, max_wait)
+
+
+class ChannelWriter(object):
+    """Write-only file object that sends data over a channel and counts it
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.bytes_sent = 0
+
+    def write(self, data):
+        self.channel.sendall(data)
+        self.bytes_sent += len(data)
+        return len(data)
+
+
+class CommandStream(object):
+    """Iterate over the output of a remote command as it arrives
+
+    Yields ``(stream, line)`` tuples where stream is ``'stdout'`` or
+    ``'stderr'``. The channel is waited on with ``select`` so lines are
+    delivered as soon as they are received, without polling. ``exit_code`` is
+    available once the iteration is finished.
+    """
+
+    def __init__(self, channel, host=None, timeout=None):
+        self.channel = channel
+        self.host = host
+        self.timeout = timeout
+
+    def __iter__(self):
+        channel = self.channel
+        readers = [('stdout', channel.recv_ready, channel.recv),
+                   ('stderr', channel.recv_stderr_ready, channel.recv_stderr)]
+        partial = {'stdout': b'', 'stderr': b''}
+
+        while True:
+            readable, _, _ = select.select([channel], [], [], self.timeout)
+            if not readable:
+                channel.close()
+                raise DaskEc2Exception("Timed out waiting for command output from '%s'" % self.host)
+
+            received = False
+            for name, ready, recv in readers:
+                while ready():
+                    data = recv(RECV_BUFFER_SIZE)
+                    received = True
+                    lines = (partial[name] + data).split(b'\n')
+                    partial[name] = lines.pop()
+                    for line in lines:
+                        yield name, line.decode('utf-8', 'replace')
+
+            if not received and (channel.eof_received or channel.closed):
+                break
+
+        for name, _, _ in readers:
+            if partial[name]:
+                yield name, partial[name].decode('utf-8', 'replace')
+
+    def get_exit_code(self):
+        return self.channel.recv_exit_status()
+
+    exit_code = property(get_exit_code, None, None)
+
+
+class SSHPool(object):
+    """Pool of open SSHClients keyed by ``(host, port, username)``
+
+    Clients are kept open (with transport keepalives) and handed out again on
+    the next request for the same key, so a CLI invocation only pays one
+    handshake per node. Dead transports are reconnected transparently and at
+    most ``max_connections`` clients are kept open, closing the least
+    recently used idle one when the cap is reached. Clients that are running
+    a command are never closed, so the pool can go over the cap while more
+    than ``max_connections`` nodes are being worked on, see ``reserve``.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, keepalive=DEFAULT_KEEPALIVE):
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"new": 0, "reused": 0, "reconnected": 0, "evicted": 0}
+
+    def get(self, host, username=None, password=None, pkey=None, port=22, timeout=15):
+        """Get a connected SSHClient for host, creating it if needed
+        """
+        key = (host, port, username)
+        with self._lock:
+            client = self._clients.pop(key, None)
+            if client is not None and (client.host, client.port, client.username) != key:
+                # Client was modified after being handed out, don't trust it
+                client.close()
+                client = None
+
+            if client is None:
+                client = SSHClient(host, username=username, password=password, pkey=pkey, port=port,
+                                   timeout=timeout, connect=False, keepalive=self.keepalive)
+                self.stats["new"] += 1
+            elif client.is_active():
+                self.stats["reused"] += 1
             else:
-                self.mkdir('%s/%s' % (remote, item))
-                self.put_dir(os.path.join(local, item), '%s/%s' % (remote, item))
+                self.stats["reconnected"] += 1
+            self._clients[key] = client
+            self._evict()
 
-        if sudo:
-            cmd = 'cp -rf {}/* {}'.format(remote, real_remote)
-            self.exec_command(cmd, sudo=True)
-            cmd = 'rm -rf {}'.format(remote)
-            self.exec_command(cmd, sudo=True)
+        # Connect outside of the pool lock so handshakes to different hosts run in parallel
+        try:
+            client.get_transport()
+        except DaskEc2Exception:
+            self.discard(client)
+            raise
+        return client
+
+    def _evict(self):
+        excess = len(self._clients) - self.max_connections
+        # The last client is the one just requested
+        for key, client in list(self._clients.items())[:-1]:
+            if excess <= 0:
+                break
+            if client.is_busy():
+                continue
+            del self._clients[key]
+            logger.debug("SSH pool is full, closing connection to '%s'", key[0])
+            client.close()
+            self.stats["evicted"] += 1
+            excess -= 1
+        if excess > 0:
+            logger.debug("SSH pool is over its limit of %i connections, %i more are in use",
+                         self.max_connections, excess)
+
+    def reserve(self, connections):
+        """Keep at least ``connections`` clients open, e.g. the number of nodes worked on in parallel
+        """
+        with self._lock:
+            self.max_connections = max(self.max_connections, connections)
+
+    def discard(self, client):
+        """Remove a client from the pool and close it
+        """
+        key = (client.host, client.port, client.username)
+        with self._lock:
+            if self._clients.get(key) is client:
+                del self._clients[key]
+        client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+_pool = None
+
+
+def get_pool(max_connections=None):
+    """Return the process wide SSHPool
+
+    Parameters
+    ----------
+    max_connections : int, optional
+        Keep at least this many clients open, see ``SSHPool.reserve``
+    """
+    global _pool
+    if _pool is None:
+        _pool = SSHPool()
+    if max_connections:
+        _pool.reserve(max_connections)
+    return _pool
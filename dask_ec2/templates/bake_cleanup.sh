@@ -0,0 +1,25 @@
+#!/bin/bash
+# Clean up an instance provisioned by `dask-ec2 bake` before creating an image.
+#
+# Nodes launched from the image bootstrap their own salt-minion identity and
+# only the head node runs salt-master and salt-api.
+
+INSTALL_PREFIX="${1:-/opt/anaconda}"
+
+for service in salt-minion salt-master salt-api; do
+    service ${service} stop || true
+done
+
+for service in salt-master salt-api; do
+    if command -v systemctl &>/dev/null; then
+        systemctl disable ${service} || true
+    else
+        update-rc.d ${service} disable || true
+    fi
+done
+
+rm -rf /etc/salt/pki /etc/salt/minion_id /etc/salt/grains /etc/salt/minion.d/* /var/cache/salt
+rm -rf /srv/salt /srv/pillar /tmp/dask-ec2-master /tmp/anaconda.sh
+
+"${INSTALL_PREFIX}/bin/conda" clean -tipsy -q || true
+apt-get clean || true
@@ -0,0 +1,69 @@
+#!/bin/bash
+# Idempotent setup of salt-master and salt-api on the head node.
+#
+# Uploaded together with the master.d configuration files and executed in a
+# single SSH session by dask_ec2.salt.install_salt_master. The "@@dask-ec2"
+# lines are progress markers used to report per step timings and failures.
+
+BUNDLE_DIR="$(cd "$(dirname "$0")" && pwd)"
+
+step() {
+    local name="$1"
+    shift
+    echo "@@dask-ec2 start ${name}"
+    "$@"
+    local rc=$?
+    echo "@@dask-ec2 end ${name} ${rc}"
+    if [ ${rc} -ne 0 ]; then
+        exit ${rc}
+    fi
+}
+
+configure() {
+    mkdir -p /etc/salt/master.d && cp -f "${BUNDLE_DIR}"/master.d/*.conf /etc/salt/master.d/
+}
+
+create_saltdev_user() {
+    id -u saltdev &>/dev/null || useradd -p $(openssl passwd -1 saltdev) saltdev
+}
+
+bootstrap() {
+    if command -v salt-master &>/dev/null && command -v salt-api &>/dev/null; then
+        echo "salt-master and salt-api are already installed"
+        return 0
+    fi
+    # One bootstrap run installs salt-master, salt-api and the build
+    # dependencies for the pip packages in the same apt transaction
+    curl -sS -L https://bootstrap.saltstack.com -o /tmp/bootstrap-salt.sh \
+        && sh /tmp/bootstrap-salt.sh -d -X -M -N -P -L \
+            -p salt-api -p python-pip -p libssl-dev -p libffi-dev -p python-dev stable
+}
+
+pip_installs() {
+    pip install --upgrade pip packaging appdirs six cherrypy PyOpenSSL==16.2.0
+}
+
+create_ssl_cert() {
+    test -e /etc/pki/tls/certs/localhost.crt || salt-call --local tls.create_self_signed_cert
+}
+
+enable_service() {
+    # Images created with `dask-ec2 bake` have the services disabled
+    if command -v systemctl &>/dev/null; then
+        systemctl enable "$1" || true
+    else
+        update-rc.d "$1" enable || true
+    fi
+}
+
+restart_services() {
+    enable_service salt-master && enable_service salt-api \
+        && service salt-master restart && service salt-api restart
+}
+
+step configure configure
+step create-saltdev-user create_saltdev_user
+step bootstrap bootstrap
+step pip-installs pip_installs
+step create-ssl-cert create_ssl_cert
+step restart-services restart_services
@@ -0,0 +1,62 @@
+"""
+Time a GIL-bound and a GIL-releasing workload on a local cluster with every
+``nprocs x nthreads`` layout given as JSON in the first argument.
+
+Run by ``dask-ec2 dask-distributed tune`` on a worker node, prints a JSON list
+with the ``nprocs``, ``nthreads``, ``gil_seconds`` and ``nogil_seconds`` of
+every layout in a single line.
+"""
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import time
+
+# One BLAS thread per task, the threads are the ones of the layout
+for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ[var] = "1"
+
+from distributed import Client, LocalCluster  # noqa
+
+
+def gil_task(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def nogil_task(n):
+    import numpy as np
+    x = np.random.RandomState(n).random_sample((n, n))
+    return float(np.dot(x, x).sum())
+
+
+def timed(client, function, args):
+    start = time.time()
+    client.gather(client.map(function, args, pure=False))
+    return time.time() - start
+
+
+def main(layouts, tasks_per_cpu=4, gil_size=2000000, nogil_size=1000):
+    results = []
+    for nprocs, nthreads in layouts:
+        cluster = LocalCluster(n_workers=nprocs, threads_per_worker=nthreads, processes=True)
+        client = Client(cluster)
+        try:
+            ntasks = tasks_per_cpu * nprocs * nthreads
+            # Warm up the workers
+            timed(client, gil_task, [1] * ntasks)
+            results.append({"nprocs": nprocs,
+                            "nthreads": nthreads,
+                            "gil_seconds": timed(client, gil_task, [gil_size] * ntasks),
+                            "nogil_seconds": timed(client, nogil_task, [nogil_size] * ntasks)})
+        finally:
+            client.close()
+            cluster.close()
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main(json.loads(sys.argv[1]))
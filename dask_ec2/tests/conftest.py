@@ -4,8 +4,10 @@ import os
 import pytest
 
 
-@pytest.yield_fixture(scope="module")
+@pytest.yield_fixture()
 def driver():
+    # Not shared between tests: the driver memoizes lookups and every
+    # mock_ec2 test starts with new resources
     from dask_ec2.ec2 import EC2
     driver = EC2(region="us-east-1", default_vpc=False, default_subnet=False, test=False)
 
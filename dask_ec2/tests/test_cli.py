@@ -0,0 +1,120 @@
+from __future__ import absolute_import, print_function, division
+
+import os
+import stat
+
+from .utils import run_wrapped
+
+
+def fake_python(tmpdir):
+    """``<prefix>/bin/python`` that prints its second argument, e.g. the script given with ``-c``"""
+    bin_dir = tmpdir.mkdir("bin")
+    python = bin_dir.join("python")
+    python.write('#!/bin/sh\nprintf "%s" "$2"\n')
+    os.chmod(python.strpath, os.stat(python.strpath).st_mode | stat.S_IEXEC)
+    return tmpdir.strpath
+
+
+def test_workers_command(tmpdir):
+    from dask_ec2.cli.daskd import WORKERS_SCRIPT, workers_command
+    exit_code, stdout = run_wrapped(workers_command(fake_python(tmpdir)))
+    assert exit_code == 0
+    assert stdout == WORKERS_SCRIPT
+    compile(stdout, "<check-network>", "exec")
+
+
+class FakeBoto3Instance(object):
+
+    def __init__(self, index):
+        self.id = "i-{}".format(index)
+        self.public_ip_address = "1.1.1.{}".format(index)
+        self.private_ip_address = "10.0.0.{}".format(index)
+
+
+class FakeDriver(object):
+    """EC2 driver that records the ENA checks and launches fake instances"""
+    ena_checks = []
+
+    def __init__(self, **kwargs):
+        pass
+
+    def check_enhanced_networking(self, instance_type, image_id=None):
+        self.ena_checks.append((instance_type, image_id))
+        return {"ena_support": "required", "network_performance": "100 Gigabit"}
+
+    def launch(self, count, first_index=0, **kwargs):
+        return [FakeBoto3Instance(first_index + i) for i in range(count)]
+
+
+def test_up_enhanced_networking(monkeypatch, tmpdir):
+    from collections import OrderedDict
+    from click.testing import CliRunner
+    import dask_ec2.ec2
+    import dask_ec2.salt
+    from dask_ec2 import Cluster
+    from dask_ec2.cli.main import cli
+
+    FakeDriver.ena_checks = []
+    monkeypatch.setattr(dask_ec2.ec2, "EC2", FakeDriver)
+    monkeypatch.setattr(Cluster, "wait_for_ssh", lambda self, timeout=300: OrderedDict())
+    info = {"interface": "ens5", "driver": "ena", "mtu": 9001, "speed": None, "ena": True, "jumbo": True}
+    checked = []
+
+    def network_info(cluster):
+        checked.append([instance.ip for instance in cluster.instances])
+        return OrderedDict((instance.ip, info) for instance in cluster.instances)
+
+    monkeypatch.setattr(dask_ec2.salt, "network_info", network_info)
+    keypair = tmpdir.join("key.pem")
+    keypair.write("")
+    filepath = tmpdir.join("cluster.yaml").strpath
+
+    result = CliRunner().invoke(cli, ["up", "--keyname", "key", "--keypair", keypair.strpath, "--count", "2",
+                                      "--type", "c5n.18xlarge", "--ami", "ami-123", "--enhanced-networking",
+                                      "--no-provision", "--file", filepath])
+    assert result.exit_code == 0, result.output
+    assert FakeDriver.ena_checks == [("c5n.18xlarge", "ami-123")]
+    # The network command ran on the launched nodes
+    assert checked == [["1.1.1.0", "1.1.1.1"]]
+    assert "ens5" in result.output
+
+
+def test_get_head_storage():
+    from dask_ec2.cli.main import get_head_storage, get_storage
+    worker = get_storage("gp3", 500, 6000, 500, ["1000:gp3"])
+
+    head = get_head_storage(worker, None, None, None, None, ())
+    assert head == worker
+
+    head = get_head_storage(worker, "gp2", 100, None, None, ())
+    assert head["volume_type"] == "gp2"
+    assert head["volume_size"] == 100
+    assert head["volume_iops"] is None
+    assert head["volume_throughput"] is None
+    assert head["data_volumes"] == worker["data_volumes"]
+
+    head = get_head_storage(worker, "io2", None, None, None, ["2000:st1"])
+    assert head["volume_iops"] == 6000
+    assert head["volume_throughput"] is None
+    assert [v["volume_type"] for v in head["data_volumes"]] == ["st1"]
+
+
+def test_tune_command(tmpdir):
+    import json
+    from dask_ec2.cli.daskd import tune_command
+    # The fake python prints its second argument, the layouts
+    layouts = [[1, 8], [2, 4], [8, 1]]
+    exit_code, stdout = run_wrapped(tune_command(fake_python(tmpdir), layouts))
+    assert exit_code == 0
+    assert json.loads(stdout) == layouts
+
+
+def test_print_state_nameless_failure(capsys):
+    from dask_ec2.cli.main import print_state
+    output = {"return": [{"node-0": [{"result": False, "comment": "Rendering failed"}],
+                          "node-1": {"cmd_|-dask-install_|-pip install dask_|-run": {"result": True, "comment": ""}}}]}
+    response = print_state(output)
+    assert not response.aggregated_success()
+    out = capsys.readouterr().out
+    assert "Failed states for 'node-0'" in out
+    assert "  unknown: Rendering failed" in out
@@ -143,3 +143,263 @@ def test_from_boto3(driver):
                               check_ami=False)
 
     Cluster.from_boto3_instances(region, instances)
+
+
+def test_wait_for_ssh(monkeypatch):
+    import time
+
+    def wait_for_ssh(self, timeout=300):
+        time.sleep(0.1)
+        if self.ip == "3.3.3.3":
+            raise DaskEc2Exception("not ready")
+        return float(self.ip[0])
+
+    monkeypatch.setattr(Instance, "wait_for_ssh", wait_for_ssh)
+    cluster = Cluster("foo", parallelism=10)
+    for i in range(3):
+        cluster.append(Instance(ip="{0}.{0}.{0}.{0}".format(i)))
+
+    start = time.time()
+    response = cluster.wait_for_ssh()
+    assert time.time() - start < 0.25
+    assert list(response.items()) == [("0.0.0.0:22", 0.0), ("1.1.1.1:22", 1.0), ("2.2.2.2:22", 2.0)]
+    assert cluster.check_ssh() == {"0.0.0.0:22": True, "1.1.1.1:22": True, "2.2.2.2:22": True}
+
+    cluster.append(Instance(ip="3.3.3.3"))
+    with pytest.raises(DaskEc2Exception) as excinfo:
+        cluster.wait_for_ssh()
+    assert "3.3.3.3:22" in str(excinfo.value)
+
+
+def test_wait_for_ssh_node_timeout(monkeypatch):
+    import time
+    import threading
+    hung = threading.Event()
+
+    def wait_for_ssh(self, timeout=300):
+        if self.ip == "1.1.1.1":
+            hung.wait(5)
+        return 0.0
+
+    monkeypatch.setattr(Instance, "wait_for_ssh", wait_for_ssh)
+    cluster = Cluster("foo", node_timeout=0.2)
+    for i in range(3):
+        cluster.append(Instance(ip="{0}.{0}.{0}.{0}".format(i)))
+
+    start = time.time()
+    try:
+        with pytest.raises(DaskEc2Exception) as excinfo:
+            cluster.wait_for_ssh()
+    finally:
+        hung.set()
+    assert time.time() - start < 1
+    assert "1.1.1.1:22" in str(excinfo.value)
+    assert "0.0.0.0:22" not in str(excinfo.value)
+
+
+def test_executor_settings():
+    cluster = Cluster("foo", parallelism=4, node_timeout=10, node_deadline=60)
+    executor = cluster.executor(retries=3)
+    assert (executor.parallelism, executor.timeout, executor.deadline, executor.retries) == (4, 10, 60, 3)
+    assert cluster.executor(timeout=1).timeout == 1
+
+
+def test_token_cache(tmpdir):
+    import time
+    fpath = tmpdir.join("cluster.yaml").strpath
+
+    cluster = Cluster("foo")
+    cluster.append(Instance(ip="1.1.1.1"))
+    assert cluster.token_filepath is None
+    cluster.to_file(fpath)
+
+    cluster = Cluster.from_filepath(fpath)
+    assert cluster.token_filepath == tmpdir.join(".cluster.yaml.token").strpath
+    assert cluster.load_token() is None
+
+    auth = {"token": "abc", "expire": time.time() + 3600}
+    cluster.save_token(auth)
+    assert Cluster.from_filepath(fpath).load_token() == auth
+
+    cluster.save_token({"token": "abc", "expire": time.time() + 10})
+    assert Cluster.from_filepath(fpath).load_token() is None
+
+
+def test_salt_call_login_again_on_401():
+    from dask_ec2.libpepper import PepperException
+
+    class FakePepper(object):
+        def __init__(self):
+            self.auth = {"token": "expired"}
+            self.calls = []
+
+        def login(self, username, password, eauth):
+            self.auth = {"token": "new"}
+            return self.auth
+
+        def local(self, target, module, args):
+            self.calls.append(self.auth["token"])
+            if self.auth["token"] == "expired":
+                raise PepperException("Authentication denied")
+            return {"return": [{"node-0": True}]}
+
+    cluster = Cluster("foo")
+    cluster.append(Instance(ip="1.1.1.1"))
+    cluster._pepper = FakePepper()
+    assert cluster.salt_call("*", "test.ping") == {"return": [{"node-0": True}]}
+    assert cluster._pepper.calls == ["expired", "new"]
+
+
+def test_record_timing(tmpdir):
+    fpath = tmpdir.join("cluster.yaml").strpath
+    cluster = Cluster("foo")
+    cluster.append(Instance(ip="1.1.1.1"))
+    assert cluster.record_timing("provision", 10) == {}
+    cluster.to_file(fpath)
+
+    cluster = Cluster.from_filepath(fpath)
+    cluster.record_timing("provision-multi-pass", 100)
+    timings = cluster.record_timing("provision-highstate", 60.5)
+    assert timings["provision-multi-pass"]["seconds"] == 100
+    assert timings["provision-highstate"]["seconds"] == 60.5
+    assert tmpdir.join(".cluster.yaml.timings").check()
+
+
+class FakeJobPepper(object):
+    """Pepper that returns one more minion every time a job is looked up"""
+
+    def __init__(self, *minions, **kwargs):
+        self.jobs = dict((str(i), job_minions) for i, job_minions in enumerate(minions, 123))
+        self.lookups = dict((jid, 0) for jid in self.jobs)
+        self.requests = []
+        self.started = 0
+        # Minions that never return and don't answer saltutil.find_job
+        self.offline = kwargs.get("offline", [])
+
+    def low(self, lowstate):
+        self.requests.append(lowstate)
+        ret = []
+        for chunk in lowstate:
+            if chunk["client"] == "local_async":
+                jid = str(123 + self.started)
+                self.started += 1
+                ret.append({"jid": jid, "minions": self.jobs[jid]})
+            elif chunk["client"] == "runner":
+                jid = chunk["jid"]
+                self.lookups[jid] += 1
+                minions = [m for m in self.jobs[jid][:self.lookups[jid] - 1] if m not in self.offline]
+                ret.append(dict((minion, {"state": {"result": True}}) for minion in minions))
+            elif chunk["fun"] == "saltutil.find_job":
+                ret.append(dict((minion, {"jid": chunk["arg"][0]}) for minion in chunk["tgt"]
+                                if minion not in self.offline))
+            else:
+                ret.append({chunk["tgt"]: chunk["fun"]})
+        return {"return": ret}
+
+
+def test_salt_call_async():
+    cluster = Cluster("foo")
+    cluster._pepper = FakeJobPepper(["node-0", "node-1"])
+    returned = []
+    output = cluster.salt_call_async("*", "state.sls", ["conda"], poll_interval=0,
+                                     callback=lambda minion_id, result: returned.append(minion_id))
+    assert returned == ["node-0", "node-1"]
+    assert output == {"return": [{"node-0": {"state": {"result": True}}, "node-1": {"state": {"result": True}}}]}
+    assert cluster._pepper.lookups["123"] == 3
+
+
+def test_salt_call_async_deadline():
+    from dask_ec2.exceptions import SaltTimeoutException
+    cluster = Cluster("foo")
+    cluster._pepper = FakeJobPepper(["node-0", "node-1", "node-2"])
+    with pytest.raises(SaltTimeoutException) as excinfo:
+        cluster.salt_call_async("*", "state.sls", ["conda"], poll_interval=0.1, deadline=0.05)
+    assert excinfo.value.jid == "123"
+    assert excinfo.value.missing == ["node-1", "node-2"]
+    assert list(excinfo.value.output["return"][0]) == ["node-0"]
+
+
+def test_salt_call_async_offline_minion():
+    from dask_ec2.cluster import MINION_DID_NOT_RETURN
+    cluster = Cluster("foo")
+    cluster._pepper = FakeJobPepper(["node-0", "node-1"], offline=["node-1"])
+    output = cluster.salt_jobs([("*", "state.sls", ["conda"])], poll_interval=0, find_job_interval=0)[0]
+    assert output == {"return": [{"node-0": {"state": {"result": True}}, "node-1": MINION_DID_NOT_RETURN}]}
+    find_jobs = [chunk for request in cluster._pepper.requests for chunk in request
+                 if chunk.get("fun") == "saltutil.find_job"]
+    # Not running in two consecutive checks
+    assert len(find_jobs) == 2
+    assert find_jobs[0]["tgt"] == ["node-0", "node-1"]
+    assert find_jobs[1]["tgt"] == ["node-1"]
+
+
+def test_salt_batch():
+    cluster = Cluster("foo")
+    cluster._pepper = FakeJobPepper()
+    batch = cluster.salt_batch()
+    first = batch.local("node-0", "grains.append", ["roles", "scheduler"])
+    second = batch.local("node-[1-9]*", "grains.append", ["roles", "worker"])
+    assert len(batch) == 2
+    outputs = batch.send()
+    assert len(cluster._pepper.requests) == 1
+    assert outputs[first] == {"return": [{"node-0": "grains.append"}]}
+    assert outputs[second] == {"return": [{"node-[1-9]*": "grains.append"}]}
+    assert len(batch) == 0
+    assert batch.send() == []
+
+
+def test_salt_jobs_single_round_trip():
+    cluster = Cluster("foo")
+    cluster._pepper = FakeJobPepper(["node-0"], ["node-1", "node-2"])
+    returned = []
+    outputs = cluster.salt_jobs([("node-0", "state.sls", ["dask.distributed.scheduler"]),
+                                 ("node-[1-9]*", "state.sls", ["dask.distributed.worker"])],
+                                poll_interval=0, callback=lambda minion_id, result: returned.append(minion_id))
+    assert sorted(returned) == ["node-0", "node-1", "node-2"]
+    assert list(outputs[0]["return"][0]) == ["node-0"]
+    assert sorted(outputs[1]["return"][0]) == ["node-1", "node-2"]
+    # One request starts both jobs, then every poll looks up the unfinished ones
+    requests = cluster._pepper.requests
+    assert [chunk["client"] for chunk in requests[0]] == ["local_async", "local_async"]
+    assert [len(request) for request in requests[1:]] == [2, 2, 1]
+
+
+def test_batches():
+    cluster = Cluster("foo")
+    for i in range(12):
+        cluster.append(Instance(ip="%i" % i))
+
+    assert cluster.get_minion_ids("node-0") == ["node-0"]
+    assert len(cluster.get_minion_ids("node-[1-9]*")) == 11
+    assert cluster.get_batches("*") == [cluster.get_minion_ids("*")]
+
+    batches = cluster.get_batches("node-[1-9]*", size=5)
+    assert [len(batch) for batch in batches] == [5, 5, 1]
+    assert sum(batches, []) == cluster.get_minion_ids("node-[1-9]*")
+
+    batches = cluster.get_batches("*", percent=25)
+    assert [len(batch) for batch in batches] == [3, 3, 3, 3]
+    assert [len(batch) for batch in cluster.get_batches("node-0", percent=10)] == [1]
+
+    with pytest.raises(DaskEc2Exception):
+        cluster.get_batches("*", size=2, percent=10)
+
+
+def test_classify_addresses():
+    cluster = Cluster("us-east-1")
+    for i in range(3):
+        cluster.append(Instance(ip="54.0.0.{}".format(i), private_ip="10.0.0.{}".format(i)))
+
+    rows = cluster.classify_addresses(["tcp://10.0.0.1:40123", "54.0.0.2:40123", "tcp://192.168.0.1:1"])
+    assert rows == [("tcp://10.0.0.1:40123", 1, "private"),
+                    ("54.0.0.2:40123", 2, "public"),
+                    ("tcp://192.168.0.1:1", None, "unknown")]
+
+
+def test_storage_serde():
+    cluster = Cluster("us-east-1")
+    cluster.append(Instance(ip="1.1.1.1"))
+    assert "storage" not in cluster.to_dict()
+
+    cluster.storage = {"head": {"volume_type": "gp3"}, "worker": {"volume_type": "io2", "volume_iops": 10000}}
+    assert Cluster.from_dict(cluster.to_dict()).storage == cluster.storage
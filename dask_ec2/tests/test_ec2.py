@@ -148,3 +148,179 @@ def test_check_sg(driver):
     assert ("Security group 'ANOTHER_FAKE_SG' not found, "
             "please create or use the default "
             "'dask-ec2-default'") == str(e.value)
+
+
+@mock_ec2
+def test_create_image(driver):
+    instances = driver.ec2.create_instances(ImageId=ami, MinCount=1, MaxCount=1)
+    assert not driver.image_exists("ami-12345678")
+
+    image_id = driver.create_image(instances[0].id, "dask-ec2-test")
+    assert driver.image_exists(image_id)
+    image = driver.client.describe_images(ImageIds=[image_id])["Images"][0]
+    assert image["Name"] == "dask-ec2-test"
+
+
+@mock_ec2
+def test_launch_tag_specifications(driver):
+    driver.ec2.create_key_pair(KeyName=keyname)
+    instances = driver.launch(name=name,
+                              image_id=ami,
+                              instance_type=instance_type,
+                              count=count,
+                              keyname=keyname,
+                              security_group_name=DEFAULT_SG_GROUP_NAME,
+                              keypair=keypair,
+                              check_ami=False,
+                              tags=tags)
+
+    for idx, instance in enumerate(instances):
+        tags_dict = dict((t["Key"], t["Value"]) for t in instance.tags)
+        assert tags_dict == {"Name": "{0}-{1}".format(name, idx), "key1": "value1", "key2": "value2"}
+        for volume in instance.volumes.all():
+            assert dict((t["Key"], t["Value"]) for t in volume.tags) == {"key1": "value1", "key2": "value2"}
+
+    assert driver.get_tag_specifications() == []
+    assert driver.get_tag_specifications(name="foo") == [{"ResourceType": "instance",
+                                                          "Tags": [{"Key": "Name", "Value": "foo"}]}]
+
+
+@mock_ec2
+def test_lookup_cache(tmpdir):
+    from dask_ec2.ec2 import EC2
+    fpath = tmpdir.join("ec2-cache.yaml").strpath
+    driver = EC2(region="us-east-1", default_vpc=False, default_subnet=False, test=False, cache_ttl=60,
+                 cache_filepath=fpath)
+    assert driver.get_security_groups(security_group) == []
+    assert not tmpdir.join("ec2-cache.yaml").check()
+
+    driver.create_default_sg()
+    sg_ids = driver.get_security_groups_ids(DEFAULT_SG_GROUP_NAME)
+    assert len(sg_ids) == 1
+    vpc_id = driver.get_default_vpc()
+
+    # A new driver uses the disk cache, not the API
+    other = EC2(region="us-east-1", default_vpc=False, default_subnet=False, test=False, cache_ttl=60,
+                cache_filepath=fpath)
+    other.ec2 = None
+    assert other.get_security_groups_ids(DEFAULT_SG_GROUP_NAME) == sg_ids
+    assert other.get_default_vpc() == vpc_id
+
+    expired = EC2(region="us-east-1", default_vpc=False, default_subnet=False, test=False, cache_ttl=1e-9,
+                  cache_filepath=fpath)
+    assert expired.get_security_groups_ids(DEFAULT_SG_GROUP_NAME) == sg_ids
+
+
+@mock_ec2
+def test_check_enhanced_networking(driver):
+    info = driver.check_enhanced_networking("c5n.18xlarge")
+    assert info["ena_support"] == "required"
+
+    with pytest.raises(DaskEc2Exception):
+        driver.check_enhanced_networking("m3.2xlarge")
+
+
+class FakePlacementClient(object):
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.created = []
+
+    def describe_placement_groups(self, GroupNames):
+        from botocore.exceptions import ClientError
+        groups = [g for g in self.groups if g["GroupName"] in GroupNames]
+        if not groups:
+            raise ClientError({"Error": {"Code": "InvalidPlacementGroup.Unknown"}}, "DescribePlacementGroups")
+        return {"PlacementGroups": groups}
+
+    def create_placement_group(self, **kwargs):
+        self.created.append(kwargs)
+
+
+@mock_ec2
+def test_create_placement_group(driver):
+    driver.client = FakePlacementClient([{"GroupName": "existing", "Strategy": "cluster"}])
+    assert driver.create_placement_group("existing") == "existing"
+    assert driver.client.created == []
+
+    with pytest.raises(DaskEc2Exception):
+        driver.create_placement_group("existing", strategy="spread")
+    with pytest.raises(DaskEc2Exception):
+        driver.create_placement_group("new", strategy="unknown")
+
+    driver.create_placement_group("new", strategy="partition", partition_count=3)
+    assert driver.client.created == [{"GroupName": "new", "Strategy": "partition", "PartitionCount": 3}]
+
+
+@mock_ec2
+def test_instance_store_mappings(driver):
+    assert driver.get_instance_store_mappings("t2.micro") == []
+    assert driver.get_instance_store_mappings("m3.2xlarge") == [{"DeviceName": "/dev/sdb",
+                                                                 "VirtualName": "ephemeral0"}]
+
+
+def test_ebs_mapping():
+    from dask_ec2.ec2 import ebs_mapping, parse_data_volume
+    mapping = ebs_mapping("/dev/sda1", "gp3", 100, iops=6000, throughput=500)
+    assert mapping == {"DeviceName": "/dev/sda1", "Ebs": {"VolumeSize": 100, "DeleteOnTermination": True,
+                                                          "VolumeType": "gp3", "Iops": 6000, "Throughput": 500}}
+    with pytest.raises(DaskEc2Exception):
+        ebs_mapping("/dev/sda1", "gp2", 100, iops=6000)
+    with pytest.raises(DaskEc2Exception):
+        ebs_mapping("/dev/sda1", "io2", 100, throughput=500)
+    with pytest.raises(DaskEc2Exception):
+        ebs_mapping("/dev/sda1", "io2", 100)
+
+    assert parse_data_volume("200") == {"volume_size": 200, "volume_type": "gp3", "iops": None, "throughput": None}
+    assert parse_data_volume("200:io2:10000") == {"volume_size": 200, "volume_type": "io2", "iops": 10000,
+                                                  "throughput": None}
+    for spec in ("", "big", "200:gp3:1:2:3"):
+        with pytest.raises(DaskEc2Exception):
+            parse_data_volume(spec)
+
+
+@mock_ec2
+def test_launch_data_volumes(driver):
+    driver.ec2.create_key_pair(KeyName=keyname)
+    instances = driver.launch(name=name,
+                              image_id=ami,
+                              instance_type=instance_type,
+                              count=2,
+                              keyname=keyname,
+                              security_group_name=DEFAULT_SG_GROUP_NAME,
+                              volume_type="gp3",
+                              volume_size=100,
+                              volume_iops=4000,
+                              keypair=keypair,
+                              check_ami=False,
+                              data_volumes=[{"volume_size": 50, "volume_type": "gp3", "iops": None,
+                                             "throughput": None}],
+                              first_index=1)
+
+    for idx, instance in enumerate(instances, 1):
+        assert dict((t["Key"], t["Value"]) for t in instance.tags)["Name"] == "{0}-{1}".format(name, idx)
+        devices = sorted(mapping["DeviceName"] for mapping in instance.block_device_mappings)
+        assert devices == ["/dev/sda1", "/dev/sdf"]
+
+
+class FakeTagClient(object):
+
+    def __init__(self, fail):
+        self.fail = fail
+        self.tags = {}
+
+    def create_tags(self, Resources, Tags):
+        from botocore.exceptions import ClientError
+        if Resources[0] in self.fail:
+            raise ClientError({"Error": {"Code": "InvalidInstanceID.NotFound"}}, "CreateTags")
+        self.tags[Resources[0]] = Tags[0]["Value"]
+
+
+@mock_ec2
+def test_tag_names(driver, monkeypatch):
+    from dask_ec2 import executor
+    monkeypatch.setattr(executor.time, "sleep", lambda seconds: None)
+    driver.client = FakeTagClient(fail=["i-2"])
+    failed = driver.tag_names(["i-1", "i-2", "i-3"], "cluster", first_index=1)
+    assert failed == ["i-2"]
+    assert driver.client.tags == {"i-1": "cluster-1", "i-3": "cluster-3"}
@@ -0,0 +1,92 @@
+from __future__ import absolute_import, print_function, division
+
+import time
+import threading
+
+from dask_ec2.executor import ParallelExecutor, TaskTimeout
+
+
+def test_map_results_in_order():
+    executor = ParallelExecutor(parallelism=3)
+    results = executor.map(lambda x: x * 2, range(10), key=lambda x: "node-%i" % x)
+    assert list(results.keys()) == ["node-%i" % i for i in range(10)]
+    for i, result in enumerate(results.values()):
+        assert result.success
+        assert result.output == i * 2
+        assert result.attempts == 1
+
+
+def test_map_empty():
+    assert ParallelExecutor().map(lambda x: x, []) == {}
+
+
+def test_parallelism_limit():
+    lock = threading.Lock()
+    state = {"running": 0, "max": 0}
+
+    def work(x):
+        with lock:
+            state["running"] += 1
+            state["max"] = max(state["max"], state["running"])
+        time.sleep(0.02)
+        with lock:
+            state["running"] -= 1
+
+    ParallelExecutor(parallelism=4).map(work, range(20))
+    assert state["max"] <= 4
+
+
+def test_retries():
+    calls = {}
+
+    def flaky(x):
+        calls[x] = calls.get(x, 0) + 1
+        if x == 1 or calls[x] < 2:
+            raise ValueError("fail %i" % x)
+        return x
+
+    results = ParallelExecutor(retries=3).map(flaky, [0, 1])
+    assert results[0].success and results[0].attempts == 2
+    assert not results[1].success and results[1].attempts == 3
+    assert isinstance(results[1].error, ValueError)
+
+
+def test_retries_catch():
+    def fail(x):
+        raise KeyError(x)
+
+    results = ParallelExecutor(retries=3, catch=(ValueError,)).map(fail, [0])
+    assert not results[0].success
+    assert results[0].attempts == 1
+
+
+def test_timeout():
+    event = threading.Event()
+
+    def work(x):
+        if x == 0:
+            event.wait(5)
+        return x
+
+    start = time.time()
+    results = ParallelExecutor(parallelism=1, timeout=0.2).map(work, range(3))
+    event.set()
+    assert time.time() - start < 2
+    assert not results[0].success
+    assert isinstance(results[0].error, TaskTimeout)
+    assert results[1].success and results[2].success
+
+
+def test_deadline():
+    event = threading.Event()
+
+    def work(x):
+        event.wait(5)
+        return x
+
+    start = time.time()
+    results = ParallelExecutor(parallelism=2, deadline=0.2).map(work, range(4))
+    event.set()
+    assert time.time() - start < 2
+    assert len(results) == 4
+    assert not any(result.success for result in results.values())
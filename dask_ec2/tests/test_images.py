@@ -0,0 +1,24 @@
+from __future__ import absolute_import, print_function, division
+
+from dask_ec2.images import ImageRegistry, formulas_hash, image_key
+
+
+def test_image_key():
+    formulas = formulas_hash()
+    assert formulas == formulas_hash()
+    assert len(formulas) == 40
+    assert image_key("us-east-1", "ami-1", 3, "ubuntu") == "us-east-1/ami-1/py3/ubuntu/" + formulas
+    assert image_key("us-east-1", "ami-1", 3, "ubuntu", "abc") != image_key("us-east-1", "ami-1", 2, "ubuntu", "abc")
+
+
+def test_registry(tmpdir):
+    registry = ImageRegistry(tmpdir.join("dask-ec2", "images.yaml").strpath)
+    assert registry.get("key") is None
+
+    registry.add("key", "ami-123", name="baked")
+    entry = ImageRegistry(registry.filepath).get("key")
+    assert entry["image_id"] == "ami-123"
+    assert entry["name"] == "baked"
+
+    assert registry.remove("key")["image_id"] == "ami-123"
+    assert registry.get("key") is None
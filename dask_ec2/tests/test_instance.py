@@ -30,6 +30,20 @@ def test_dict_serde():
     assert instance2.port == 2222
     assert instance2.username == "user"
     assert instance2.keypair == "~/.ssh/key"
+    assert instance2.private_ip is None
+
+
+def test_private_ip():
+    instance = Instance("1.1.1.1", uid="i-123", private_ip="10.0.0.1")
+    assert instance.cluster_ip == "10.0.0.1"
+    assert Instance.from_dict(instance.to_dict()).private_ip == "10.0.0.1"
+
+    # Cluster files written by older versions don't have the private IP
+    data = instance.to_dict()
+    del data["private_ip"]
+    instance2 = Instance.from_dict(data)
+    assert instance2.private_ip is None
+    assert instance2.cluster_ip == "1.1.1.1"
 
 
 @remotetest
@@ -61,4 +75,5 @@ def test_from_boto3(driver):
                               keypair=keypair,
                               check_ami=False)
 
-    Instance.from_boto3_instance(instances[0])
+    instance = Instance.from_boto3_instance(instances[0])
+    assert instance.private_ip == instances[0].private_ip_address
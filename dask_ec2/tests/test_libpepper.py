@@ -0,0 +1,104 @@
+from __future__ import absolute_import, print_function, division
+
+import json
+import socket
+import struct
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer
+
+from dask_ec2.libpepper import Pepper, PepperException
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        data = json.loads(self.rfile.read(length).decode("utf-8"))
+        self.server.tokens.append(self.headers.get("X-Auth-Token"))
+        self.server.paths.append(self.path)
+        if self.path == "/reset":
+            # Reset the connection after getting the request, without a response
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.rfile.close()
+            self.wfile.close()
+            self.connection.close()
+            self.close_connection = True
+            return
+        if self.path == "/login":
+            status, body = 200, {"return": [{"token": "abc", "expire": 0}]}
+        elif self.path == "/denied":
+            status, body = 401, {}
+        else:
+            status, body = 200, {"return": [data]}
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if self.server.close_connections:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(params=[False, True], ids=["keep-alive", "close"])
+def server(request):
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+    server.tokens = []
+    server.paths = []
+    server.close_connections = request.param
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_connection_reuse(server):
+    api = Pepper("http://127.0.0.1:%i" % server.server_port)
+    api.login("saltdev", "saltdev", "pam")
+    assert api.auth["token"] == "abc"
+
+    for i in range(3):
+        ret = api.local("*", "test.ping")
+        assert ret == {"return": [[{"client": "local", "tgt": "*", "fun": "test.ping", "expr_form": "glob"}]]}
+
+    assert server.tokens == [None, "abc", "abc", "abc"]
+    stats = api.get_stats()
+    assert stats["requests"] == 4
+    assert stats["connections"] == (4 if server.close_connections else 1)
+    assert stats["max_time"] >= stats["mean_time"] > 0
+
+    with pytest.raises(PepperException):
+        api.req("/denied", {})
+    api.close()
+
+
+def test_reconnect_dropped_connection(server):
+    if server.close_connections:
+        pytest.skip("Only applies to keep-alive connections")
+    api = Pepper("http://127.0.0.1:%i" % server.server_port)
+    api.local("*", "test.ping")
+    # Simulate the server dropping the idle connection
+    api._connection.sock.close()
+    api.local("*", "test.ping")
+    stats = api.get_stats()
+    assert stats["requests"] == 2
+    assert stats["connections"] == 2
+
+
+def test_no_resend_after_request_was_sent(server):
+    from six.moves.urllib.error import URLError
+    api = Pepper("http://127.0.0.1:%i" % server.server_port)
+    api.local("*", "test.ping")
+    with pytest.raises(URLError):
+        api.req("/reset", {"client": "local_async", "tgt": "*", "fun": "state.sls"})
+    # The server got the request once, it was not sent again on a new connection
+    assert server.paths == ["/", "/reset"]
+    assert api.get_stats()["reconnects"] == 0
@@ -0,0 +1,85 @@
+from __future__ import absolute_import, print_function, division
+
+import time
+import threading
+
+import pytest
+
+from dask_ec2 import Cluster, Instance
+from dask_ec2 import pipeline as pipeline_module
+from dask_ec2.exceptions import DaskEc2Exception
+from dask_ec2.pipeline import LaunchPipeline
+
+
+class FakeBoto3Instance(object):
+
+    def __init__(self, id_, ip):
+        self.id = id_
+        self.public_ip_address = ip
+        self.private_ip_address = None
+
+
+class FakeDriver(object):
+    """The head node is the last one to be running"""
+
+    def __init__(self, instances):
+        self.instances = instances
+
+    def iter_running(self, ids, poll_interval=5, timeout=600):
+        for instance in self.instances[1:] + self.instances[:1]:
+            time.sleep(0.05)
+            yield instance
+
+
+@pytest.fixture
+def fake_salt(monkeypatch):
+    events = []
+    lock = threading.Lock()
+
+    def __event(*event):
+        with lock:
+            events.append(event)
+
+    def install_salt_master(cluster):
+        time.sleep(0.2)
+        __event("master", cluster.instances[0].ip)
+
+    def install_node_minion(cluster, i):
+        __event("minion", cluster.instances[i].ip, cluster.instances[0].ip)
+        return {"failed_step": "restart" if cluster.instances[i].ip == "fail" else None, "error": "error"}
+
+    monkeypatch.setattr(pipeline_module, "install_salt_master", install_salt_master)
+    monkeypatch.setattr(pipeline_module, "install_node_minion", install_node_minion)
+    monkeypatch.setattr(Instance, "wait_for_ssh", lambda self, timeout=300: 0)
+    monkeypatch.setattr(Cluster, "wait_for_minions", lambda self, timeout=120: __event("wait_for_minions"))
+    return events
+
+
+def test_pipeline(fake_salt):
+    instances = [FakeBoto3Instance("i-%i" % i, "10.0.0.%i" % i) for i in range(4)]
+    driver = FakeDriver(instances)
+    stages = []
+    pipeline = LaunchPipeline(driver, "us-east-1", instances, "ubuntu", "key.pem", parallelism=4,
+                              callback=lambda index, stage, seconds: stages.append((index, stage)))
+    cluster = pipeline.run()
+
+    assert [instance.ip for instance in cluster.instances] == ["10.0.0.%i" % i for i in range(4)]
+    assert cluster.instances[1].username == "ubuntu"
+    # Workers are bootstrapped pointing to the head node while salt-master is being installed
+    minions = [event for event in fake_salt if event[0] == "minion"]
+    assert all(event[2] == "10.0.0.0" for event in minions)
+    assert fake_salt.index(("master", "10.0.0.0")) > fake_salt.index(("minion", "10.0.0.1", "10.0.0.0"))
+    assert fake_salt[-1] == ("wait_for_minions", )
+
+    assert (0, "master") in stages
+    assert list(pipeline.summary()) == ["running", "ssh", "master", "minion"]
+    assert pipeline.timings["i-0"]["minion"] > pipeline.timings["i-0"]["master"]
+
+
+def test_pipeline_failure(fake_salt):
+    instances = [FakeBoto3Instance("i-0", "10.0.0.0"), FakeBoto3Instance("i-1", "fail")]
+    pipeline = LaunchPipeline(FakeDriver(instances), "us-east-1", instances, "ubuntu", "key.pem")
+    with pytest.raises(DaskEc2Exception) as excinfo:
+        pipeline.run()
+    assert "i-1 (minion" in str(excinfo.value)
+    assert "i-0" not in str(excinfo.value)
@@ -0,0 +1,254 @@
+from __future__ import absolute_import, print_function, division
+
+import json
+
+import pytest
+
+from dask_ec2 import Cluster, Instance
+from dask_ec2.exceptions import DaskEc2Exception
+from dask_ec2.salt import (NETWORK_INFO_CMD, Response, StateProfile, StepTimings, install_salt_master,
+                           parse_fio_output, parse_network_info, percentile)
+from dask_ec2.ssh import SSHClient
+
+from .utils import run_wrapped
+
+
+def test_step_timings():
+    timings = StepTimings()
+    timings("stdout", "@@dask-ec2 start step1")
+    timings("stdout", "some output")
+    timings("stderr", "@@dask-ec2 end step1 0")
+    timings("stdout", "@@dask-ec2 end step1 0")
+    timings("stdout", "@@dask-ec2 start step2")
+    assert [step["name"] for step in timings.steps] == ["step1"]
+    assert timings.steps[0]["exit_code"] == 0
+    assert timings.failed() == "step2"
+
+    timings("stdout", "@@dask-ec2 end step2 1")
+    assert timings.failed() == "step2"
+
+
+@pytest.fixture
+def head_cluster(monkeypatch):
+    monkeypatch.setattr(Instance, "ssh_client", property(lambda self: SSHClient(self.ip, connect=False)))
+    cluster = Cluster("foo")
+    cluster.append(Instance(ip="1.1.1.1"))
+    return cluster
+
+
+def test_install_salt_master_single_session(monkeypatch, head_cluster):
+    calls = []
+
+    def put_tar(self, sources, remote, sudo=False, run=None, callback=None, **kwargs):
+        calls.append((sources, remote, run))
+        for step in ("configure", "bootstrap"):
+            callback("stdout", "@@dask-ec2 start %s" % step)
+            callback("stdout", "@@dask-ec2 end %s 0" % step)
+        return {"bytes_sent": 0, "seconds": 0}
+
+    monkeypatch.setattr(SSHClient, "put_tar", put_tar)
+    steps = install_salt_master(head_cluster)
+
+    assert len(calls) == 1
+    sources, remote, run = calls[0]
+    expected = ["install_salt_master.sh", "master.d/auto_accept.conf", "master.d/external_auth.conf",
+                "master.d/rest_cherrypy.conf"]
+    assert sorted(arcname for _, arcname in sources) == expected
+    assert run == "bash {}/install_salt_master.sh".format(remote)
+    assert [step["name"] for step in steps] == ["configure", "bootstrap"]
+
+
+def test_install_salt_master_reports_failed_step(monkeypatch, head_cluster):
+    import dask_ec2.utils
+
+    def put_tar(self, sources, remote, sudo=False, run=None, callback=None, **kwargs):
+        callback("stdout", "@@dask-ec2 start bootstrap")
+        callback("stdout", "@@dask-ec2 end bootstrap 1")
+        raise DaskEc2Exception("boom")
+
+    monkeypatch.setattr(SSHClient, "put_tar", put_tar)
+    monkeypatch.setattr(dask_ec2.utils.time, "sleep", lambda seconds: None)
+    with pytest.raises(DaskEc2Exception) as excinfo:
+        install_salt_master(head_cluster)
+    assert "failed at step 'bootstrap'" in str(excinfo.value)
+
+
+def test_install_salt_minion_pipeline(monkeypatch):
+    from dask_ec2.salt import install_salt_minion
+    monkeypatch.setattr(Instance, "ssh_client", property(lambda self: SSHClient(self.ip, connect=False)))
+
+    commands, uploads = [], []
+
+    def exec_command(self, command, sudo=False, **kwargs):
+        commands.append((self.host, command))
+        failed = self.host == "2.2.2.2" and "restart" in command
+        return {"stdout": "", "stderr": "error", "exit_code": 1 if failed else 0}
+
+    def put_tar(self, sources, remote, sudo=False, **kwargs):
+        uploads.append((self.host, remote))
+
+    monkeypatch.setattr(SSHClient, "exec_command", exec_command)
+    monkeypatch.setattr(SSHClient, "put_tar", put_tar)
+
+    cluster = Cluster("foo", parallelism=2)
+    for i in range(3):
+        cluster.append(Instance(ip="{0}.{0}.{0}.{0}".format(i)))
+
+    with pytest.raises(DaskEc2Exception) as excinfo:
+        install_salt_minion(cluster)
+    assert "2.2.2.2 (restart)" in str(excinfo.value)
+    assert "1.1.1.1" not in str(excinfo.value)
+
+    assert len(uploads) == 3
+    assert ("0.0.0.0", "/etc/salt/minion.d") in uploads
+    bootstraps = [command for host, command in commands if "bootstrap" in command]
+    assert len(bootstraps) == 3
+    assert any("-A 0.0.0.0 -i node-2" in command for command in bootstraps)
+    # The failing restart is retried
+    assert len([1 for host, command in commands if host == "2.2.2.2" and "restart" in command]) == 3
+
+
+def test_remote_cmd_hung_node(monkeypatch):
+    import time
+    import threading
+    from dask_ec2.executor import TaskTimeout
+    from dask_ec2.salt import remote_cmd
+    monkeypatch.setattr(Instance, "ssh_client", property(lambda self: SSHClient(self.ip, connect=False)))
+    hung = threading.Event()
+
+    def exec_command(self, command, sudo=False, **kwargs):
+        if self.host == "1.1.1.1":
+            hung.wait(5)
+        return {"stdout": "ok", "stderr": "", "exit_code": 0}
+
+    monkeypatch.setattr(SSHClient, "exec_command", exec_command)
+    cluster = Cluster("foo", node_deadline=0.2)
+    for i in range(3):
+        cluster.append(Instance(ip="{0}.{0}.{0}.{0}".format(i)))
+
+    start = time.time()
+    try:
+        results = remote_cmd(cluster, "true")
+    finally:
+        hung.set()
+    assert time.time() - start < 1
+    assert [result.success for result in results.values()] == [True, False, True]
+    assert isinstance(results["1.1.1.1"].error, TaskTimeout)
+
+
+def test_state_profile():
+    def state(duration, id_):
+        return {"result": True, "comment": "", "duration": duration, "start_time": "10:00:00.000000", "__id__": id_}
+
+    response = Response({
+        "node-0": {"pkg_|-remove-anaconda_|-/opt/anaconda_|-removed": state(1000, "remove-anaconda"),
+                   "cmd_|-dask-install_|-pip install dask_|-run": state("3000.5 ms", "dask-install")},
+        "node-1": {"pkg_|-remove-anaconda_|-/opt/anaconda_|-removed": state(2000, "remove-anaconda"),
+                   "cmd_|-dask-install_|-pip install dask_|-run": state(500, "dask-install")},
+        "node-2": ["Rendering SLS 'base:conda' failed"],
+    })
+    profile = StateProfile(response)
+    assert len(profile) == 4
+
+    slowest = profile.slowest()
+    assert slowest["node-0"][0]["state"] == "dask-install"
+    assert slowest["node-0"][0]["function"] == "cmd.run"
+    assert slowest["node-1"][0]["state"] == "remove-anaconda"
+    assert "node-2" not in slowest
+
+    by_state = profile.by_state()
+    assert [s["state"] for s in by_state] == ["dask-install", "remove-anaconda"]
+    assert by_state[0]["total"] == pytest.approx(3.5005)
+    assert by_state[1]["max"] == 2.0
+    assert by_state[1]["p50"] == 1.0
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+    assert percentile([3], 95) == 3
+    assert percentile([], 50) is None
+
+
+def synthetic_response(minions, states, failed=()):
+    response = Response()
+    for i in range(minions):
+        states_ = {}
+        for j in range(states):
+            states_["cmd_|-state-%i_|-run_|-run" % j] = {"result": (i, j) not in failed, "comment": "comment %i" % j}
+        response["node-%i" % i] = states_
+    return response
+
+
+def test_aggregate_by_large_response():
+    response = synthetic_response(1000, 40, failed=[(10, 3), (999, 39)])
+    aggregated = response.aggregate_by(field="result")
+
+    assert len(aggregated) == 1000
+    assert not aggregated.aggregated_success()
+    assert aggregated["node-10"]["failed"] == [{"name": "cmd_|-state-3_|-run_|-run", "comment": "comment 3",
+                                                "result": False}]
+    assert len(aggregated["node-999"]["successful"]) == 39
+    table = aggregated.aggregated_to_table(agg=len)
+    assert sum(row[1] for row in table) == 1000 * 40 - 2
+    # The response is not modified
+    assert "name" not in response["node-0"]["cmd_|-state-0_|-run_|-run"]
+
+    groups = aggregated.group_by_id()
+    assert [len(ids) for _, ids in groups] == [998, 1, 1]
+
+
+def test_aggregate_by_errors():
+    response = Response({"node-0": ["Rendering SLS 'base:conda' failed"], "node-1": "Minion did not return"})
+    aggregated = response.aggregate_by(field="result")
+    assert aggregated["node-0"]["failed"][0]["comment"] == "Rendering SLS 'base:conda' failed"
+    assert len(aggregated["node-1"]["failed"]) == 1
+    assert not aggregated.aggregated_success()
+
+
+def test_aggregate_by_nameless_states():
+    response = Response({"node-0": [{"result": False, "comment": "boom", "__id__": "dask-install"},
+                                    {"result": False, "comment": "bang"},
+                                    {"result": True}]})
+    aggregated = response.aggregate_by(field="result")
+    assert [fail["name"] for fail in aggregated["node-0"]["failed"]] == ["dask-install", "unknown"]
+    assert aggregated["node-0"]["successful"] == ["unknown"]
+
+
+def test_group_by_id_ignore_fields():
+    response = Response({"node-0": {"a": 1, "time": 1}, "node-1": {"a": 1, "time": 2}, "node-2": {"a": 2}})
+    assert response.group_by_id(ignore_fields=["time"]) == [({"a": 1}, ["node-0", "node-1"]),
+                                                            ({"a": 2}, ["node-2"])]
+
+
+def test_parse_network_info():
+    info = parse_network_info("interface=ens5\ndriver=ena\nmtu=9001\nspeed=\n")
+    assert info == {"interface": "ens5", "driver": "ena", "mtu": 9001, "speed": None, "ena": True, "jumbo": True}
+
+    info = parse_network_info("interface=eth0\ndriver=xen_netfront\nmtu=1500\nspeed=10000")
+    assert info["speed"] == 10000
+    assert not info["ena"]
+    assert not info["jumbo"]
+
+    assert parse_network_info("")["mtu"] is None
+
+
+def test_network_info_command():
+    # The command as ``remote_cmd`` runs it, inside ``bash -c``
+    exit_code, stdout = run_wrapped(NETWORK_INFO_CMD)
+    assert exit_code == 0
+    keys = [line.split("=", 1)[0] for line in stdout.splitlines()]
+    assert keys == ["interface", "driver", "mtu", "speed"]
+
+
+def test_parse_fio_output():
+    jobs = [{"jobname": "write", "write": {"bw_bytes": 250000000, "iops": 238.4}, "read": {"bw_bytes": 0, "iops": 0}},
+            {"jobname": "read", "write": {"bw_bytes": 0, "iops": 0}, "read": {"bw_bytes": 500000000, "iops": 476.8}}]
+    output = 'fio: some warning{"fio version": "fio-3.16", "jobs": %s}' % json.dumps(jobs)
+    assert parse_fio_output(output) == {"write_mbps": 250.0, "read_mbps": 500.0, "write_iops": 238.4,
+                                        "read_iops": 476.8}
+
+    with pytest.raises(DaskEc2Exception):
+        parse_fio_output("fio: command not found")
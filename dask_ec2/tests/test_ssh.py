@@ -2,9 +2,9 @@ from __future__ import absolute_import, print_function, division
 
 import pytest
 
-from dask_ec2.ssh import SSHClient
+from dask_ec2.ssh import SSHClient, wrap_command
 from dask_ec2.exceptions import DaskEc2Exception
-from .utils import remotetest
+from .utils import remotetest, run_wrapped
 
 
 @remotetest
@@ -197,3 +197,364 @@ def test_put_dir(cluster, tmpdir, request):
         client.close()
 
     request.addfinalizer(fin)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        self.keepalive = interval
+
+    def close(self):
+        self.active = False
+
+
+@pytest.fixture
+def fake_connect(monkeypatch):
+    connections = []
+
+    def connect(self):
+        transport = FakeTransport()
+        self.client._transport = transport
+        connections.append(transport)
+
+    monkeypatch.setattr(SSHClient, "connect", connect)
+    return connections
+
+
+def test_pool_reuses_clients(fake_connect):
+    from dask_ec2.ssh import SSHPool
+    pool = SSHPool()
+    client1 = pool.get("1.1.1.1", username="ubuntu")
+    client2 = pool.get("1.1.1.1", username="ubuntu")
+    client3 = pool.get("1.1.1.1", username="root")
+
+    assert client1 is client2
+    assert client1 is not client3
+    assert len(fake_connect) == 2
+    assert pool.stats["new"] == 2
+    assert pool.stats["reused"] == 1
+    assert len(pool) == 2
+
+
+def test_pool_reconnects_dead_transport(fake_connect):
+    from dask_ec2.ssh import SSHPool
+    pool = SSHPool()
+    client1 = pool.get("1.1.1.1", username="ubuntu")
+    fake_connect[0].active = False
+    client2 = pool.get("1.1.1.1", username="ubuntu")
+
+    assert client1 is client2
+    assert client2.is_active()
+    assert len(fake_connect) == 2
+    assert pool.stats["reconnected"] == 1
+
+
+def test_pool_max_connections(fake_connect):
+    from dask_ec2.ssh import SSHPool
+    pool = SSHPool(max_connections=2)
+    client1 = pool.get("1.1.1.1")
+    pool.get("2.2.2.2")
+    pool.get("1.1.1.1")
+    pool.get("3.3.3.3")
+
+    assert len(pool) == 2
+    assert pool.stats["evicted"] == 1
+    assert pool.get("1.1.1.1") is client1
+
+    pool.close_all()
+    assert len(pool) == 0
+
+
+class FakeOpenChannel(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def recv_ready(self):
+        return False
+
+    def recv_stderr_ready(self):
+        return False
+
+
+def test_pool_does_not_evict_busy_clients(fake_connect):
+    from dask_ec2.ssh import SSHPool
+    pool = SSHPool(max_connections=1)
+    client1 = pool.get("1.1.1.1")
+    channel = FakeOpenChannel()
+    client1._channels.append(channel)
+    client2 = pool.get("2.2.2.2")
+
+    # client1 is running a command, the pool goes over its limit
+    assert len(pool) == 2
+    assert pool.stats["evicted"] == 0
+    assert client1.is_active()
+
+    channel.closed = True
+    pool.get("3.3.3.3")
+    assert len(pool) == 1
+    assert pool.stats["evicted"] == 2
+    assert not client1.is_active()
+    assert not client2.is_active()
+
+
+def test_pool_reserve():
+    from dask_ec2.ssh import SSHPool
+    pool = SSHPool(max_connections=4)
+    pool.reserve(512)
+    assert pool.max_connections == 512
+    pool.reserve(8)
+    assert pool.max_connections == 512
+
+
+class FakeChannel(object):
+    """Channel that is always readable and returns the given chunks in order"""
+
+    def __init__(self, stdout, stderr, exit_code=0):
+        import os
+        self._stdout = list(stdout)
+        self._stderr = list(stderr)
+        self._exit_code = exit_code
+        self._read, self._write = os.pipe()
+        os.write(self._write, b"x")
+        self.closed = False
+        self.sent = b""
+
+    def sendall(self, data):
+        self.sent += data
+
+    def shutdown_write(self):
+        pass
+
+    def fileno(self):
+        return self._read
+
+    def recv_ready(self):
+        return len(self._stdout) > 0
+
+    def recv(self, nbytes):
+        return self._stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return len(self._stderr) > 0
+
+    def recv_stderr(self, nbytes):
+        return self._stderr.pop(0)
+
+    @property
+    def eof_received(self):
+        return not (self._stdout or self._stderr)
+
+    def recv_exit_status(self):
+        return self._exit_code
+
+
+def test_command_stream_lines():
+    from dask_ec2.ssh import CommandStream
+    channel = FakeChannel([b"line1\nli", b"ne2\n", b"line3"], [b"err\xff\n"], exit_code=3)
+    stream = CommandStream(channel)
+    lines = list(stream)
+    assert ("stdout", "line1") in lines
+    assert ("stdout", "line2") in lines
+    assert ("stdout", "line3") in lines
+    assert ("stderr", u"err\ufffd") in lines
+    assert [l for s, l in lines if s == "stdout"] == ["line1", "line2", "line3"]
+    assert stream.exit_code == 3
+
+
+def test_exec_command_tail_and_callback(monkeypatch):
+    from dask_ec2.ssh import CommandStream
+    chunks = [("line%i\n" % i).encode() for i in range(100)]
+    monkeypatch.setattr(SSHClient, "iter_command",
+                        lambda self, command, **kwargs: CommandStream(FakeChannel(chunks, [])))
+    client = SSHClient("1.1.1.1", connect=False)
+    seen = []
+    response = client.exec_command("ls", callback=lambda stream, line: seen.append(line), tail=2)
+    assert len(seen) == 100
+    assert response["stdout"] == "line98\nline99"
+    assert response["exit_code"] == 0
+
+
+@remotetest
+def test_iter_command(cluster):
+    client = cluster.head.ssh_client
+    stream = client.iter_command("echo 1; echo 2 >&2; echo 3; exit 4")
+    lines = list(stream)
+    assert [line for name, line in lines if name == "stdout"] == ["1", "3"]
+    assert [line for name, line in lines if name == "stderr"] == ["2"]
+    assert stream.exit_code == 4
+
+
+def test_put_dir_streams_tar(monkeypatch, tmpdir):
+    import io
+    import tarfile
+    channels, commands = [], []
+
+    def open_command(self, command, sudo=False):
+        commands.append(command)
+        channels.append(FakeChannel([], []))
+        return channels[-1]
+
+    monkeypatch.setattr(SSHClient, "open_command", open_command)
+
+    d1 = tmpdir.mkdir("rootdir")
+    d1.join("upload1.txt").write("content1")
+    d1.mkdir("subdir").join("upload2.txt").write("content2")
+
+    client = SSHClient("1.1.1.1", connect=False)
+    stats = client.put_dir(d1.strpath, "/tmp/dest", sudo=True)
+
+    assert len(commands) == 1
+    assert "tar -xzf - -C /tmp/dest" in commands[0]
+    assert stats["bytes_sent"] == len(channels[0].sent)
+
+    archive = tarfile.open(fileobj=io.BytesIO(channels[0].sent), mode="r:gz")
+    assert sorted(archive.getnames()) == ["subdir", "subdir/upload2.txt", "upload1.txt"]
+    assert archive.extractfile("subdir/upload2.txt").read() == b"content2"
+
+
+def test_sync_dir_transfers_differences(monkeypatch, tmpdir):
+    import hashlib
+    from dask_ec2.ssh import local_manifest
+
+    d1 = tmpdir.mkdir("rootdir")
+    d1.join("same.txt").write("same")
+    d1.join("changed.txt").write("new content")
+    d1.mkdir("subdir").join("new.txt").write("new")
+
+    assert sorted(local_manifest(d1.strpath)) == ["changed.txt", "same.txt", "subdir/new.txt"]
+
+    remote = {"same.txt": hashlib.sha1(b"same").hexdigest(),
+              "changed.txt": hashlib.sha1(b"old content").hexdigest(),
+              "removed.txt": hashlib.sha1(b"removed").hexdigest()}
+    uploads, commands = [], []
+    monkeypatch.setattr(SSHClient, "remote_manifest", lambda self, remote_, sudo=False: remote)
+    monkeypatch.setattr(SSHClient, "put_tar",
+                        lambda self, sources, remote_, **kwargs: uploads.append(sources) or {"bytes_sent": 10})
+    monkeypatch.setattr(SSHClient, "exec_command",
+                        lambda self, command, **kwargs: commands.append(command) or {"exit_code": 0})
+
+    client = SSHClient("1.1.1.1", connect=False)
+    ret = client.sync_dir(d1.strpath, "/srv/salt")
+
+    assert ret["transferred"] == ["changed.txt", "subdir/new.txt"]
+    assert ret["deleted"] == ["removed.txt"]
+    assert ret["skipped"] == 1
+    assert [arcname for _, arcname in uploads[0]] == ["changed.txt", "subdir/new.txt"]
+    assert commands == ["cd /srv/salt && rm -f -- removed.txt"]
+
+    # Nothing to do when both sides match
+    remote = local_manifest(d1.strpath)
+    uploads[:], commands[:] = [], []
+    ret = client.sync_dir(d1.strpath, "/srv/salt")
+    assert ret["transferred"] == [] and ret["deleted"] == [] and ret["skipped"] == 3
+    assert uploads == [] and commands == []
+
+
+@pytest.fixture
+def local_exec(monkeypatch):
+    """Run the commands of SSHClient.exec_command in a local shell"""
+    def exec_command(self, command, sudo=False, **kwargs):
+        exit_code, stdout = run_wrapped(command)
+        return {"stdout": stdout.strip(), "stderr": "", "exit_code": exit_code}
+
+    monkeypatch.setattr(SSHClient, "exec_command", exec_command)
+
+
+def test_sync_dir_extra_files(monkeypatch, tmpdir):
+    import hashlib
+    d1 = tmpdir.mkdir("rootdir")
+    d1.join("top.sls").write("top")
+    module = tmpdir.join("tuning.py")
+    module.write("module")
+
+    remote = {"top.sls": hashlib.sha1(b"top").hexdigest()}
+    uploads = []
+    monkeypatch.setattr(SSHClient, "remote_manifest", lambda self, remote_, sudo=False: remote)
+    monkeypatch.setattr(SSHClient, "put_tar",
+                        lambda self, sources, remote_, **kwargs: uploads.append(sources) or {"bytes_sent": 10})
+
+    client = SSHClient("1.1.1.1", connect=False)
+    ret = client.sync_dir(d1.strpath, "/srv/salt", extra={"_modules/dask_tuning.py": module.strpath})
+    assert ret["transferred"] == ["_modules/dask_tuning.py"]
+    assert uploads == [[(module.strpath, "_modules/dask_tuning.py")]]
+
+    # Not deleted once it is there
+    remote["_modules/dask_tuning.py"] = hashlib.sha1(b"module").hexdigest()
+    ret = client.sync_dir(d1.strpath, "/srv/salt", extra={"_modules/dask_tuning.py": module.strpath})
+    assert ret["transferred"] == [] and ret["deleted"] == []
+
+
+def test_sync_dir_special_paths(local_exec, tmpdir):
+    import hashlib
+    remote = tmpdir.mkdir("remote dir $HOME `id` \"x\"")
+    names = ["plain.txt", "back\\slash.txt", "new\nline.txt", "cr\rx.txt", "quote's $(id).txt", "sep\x1c.txt"]
+    for i, name in enumerate(names):
+        remote.join(name).write(str(i))
+
+    client = SSHClient("1.1.1.1", connect=False)
+    manifest = client.remote_manifest(remote.strpath)
+    assert manifest == dict((name, hashlib.sha1(str(i).encode()).hexdigest()) for i, name in enumerate(names))
+
+    local = tmpdir.mkdir("local")
+    local.join("plain.txt").write("0")
+    ret = client.sync_dir(local.strpath, remote.strpath)
+    assert ret["transferred"] == []
+    assert ret["deleted"] == sorted(names[1:])
+    assert sorted(p.basename for p in remote.listdir()) == ["plain.txt"]
+
+    assert client.remote_manifest(tmpdir.join("missing $dir").strpath) == {}
+
+
+def test_parse_sha1sum():
+    from dask_ec2.ssh import parse_sha1sum
+    digest = "a" * 40
+    output = "\n".join([digest + "  ./a b.txt",
+                        "\\" + digest + "  ./dir/back\\\\slash\\nnewline",
+                        "\\" + digest + " *./cr\\rx"])
+    assert parse_sha1sum(output) == {"a b.txt": digest, "dir/back\\slash\nnewline": digest, "cr\rx": digest}
+
+
+def test_put_tar_quotes_remote(monkeypatch):
+    commands = []
+
+    def open_command(self, command, sudo=False, **kwargs):
+        commands.append(command)
+        return FakeChannel([], [])
+
+    monkeypatch.setattr(SSHClient, "open_command", open_command)
+    SSHClient("1.1.1.1", connect=False).put_tar([], "/tmp/a $b")
+    assert commands[0].startswith("mkdir -p '/tmp/a $b' && tar -xzf - -C '/tmp/a $b' ")
+
+
+def test_wait_for_port():
+    import socket
+    from dask_ec2.ssh import wait_for_port
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+    try:
+        assert wait_for_port("127.0.0.1", port, timeout=1) < 1
+    finally:
+        server.close()
+
+    with pytest.raises(DaskEc2Exception) as excinfo:
+        wait_for_port("127.0.0.1", port, timeout=0.3, initial_wait=0.1)
+    assert "not open after" in str(excinfo.value)
+
+
+def test_wrap_command():
+    assert wrap_command("ls") == "bash -c ls"
+    assert wrap_command("ls -l", sudo=True) == "sudo -S bash -c 'ls -l'"
+
+    exit_code, stdout = run_wrapped("""echo 'single' "double" | awk '{print $2}'""")
+    assert exit_code == 0
+    assert stdout.strip() == "double"
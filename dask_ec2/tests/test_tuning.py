@@ -0,0 +1,47 @@
+from __future__ import absolute_import, print_function, division
+
+from dask_ec2.tuning import auto_layout, candidate_layouts, choose_layout, worker_layout
+
+
+def test_auto_layout():
+    assert auto_layout(2, 4000) == {"nprocs": 1, "nthreads": 2, "memory_limit": "3600MB"}
+    assert auto_layout(32, 128000, numa_nodes=2) == {"nprocs": 8, "nthreads": 4, "memory_limit": "14400MB"}
+    # One process per NUMA node at least, all the CPUs are used
+    assert auto_layout(8, 32000, numa_nodes=4) == {"nprocs": 4, "nthreads": 2, "memory_limit": "7200MB"}
+    # The threads are rounded down, the node is not oversubscribed
+    assert auto_layout(36, 72000, numa_nodes=2) == {"nprocs": 8, "nthreads": 4, "memory_limit": "8100MB"}
+
+
+def test_auto_layout_is_benchmarked():
+    for cpus in range(1, 97):
+        for numa_nodes in (1, 2, 4):
+            layout = auto_layout(cpus, 1000, numa_nodes)
+            assert layout["nprocs"] * layout["nthreads"] <= cpus
+            assert (layout["nprocs"], layout["nthreads"]) in candidate_layouts(cpus, numa_nodes)
+
+
+def test_worker_layout():
+    auto = {"nprocs": 8, "nthreads": 4, "memory_limit": "8100MB"}
+    assert worker_layout(36, 72000, "auto", numa_nodes=2) == auto
+    assert worker_layout(36, 72000, "auto", nthreads=2, memory_limit="4GB", numa_nodes=2) == \
+        {"nprocs": 8, "nthreads": 2, "memory_limit": "4GB"}
+    # Only the values given as auto are computed
+    assert worker_layout(8, 16000, 3, numa_nodes=1) == {"nprocs": 3, "nthreads": None, "memory_limit": None}
+    assert worker_layout(8, 16000, 3, nthreads="auto", memory_limit="auto", numa_nodes=1) == \
+        {"nprocs": 3, "nthreads": 2, "memory_limit": "4800MB"}
+    assert worker_layout(4, 16000, "auto")["nprocs"] >= 1
+
+
+def test_candidate_layouts():
+    assert candidate_layouts(8) == [(1, 8), (2, 4), (4, 2), (8, 1)]
+    assert candidate_layouts(6) == [(1, 6), (2, 3), (6, 1)]
+    assert candidate_layouts(1) == [(1, 1)]
+    assert (8, 4) in candidate_layouts(36, numa_nodes=2)
+
+
+def test_choose_layout():
+    results = [{"nprocs": 1, "nthreads": 8, "gil_seconds": 8.0, "nogil_seconds": 1.0},
+               {"nprocs": 4, "nthreads": 2, "gil_seconds": 2.5, "nogil_seconds": 1.2},
+               {"nprocs": 8, "nthreads": 1, "gil_seconds": 2.0, "nogil_seconds": 2.0}]
+    assert choose_layout(results) is results[1]
+    assert choose_layout([]) is None
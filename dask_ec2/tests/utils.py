@@ -26,3 +26,17 @@ def assert_all_true(salt_output, none_is_ok=False):
                 assert value['result'] is not False, (state_id, value)
             else:
                 assert value['result'] is True, (state_id, value)
+
+
+def run_wrapped(command):
+    """Run a command locally the way ``SSHClient.exec_command`` runs it remotely
+
+    Returns
+    -------
+        (exit code, stdout)
+    """
+    import subprocess
+    from dask_ec2.ssh import wrap_command
+    process = subprocess.Popen(wrap_command(command), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate()
+    return process.returncode, stdout.decode("utf-8")
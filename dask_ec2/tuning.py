@@ -0,0 +1,137 @@
+"""
+Layout of the dask-worker processes and threads of a node
+
+The ``auto`` policy:
+
+- At least one process per NUMA node, so no process spans memory controllers
+- About ``THREADS_PER_PROCESS`` threads per process, more processes keep
+  GIL-bound (pure python) tasks running in parallel while the threads
+  still share memory for GIL-releasing (numpy, pandas) tasks
+- ``nthreads`` is the number of CPUs divided by the number of processes,
+  rounded down so the node is never oversubscribed
+- ``MEMORY_FRACTION`` of the memory of the node is split evenly between the
+  processes, the rest is left to the OS and the page cache
+
+With ``--nprocs auto`` the threads and memory limit are also ``auto`` unless
+they are given.
+
+This module is also uploaded as the ``dask_tuning`` salt execution module
+(see ``salt.upload_formulas``), ``dask/distributed/settings.sls`` calls
+``worker_layout`` on the nodes. It must only use the standard library.
+"""
+from __future__ import print_function, division, absolute_import
+
+import glob
+import logging
+
+logger = logging.getLogger(__name__)
+
+THREADS_PER_PROCESS = 4
+
+MEMORY_FRACTION = 0.9
+
+
+def auto_layout(cpus, memory_mb, numa_nodes=1):
+    """Processes, threads and memory limit for a node with the ``auto`` policy
+
+    Parameters
+    ----------
+    cpus : int
+        ``num_cpus`` grain
+    memory_mb : int
+        ``mem_total`` grain
+    numa_nodes : int
+
+    Returns
+    -------
+        dict with ``nprocs``, ``nthreads`` and ``memory_limit`` (str, e.g. ``'7372MB'``)
+    """
+    cpus = max(1, int(cpus))
+    numa_nodes = max(1, min(int(numa_nodes), cpus))
+    nprocs = max(numa_nodes, cpus // THREADS_PER_PROCESS)
+    # Same number of processes in every NUMA node
+    nprocs -= nprocs % numa_nodes
+    return {"nprocs": nprocs, "nthreads": _threads(cpus, nprocs), "memory_limit": _memory_limit(memory_mb, nprocs)}
+
+
+def worker_layout(cpus, memory_mb, nprocs=1, nthreads=None, memory_limit=None, numa_nodes=None):
+    """dask-worker settings of a node with the ``auto`` values resolved
+
+    Parameters
+    ----------
+    cpus, memory_mb : int
+        ``num_cpus`` and ``mem_total`` grains
+    nprocs : int or ``'auto'``
+    nthreads, memory_limit : ``'auto'``, optional
+        Returned as they are unless they are ``'auto'``
+    numa_nodes : int, optional
+        By default the NUMA nodes of the machine it runs on
+
+    Returns
+    -------
+        dict with ``nprocs``, ``nthreads`` and ``memory_limit``
+    """
+    if numa_nodes is None:
+        numa_nodes = len(glob.glob("/sys/devices/system/node/node[0-9]*"))
+    if nprocs == "auto":
+        nprocs = auto_layout(cpus, 0, numa_nodes or 1)["nprocs"]
+        nthreads = "auto" if nthreads is None else nthreads
+        memory_limit = "auto" if memory_limit is None else memory_limit
+    nprocs = max(1, int(nprocs))
+    if nthreads == "auto":
+        nthreads = _threads(cpus, nprocs)
+    if memory_limit == "auto":
+        memory_limit = _memory_limit(memory_mb, nprocs)
+    return {"nprocs": nprocs, "nthreads": nthreads, "memory_limit": memory_limit}
+
+
+def _threads(cpus, nprocs):
+    return max(1, int(cpus) // nprocs)
+
+
+def _memory_limit(memory_mb, nprocs):
+    return "{}MB".format(int(memory_mb * MEMORY_FRACTION / nprocs))
+
+
+def candidate_layouts(cpus, numa_nodes=1):
+    """``(nprocs, nthreads)`` layouts that use all the CPUs of a node
+
+    The number of processes are the powers of two (and the ``auto`` layout)
+    that divide the number of CPUs, from one process with all the threads to
+    one single threaded process per CPU.
+    """
+    cpus = max(1, int(cpus))
+    auto = auto_layout(cpus, 0, numa_nodes)
+    nprocs = set([auto["nprocs"], cpus])
+    n = 1
+    while n < cpus:
+        if cpus % n == 0:
+            nprocs.add(n)
+        n *= 2
+    return [(n, _threads(cpus, n)) for n in sorted(nprocs)]
+
+
+def choose_layout(results):
+    """Fastest layout of a ``dask-ec2 dask-distributed tune`` run
+
+    Parameters
+    ----------
+    results : list of dict
+        ``{'nprocs', 'nthreads', 'gil_seconds', 'nogil_seconds'}`` per layout
+
+    Returns
+    -------
+        The result with the lowest time relative to the best layout of each
+        workload, so both workloads have the same weight
+    """
+    if not results:
+        return None
+    best_gil = min(r["gil_seconds"] for r in results) or 1e-9
+    best_nogil = min(r["nogil_seconds"] for r in results) or 1e-9
+
+    def __score(result):
+        return result["gil_seconds"] / best_gil + result["nogil_seconds"] / best_nogil
+
+    for result in results:
+        logger.debug("Layout %i x %i: score %.2f", result["nprocs"], result["nthreads"], __score(result))
+    return min(results, key=__score)